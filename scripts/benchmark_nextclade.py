@@ -0,0 +1,151 @@
+"""Benchmark the orchestration overhead of running Nextclade through VARGRAM.
+
+Synthetic FASTA batches are analysed by the stand-in Nextclade executable
+(tests/standin/nextclade), once through VARGRAM and once by running the
+stand-in directly with the same concurrency. The difference is the overhead of
+VARGRAM (splitting, scheduling, reading, QC and combining the output).
+The 'pipe' mode also counts the mutations, which the other modes leave to the
+Wrangler, and the 'incremental' mode is a repeated run with every sequence stored.
+
+Example:
+    python scripts/benchmark_nextclade.py --sequences 1000 100000 1000000 --batches 1 50 500 --modes file pipe
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+root = Path(__file__).parent.parent
+sys.path.insert(0, str(root / "src"))
+from vargram.wranglers._nextclade import nextclade, cpu_budget  # noqa: E402
+from vargram.wranglers._nextclade_async import nextclade_async  # noqa: E402
+
+STANDIN_DIR = root / "tests" / "standin"
+REF = root / "tests" / "test_data" / "sc2_wuhan_2019.fasta"
+GENE = root / "tests" / "test_data" / "sc2.gff"
+BASES = bytes(b"ACGT"[i % 4] for i in range(256))
+
+
+def write_batches(batch_dir, num_sequences, num_batches, length, duplicates, seed=0):
+    """Writes the sequences split into FASTA batches of about equal size."""
+    rng = random.Random(seed)
+    batch_dir.mkdir(parents=True)
+    sequences = []
+    for batch in range(num_batches):
+        batch_size = num_sequences // num_batches + (batch < num_sequences % num_batches)
+        with open(batch_dir / f"batch_{batch:03d}.fasta", "w") as fasta_file:
+            for i in range(batch_size):
+                if sequences and rng.random() < duplicates:
+                    sequence = rng.choice(sequences)
+                else:
+                    sequence = rng.randbytes(length).translate(BASES).decode()
+                    if len(sequences) < 10000: # Keeping a sample to duplicate from
+                        sequences.append(sequence)
+                fasta_file.write(f">seq_{batch}_{i}\n{sequence}\n")
+    return sorted(batch_dir.iterdir())
+
+
+def run_standin(batches, output_dir, processes, cpus):
+    """Runs the stand-in on each batch directly, with the same concurrency as VARGRAM."""
+    processes, jobs = cpu_budget(len(batches), processes=processes, cpus=cpus)
+    def run(batch):
+        command = ["nextclade", "run", "-r", str(REF), "-m", str(GENE),
+                   "-t", str(output_dir / f"{batch.name}.tsv"), "--jobs", str(jobs), str(batch)]
+        subprocess.run(command, check=True, capture_output=True)
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        list(executor.map(run, batches))
+
+
+def run_vargram(mode, seq, cache_dir, processes, cpus, shards):
+    """Runs Nextclade through VARGRAM in the given mode."""
+    nextclade_kwargs = {"seq": str(seq), "ref": str(REF), "gene": str(GENE),
+                        "processes": processes, "cpus": cpus, "shards": shards,
+                        "columns": ["batch", "seqName", "aaSubstitutions", "aaDeletions",
+                                    "aaInsertions", "warnings", "errors"]}
+    match mode:
+        case "file":
+            nextclade(**nextclade_kwargs)
+        case "pipe":
+            nextclade(**nextclade_kwargs, chunksize=10000)
+        case "async":
+            asyncio.run(nextclade_async(**nextclade_kwargs))
+        case "collapse":
+            nextclade(**nextclade_kwargs, collapse=True)
+        case "incremental": # A repeated run with every sequence stored
+            nextclade(**nextclade_kwargs, incremental=True, cache_dir=str(cache_dir))
+        case _:
+            raise ValueError(f"Unrecognized mode: {mode}")
+
+
+def best_time(function, repeat):
+    """Gets the shortest wall-clock time in seconds of repeated calls."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sequences", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--modes", nargs="+", default=["file", "pipe"],
+                        choices=["file", "pipe", "async", "collapse", "incremental"])
+    parser.add_argument("--length", type=int, default=100, help="Length of each sequence.")
+    parser.add_argument("--duplicates", type=float, default=0, help="Fraction of duplicated sequences.")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--cpus", type=int, default=None)
+    parser.add_argument("--shards", type=int, default=None, help="Shards of a single batch.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds slept when each run starts.")
+    parser.add_argument("--seq-latency", type=float, default=0, help="Seconds of alignment per sequence.")
+    parser.add_argument("--mutations", type=int, default=30, help="Mean substitutions per sequence.")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ["PATH"] = str(STANDIN_DIR) + os.pathsep + os.environ.get("PATH", "")
+    os.environ["NEXTCLADE_STANDIN_LATENCY"] = str(args.latency)
+    os.environ["NEXTCLADE_STANDIN_SEQ_LATENCY"] = str(args.seq_latency)
+    os.environ["NEXTCLADE_STANDIN_MUTATIONS"] = str(args.mutations)
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="vargram_benchmark_") as work_dir:
+        work_dir = Path(work_dir)
+        for num_sequences in args.sequences:
+            for num_batches in args.batches:
+                if num_batches > num_sequences:
+                    continue
+                config_dir = work_dir / f"{num_sequences}_{num_batches}"
+                batches = write_batches(config_dir / "sequences", num_sequences, num_batches,
+                                        args.length, args.duplicates)
+                seq = batches[0] if num_batches == 1 else config_dir / "sequences"
+                output_dir = config_dir / "standin_output"
+                output_dir.mkdir()
+                standin_time = best_time(lambda: run_standin(batches, output_dir, args.processes, args.cpus),
+                                         args.repeat)
+                for mode in args.modes:
+                    if mode == "incremental": # Storing the sequence results first
+                        run_vargram(mode, seq, config_dir / "cache", args.processes, args.cpus, args.shards)
+                    vargram_time = best_time(lambda: run_vargram(mode, seq, config_dir / "cache", args.processes,
+                                                                 args.cpus, args.shards), args.repeat)
+                    rows.append([num_sequences, num_batches, mode, f"{vargram_time:.2f}", f"{standin_time:.2f}",
+                                 f"{vargram_time - standin_time:.2f}", f"{num_sequences / vargram_time:,.0f}"])
+                    print(tabulate([rows[-1]], tablefmt="plain"), flush=True)
+
+    print()
+    print(tabulate(rows, headers=["sequences", "batches", "mode", "vargram (s)", "stand-in (s)",
+                                  "overhead (s)", "sequences/s"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 from .vargram import vargram
+from .wranglers._cache import clear_cache
 __version__ = "0.4.0"
\ No newline at end of file
@@ -4,7 +4,7 @@
 # "group" -> gene, "stack" -> batch, "x" -> mutations
 
 from . import _profile_renderer
-from ..wranglers._nextclade_utils import parse_mutation, get_mutation_type
+from ..wranglers._nextclade_utils import mutation_records
 import matplotlib.pyplot as plt
 import matplotlib.colors as mc
 import numpy as np
@@ -63,6 +63,127 @@ def match_attributes(cds_name, cds_attribute_string):
 
     return matched
 
+def count_stacks(data, index_columns, stack, values=None):
+    """Sums the values of each stack per row of index values, like pandas.pivot_table(aggfunc='sum').
+
+    The index columns and the stack are factorized into integer codes and the values 
+    are added into a matrix of rows and stacks in a single pass. Rows with a missing 
+    index or stack value are left out. Values that are not integers are summed with pandas.pivot_table().
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The data with the index columns, the stack column and the values column.
+    index_columns : list
+        The columns whose distinct combinations are the rows, sorted as by pandas.
+    stack : str
+        The column whose observed values are the stacks, in category order if categorical.
+    values : str
+        The column of the summed values. If not provided, the rows are counted.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The distinct index values.
+    list
+        The stack names.
+    numpy.ndarray
+        2D array of the sums with one column per stack, as int64 for integer values.
+
+    """
+    if values is not None and data[values].dtype.kind not in 'biu':
+        data_pivoted = pd.pivot_table(data, index=index_columns, columns=stack, values=values, aggfunc="sum", 
+                                      fill_value=0, observed=True).reset_index().rename_axis(None, axis=1)
+        stack_names = [col for col in data_pivoted.columns if col not in index_columns]
+        return data_pivoted[index_columns], stack_names, data_pivoted[stack_names].to_numpy()
+
+    # Combining the codes of the index columns into one key per row, in sorted order
+    row_keys = np.zeros(len(data), dtype=np.int64)
+    observed = np.ones(len(data), dtype=bool)
+    for col in index_columns + [stack]:
+        if isinstance(data[col].dtype, pd.CategoricalDtype):
+            codes, num_codes = data[col].cat.codes.to_numpy(), len(data[col].cat.categories)
+        else:
+            codes, uniques = pd.factorize(data[col], sort=True)
+            num_codes = len(uniques)
+        observed &= codes >= 0 # Missing values have code -1
+        if col == stack:
+            stack_codes, num_stack_codes = codes, num_codes
+            continue
+        if (int(row_keys.max(initial=0)) + 1) * num_codes > np.iinfo(np.int64).max: # Recoding the keys densely
+            row_keys = pd.factorize(row_keys, sort=True)[0].astype(np.int64)
+        row_keys = row_keys * num_codes + codes
+    row_keys, stack_codes = row_keys[observed], stack_codes[observed]
+    row_codes, unique_keys = pd.factorize(row_keys, sort=True) # Hashing, sorting only the distinct keys
+    key_rows = np.empty(len(unique_keys), dtype=np.int64) # A row of each distinct key
+    key_rows[row_codes] = np.arange(len(row_codes))
+    stack_sizes = np.bincount(stack_codes, minlength=num_stack_codes)
+    stack_values = np.flatnonzero(stack_sizes) # Observed stacks, in code order
+    stack_codes = np.cumsum(stack_sizes > 0)[stack_codes] - 1
+
+    # Adding the values of each row into its cell
+    cells = row_codes * len(stack_values) + stack_codes
+    num_cells = len(unique_keys) * len(stack_values)
+    if values is None:
+        sums = np.bincount(cells, minlength=num_cells)
+    else:
+        sums = np.zeros(num_cells, dtype=np.uint64 if data[values].dtype.kind == 'u' else np.int64)
+        np.add.at(sums, cells, data[values].to_numpy()[observed])
+    sums = sums.reshape(len(unique_keys), len(stack_values)).astype(np.int64)
+
+    index_data = data[index_columns][observed].iloc[key_rows].reset_index(drop=True)
+    if isinstance(data[stack].dtype, pd.CategoricalDtype):
+        stack_names = data[stack].cat.categories[stack_values].tolist()
+    else:
+        stack_names = pd.factorize(data[stack], sort=True)[1][stack_values].tolist()
+    return index_data, stack_names, sums
+
+def weight_basis_points(values):
+    """Converts the values of each stack to weights in basis points (hundredths of a percent).
+
+    Each weight is the percentage of the stack total rounded half to even to two decimals 
+    (as decimal.Decimal.quantize()) times 100. Non-negative whole values are converted 
+    over whole arrays with exact integer arithmetic. Other values are converted one at a time with Decimal.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D array of values with one column per stack.
+
+    Returns
+    -------
+    numpy.ndarray
+        2D array of the integer weights. Stacks with a zero total have zero weights.
+
+    """
+    if values.dtype.kind == 'f' and np.isfinite(values).all() and (values == np.round(values)).all() \
+            and np.abs(values).max(initial=0) < 2**53: # Whole numbers are exact as integers
+        values = values.astype(np.int64)
+    if values.dtype.kind in 'biu' and (values >= 0).all():
+        # Overflowing values are handled as Python integers
+        largest_total = int(values.max(initial=0)) * len(values)
+        dtype = np.int64 if largest_total <= np.iinfo(np.int64).max // 10000 else object
+        values = values.astype(dtype)
+        totals = values.sum(axis=0)
+        divisors = np.where(totals == 0, 1, totals)
+        scaled = values * 10000
+        quotients = scaled // divisors
+        remainders = scaled - quotients * divisors
+        halves = 2 * remainders
+        round_up = (halves > divisors) | ((halves == divisors) & (quotients % 2 == 1))
+        return quotients + round_up.astype(dtype)
+
+    basis_points = np.empty(values.shape, dtype=object)
+    for i in range(values.shape[1]): # Using Decimal for precision
+        stack = [Decimal(str(value)) for value in values[:, i]]
+        stack_sum = sum(stack, Decimal('0'))
+        if stack_sum == 0:
+            basis_points[:, i] = 0
+            continue
+        basis_points[:, i] = [int((value * Decimal('100') / stack_sum).quantize(Decimal('0.01')).scaleb(2)) 
+                              for value in stack]
+    return basis_points
+
 class Profile():
 
     def __init__(self, wrangled_data):
@@ -70,6 +191,7 @@ class Profile():
         self.data = wrangled_data["data"].copy() # User-provided data
         self.format = wrangled_data["format"] # Format of data (e.g. Nextclade, VARGRAM)
         self.annotation = wrangled_data.get("annotation") # Genome annotation file
+        self.counts = wrangled_data.get("counts") # Column of pre-aggregated counts (e.g. streamed data)
         self.plotted_already = False # Flag for whether the actual figure has been created
         self.verbose = False # Flag for printing completion of a method call
         self.fig = plt.figure() # The profile Figure object
@@ -119,27 +241,36 @@ class Profile():
         for process_key in process_kwargs.keys():
             setattr(self, process_key, process_kwargs[process_key])
 
-        # Pivoting dataframe to get x counts
-        # self.data -> data_pivoted
+        # Counting x per stack
+        # self.data -> data_pivoted -> stack_counts
+        # Defining index columns
+        index_columns = [self.group, self.x]
         data_pivoted = self.data.copy()
-        if self.y == '': # Choosing what to base counts on
-            values_for_counting = 'values_for_counting'
-            data_pivoted[values_for_counting] = 1
+
+        # Carrying the mutation positions and types parsed during wrangling
+        formats_with_positions = ['nextclade_fasta', 'nextclade_delimited', 'nextclade_ndjson', '_test']
+        record_columns = []
+        if self.format in formats_with_positions:
+            record_columns = ['position', 'type']
+            if not all(col in data_pivoted.columns for col in record_columns):
+                data_pivoted[record_columns] = mutation_records(data_pivoted['mutation'])
+        for col in index_columns + [self.stack]: # Grouping on integer category codes
+            if not isinstance(data_pivoted[col].dtype, pd.CategoricalDtype):
+                data_pivoted[col] = data_pivoted[col].astype('category')
+        if self.y == '' and self.counts is not None: # Data is already counted
+            values_for_counting = self.counts
+        elif self.y == '': # Counting the rows
+            values_for_counting = None
         elif self.y != '':
             values_for_counting = self.y
-        # Defining index columns
-        index_columns = [self.group, self.x]
-        data_pivoted = pd.pivot_table(data_pivoted, index=index_columns, columns=self.stack, values=values_for_counting, aggfunc="sum", fill_value=0).reset_index() 
-        data_pivoted.rename_axis(None, axis=1, inplace = True)
+        index_data, self.stack_names, stack_counts = count_stacks(data_pivoted, index_columns + record_columns, 
+                                                                  self.stack, values=values_for_counting)
 
         # Applying threshold, keeping only x
-        # data_pivoted -> data_filtered
-        self.stack_names = [stack for stack in data_pivoted.columns if stack not in index_columns]
+        # stack_counts -> data_filtered
         if len(self.stack_label) == 0: # Assigning stack_names as labels
             self.stack_label = self.stack_names
-        data_filtered = data_pivoted.copy()
-        for stack in self.stack_names:
-            data_filtered[stack] = data_pivoted[stack].apply(lambda x: 0 if x < self.threshold else x)
+        stack_counts = np.where(stack_counts < self.threshold, 0, stack_counts)
         
         # Determining whether to normalize or not
         # weights vs. counts
@@ -152,30 +283,36 @@ class Profile():
             self.ylabel = self.ytype.title()
         
         if self.ytype == 'weights':
-            for stack in self.stack_names: # Using Decimal for precision
-                data_filtered[stack] = data_filtered[stack].apply(lambda x: Decimal(str(x)))
-                stack_sum = data_filtered[stack].sum()
-                if stack_sum == 0:
-                    data_filtered[stack] = data_filtered[stack] * Decimal('0')
-                    continue
-                data_filtered[stack] = data_filtered[stack] * Decimal('100') / Decimal(str(stack_sum))
-                data_filtered[stack] = data_filtered[stack].apply(lambda x: x.quantize(Decimal('0.01'))) 
-        
-        # Summing x counts across all stacks
-        data_filtered['sum'] = data_filtered[self.stack_names].sum(axis=1)
-        if self.ytype == 'weights': # Converting Decimal objects back to float
-            for col in self.stack_names + ['sum']:
-                data_filtered[col] = data_filtered[col].apply(float)
+            basis_points = weight_basis_points(stack_counts)
+            stack_data = pd.DataFrame((basis_points / 100).astype(float), columns=pd.Index(self.stack_names))
+            # Summing the exact weights before converting to float
+            stack_data['sum'] = (basis_points.sum(axis=1) / 100).astype(float)
+        else: # Summing x counts across all stacks
+            stack_data = pd.DataFrame(stack_counts, columns=pd.Index(self.stack_names))
+            stack_data['sum'] = stack_data.sum(axis=1)
+        data_filtered = pd.concat([index_data, stack_data], axis=1)
         data_filtered = data_filtered[data_filtered['sum'] > 0]
         
         # Adding keys if provided
         # data_filtered -> self.data_for_plotting
         # data_filtered -> data_with_keys -> self.data_for_plotting
         if self.key_called:
-            data_with_keys = pd.merge(data_filtered, self.key_data, on=[self.group, self.x], how='outer')
-            data_with_keys.fillna(0, inplace=True)
+            key_data = self.key_data.copy()
+            for col in index_columns: # Merging on shared categories
+                categories = data_filtered[col].cat.categories.union(pd.Index(key_data[col].unique()))
+                data_filtered[col] = data_filtered[col].cat.set_categories(categories)
+                key_data[col] = pd.Categorical(key_data[col], categories=categories)
+            data_with_keys = pd.merge(data_filtered, key_data, on=[self.group, self.x], how='outer')
+            if record_columns: # Parsing only the mutations found in keys alone
+                key_only = data_with_keys['position'].isna()
+                if key_only.any():
+                    key_records = mutation_records(data_with_keys.loc[key_only, 'mutation'].astype(str))
+                    data_with_keys.loc[key_only, 'position'] = key_records['position']
+                    data_with_keys.loc[key_only, 'type'] = key_records['type'].astype(str)
+                data_with_keys['position'] = data_with_keys['position'].astype(np.int64)
+            numerical_columns = [col for col in data_with_keys.columns if col not in index_columns + record_columns]
+            data_with_keys[numerical_columns] = data_with_keys[numerical_columns].fillna(0)
             if data_filtered['sum'].dtype == np.int64:
-                numerical_columns = list(data_with_keys.columns)[2:]
                 for col in numerical_columns:
                     data_with_keys[col] = data_with_keys[col].astype(np.int64)
             data_with_keys.reset_index(drop=True, inplace=True)
@@ -186,18 +323,16 @@ class Profile():
         # Sorting data based on mutation position
         if self.data_for_plotting.columns.size > 0 and self.data_for_plotting.shape[0] == 0:
             raise ValueError("Plot DataFrame has no rows. Lowering threshold might help.")
-        formats_with_positions = ['nextclade_fasta', 'nextclade_delimited', '_test']
-        if self.format in formats_with_positions:
-            pos_index = self.data_for_plotting.columns.get_loc('mutation') + 1
-            mutation_positions = self.data_for_plotting['mutation'].apply(lambda x: parse_mutation(x, 'position'))
-            mutation_types = self.data_for_plotting['mutation'].apply(lambda x: get_mutation_type(x))
-            self.data_for_plotting.insert(pos_index, 'position', mutation_positions)
-            self.data_for_plotting.insert(pos_index+1, 'type', mutation_types)
+        if record_columns:
             self.data_for_plotting['position'] = self.data_for_plotting['position'].astype(int)
             self.data_for_plotting.sort_values(by=[self.group, 'position'], inplace=True)
         else:
             self.data_for_plotting.sort_values(by=[self.group, self.x], inplace=True)
         self.data_for_plotting.reset_index(drop=True, inplace=True)
+        for col in index_columns + record_columns: # Decoding categories
+            if isinstance(self.data_for_plotting[col].dtype, pd.CategoricalDtype):
+                categories = self.data_for_plotting[col].cat.categories
+                self.data_for_plotting[col] = self.data_for_plotting[col].astype(categories.dtype)
         
         # Getting data for calculating structure
         data_for_plotting = self.data_for_plotting.copy()
@@ -1,9 +1,15 @@
 """Main module for generating VARGRAM figures and data."""
 
 from .wranglers._wrangler import Wrangler
+from .wranglers._nextclade_async import nextclade_async
 from .plots._profile import Profile
+from .wranglers._nextclade_utils import strip_compression
+from .wranglers._watch import BatchWatcher
+import asyncio
 import pandas as pd
 import os
+import threading
+import time
 
 
 class vargram:
@@ -17,17 +23,75 @@ class vargram:
         seq : str
             FASTA file path of the sequences.
         ref : str
-            FASTA file path of the reference sequence.
+            FASTA file path of the reference sequence or name of the Nextclade dataset.
+            Nextclade datasets are downloaded once and kept in the cache directory.
+        tag : str
+            Version tag of the Nextclade dataset. If not provided, the latest dataset 
+            is downloaded and kept until refreshed (cache='refresh').
         gene : str
             GFF3 file path of the genome annotation.
-        data : str or pandas.DataFrame
-            The data to be plotted.
-        metadata : string or pandas.DataFrame
-            The metadata to be joined with the data.
+        data : str, list or pandas.DataFrame
+            The data to be plotted. 
+            Nextclade NDJSON output (.ndjson, optionally compressed) is read one record at a time.
+            A directory, glob pattern or list of Nextclade analysis files 
+            may be given, where each file is a batch.
+        qc : dict or bool
+            The QC criteria for keeping sequences: 'status' (accepted qc.overallStatus values),
+            'errors' and 'warnings' (remove flagged sequences) and 'coverage' (minimum coverage).
+            By default, sequences with errors or warnings are removed only when Nextclade is run.
+            If False, no sequence is removed.
+        processes : int
+            Number of processes for reading multiple Nextclade analysis files 
+            or number of FASTA batches run by Nextclade at the same time.
+            Defaults to the number of CPUs, up to the number of files or batches.
+            Analysis files smaller than 16 MB in total are read in one process by default.
+        cpus : int
+            Number of CPUs shared by the Nextclade runs. Each of the concurrent runs 
+            uses an equal share as Nextclade threads (--jobs). Defaults to the number of CPUs.
+        retries : int, default:1
+            Number of times a FASTA batch is run again if Nextclade fails.
+        collapse : bool, default:False
+            Determines whether identical sequences are run by Nextclade only once, 
+            with the results expanded back to each sequence name.
+        incremental : bool, default:False
+            Determines whether the Nextclade results of each sequence are kept in the cache directory 
+            (requires pyarrow), so that only sequences not analysed before are run by Nextclade.
+        shards : int
+            Number of parts a single uncompressed FASTA file of sequences is split into 
+            to be run by Nextclade at the same time. Defaults to one part per 64 MB, up to the number of CPUs.
+        chunksize : int
+            Number of rows of Nextclade analysis data to read at a time. 
+            If provided, only the running mutation counts are kept in memory. For FASTA sequences,
+            Nextclade writes only the needed analysis columns to a pipe, which are counted 
+            while the alignment is still running.
+        read_engine : str
+            The pandas.read_csv engine used to read Nextclade analysis data (e.g. 'pyarrow').
+            The C engine is used when chunksize is given, as 'pyarrow' cannot read in chunks.
+        engine : str, default:'pandas'
+            The execution engine for wrangling Nextclade data. If 'polars' (requires polars), 
+            the mutations are counted with a lazy multithreaded query. If 'duckdb' (requires duckdb), 
+            the mutations are counted out-of-core, spilling to disk. Metadata cannot be joined.
+        memory_limit : str
+            Maximum memory used by the DuckDB engine before spilling to disk (e.g. '4GB').
+        cache : bool or str, default:False
+            Determines whether wrangled Nextclade data is cached on disk (requires pyarrow).
+            Analyses of sequences are cached per reference, annotation and Nextclade version.
+            If 'refresh', the cached data is replaced.
+        cache_dir : str
+            The cache directory of analyses, sequence results and Nextclade datasets. Defaults to ~/.cache/vargram.
+        cache_size : float, default:1024
+            Maximum size of the cached analyses in megabytes. 
+            The least recently used analyses are removed first.
+        meta : str or pandas.DataFrame
+            The metadata to be joined with the data. For Nextclade data, the metadata 
+            is left joined to each sequence before exploding, reading only the columns 
+            referenced by the plot and the rows of the analysed sequences. Metadata columns 
+            that share the name of a data column (e.g. 'batch') are suffixed with '_meta'.
         join : str or list
             Provides the column to do an outer merge on. 
             If data and metadata do not share a column, 
             the two column names which share the values of interest may be provided.
+            For Nextclade data, a single column is the metadata column of sequence names.
         
         Returns
         -------
@@ -56,6 +120,8 @@ class vargram:
         self._clean_keys()
         self._shown = False
         self._saved = False
+        self._watcher = None
+        self._watched_data = None # Combined wrangled data of the watched batches
     
     def _clean_keys(self):
         """Flushes key variables clean."""
@@ -64,8 +130,17 @@ class vargram:
         self._key_labels = []
         self._key_colors = []
     
-    def _generate(self):
-        """Runs all called methods in correct order"""
+    def _wrangle(self):
+        """Wrangles the data of the most recent plot called, or gets the combined data of the watched batches."""
+        if self._watched_data is not None:
+            return self._watched_data
+        self._vargram_kwargs['plot'] = self._methods_called[self._latest_plot_index][1:].title()
+        # For reading only the referenced columns
+        self._vargram_kwargs['plot_kwargs'] = self._methods_kwargs[self._latest_plot_index]
+        return Wrangler(self._vargram_kwargs).get_wrangled_data()
+
+    def _generate(self, wrangled_data=None):
+        """Runs all called methods in correct order, wrangling the data if it is not provided"""
 
         # Ensure aes method is called
         if '_aes' not in self._methods_called[self._latest_plot_index:]:
@@ -88,8 +163,8 @@ class vargram:
         # Creating plot object instance
         plot_class = latest_method_calls[0][1:].title() 
         plot_object = globals()[plot_class]
-        self._vargram_kwargs['plot'] = plot_class
-        wrangled_data = Wrangler(self._vargram_kwargs).get_wrangled_data()
+        if wrangled_data is None:
+            wrangled_data = self._wrangle()
         self._plot_instance = plot_object(wrangled_data)
 
         # Rearranging so that auxiliary methods are run before plot and save/show methods
@@ -115,6 +190,42 @@ class vargram:
                 continue
         self._generate_plot = False
     
+    async def _agenerate(self, on_batch=None):
+        """Runs all called methods, wrangling the data in a worker thread.
+
+        Nextclade runs as asyncio subprocesses on the event loop. The figure is generated 
+        on the calling thread once the data is wrangled, as interactive Matplotlib backends 
+        must be used from the main thread.
+        """
+        loop = asyncio.get_running_loop()
+        lock = threading.Lock()
+        cancelled = False
+        runs = []
+
+        def run_nextclade(**nextclade_kwargs):
+            # Called by the Wrangler in the worker thread
+            with lock:
+                if cancelled:
+                    raise asyncio.CancelledError()
+                run = asyncio.run_coroutine_threadsafe(nextclade_async(on_batch=on_batch, **nextclade_kwargs), loop)
+                runs.append(run)
+            return run.result()
+
+        self._vargram_kwargs['run_nextclade'] = run_nextclade
+        try:
+            wrangled_data = None
+            if self._generate_plot:
+                wrangled_data = await asyncio.to_thread(self._wrangle)
+        except asyncio.CancelledError:
+            with lock:
+                cancelled = True
+                for run in runs:
+                    run.cancel() # Kills the Nextclade subprocesses
+            raise
+        finally:
+            self._vargram_kwargs.pop('run_nextclade', None)
+        self._generate(wrangled_data)
+
     def _show(self, **_show_kwargs): 
         """Show generated figure"""
         getattr(self._plot_instance, 'show')()
@@ -177,6 +288,106 @@ class vargram:
         self._methods_kwargs.append(save_kwargs)
         self._generate()
 
+    def watch(self, fname, interval=60, max_updates=None, **save_kwargs):
+        """Saves the figure or data again whenever batch files are added to, changed in or removed from the input.
+
+        Only the new or changed FASTA or Nextclade analysis files are wrangled, 
+        with the wrangled data of the other batches kept from earlier updates 
+        (and kept on disk if cache=True). A file is wrangled once it is 
+        unchanged between two checks, so that files still being copied are left for later.
+        Watches until interrupted (e.g. Ctrl+C) or until max_updates.
+
+        Parameters
+        ----------
+        fname : str or list
+            The file path or paths of the saved figure or data (see save).
+        interval : float, default:60
+            Number of seconds between checks of the input.
+        max_updates : int
+            Number of times the outputs are saved before watching stops.
+            If not provided, watches until interrupted.
+        **save_kwargs
+            Other arguments of the save method.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError
+            If no plot method (e.g. profile) is called before watching.
+            If the input is not a directory of FASTA files or multiple Nextclade analysis files.
+
+        """
+        if not self._methods_called:
+            raise ValueError("Call a plot method (e.g. profile) before watching.")
+        fnames = [fname] if isinstance(fname, str) else list(fname)
+        # Terminal methods since the latest plot method already ran
+        for i in reversed(range(self._latest_plot_index + 1, len(self._methods_called))):
+            if self._methods_called[i] in ['_' + terminal for terminal in self._terminals]:
+                del self._methods_called[i]
+                del self._methods_kwargs[i]
+        if self._watcher is None:
+            self._watcher = BatchWatcher(self._vargram_kwargs, self._wrangle_batch)
+
+        updates = 0
+        try:
+            while True:
+                if self._watcher.update():
+                    self._watched_data = self._watcher.wrangled_data()
+                    if self._watched_data is not None:
+                        for watched_fname in fnames:
+                            self._generate_plot = True # Each file is saved from a new plot of the wrangled data
+                            self.save(watched_fname, **save_kwargs)
+                            self._methods_called.pop() # Keeping the plot method the latest for the next update
+                            self._methods_kwargs.pop()
+                        updates += 1
+                        if max_updates is not None and updates >= max_updates:
+                            break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._watched_data = None
+            self._generate_plot = True
+
+    def _wrangle_batch(self, batch_input):
+        """Wrangles the data of one batch file of the watched input (see watch)."""
+        batch_input['plot'] = self._methods_called[self._latest_plot_index][1:].title()
+        batch_input['plot_kwargs'] = self._methods_kwargs[self._latest_plot_index]
+        return Wrangler(batch_input).get_wrangled_data()
+
+    async def astat(self, on_batch=None):
+        """Awaitable counterpart of the stat method.
+
+        Nextclade runs as asyncio subprocesses, which are killed if the awaiting task is cancelled.
+        
+        Parameters
+        ----------
+        on_batch : callable
+            Called with the batch name and the output DataFrame of each Nextclade run as it completes.
+            Coroutine functions are awaited.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The profile data.
+
+        """
+        self._methods_called.append('_stat')
+        self._methods_kwargs.append({'empty_string':''}) 
+        await self._agenerate(on_batch=on_batch)
+        return self._plot_data
+
+    async def asave(self, fname, on_batch=None, **save_kwargs):
+        """Awaitable counterpart of the save method (see astat)."""
+        self._saved = True
+        save_kwargs['fname'] = fname
+        self._methods_called.append('_save')
+        self._methods_kwargs.append(save_kwargs)
+        await self._agenerate(on_batch=on_batch)
+
     def profile(self,
                 threshold=10, 
                 x='mutation', 
@@ -255,7 +466,7 @@ class vargram:
 
         # Getting name of key
         if label == '' and isinstance(key_data, str):
-            label = os.path.basename(key_data)
+            label = os.path.basename(strip_compression(key_data)[0])
             label = os.path.splitext(label)[0]
         self._key_labels.append(label)
 
@@ -366,7 +577,7 @@ class vargram:
         Parameters
         ----------
         file : str
-            The file path to be read.
+            The file path to be read, which may be compressed (e.g. '.csv.gz').
         
         Returns
         -------
@@ -379,7 +590,7 @@ class vargram:
             If the given file is not a CSV or TSV file.
 
         """
-        root, extension = os.path.splitext(file)
+        root, extension = os.path.splitext(strip_compression(file)[0])
         if extension == '.csv':
             return pd.read_csv(file)
         elif extension == '.tsv':
@@ -0,0 +1,214 @@
+"""Module for caching wrangled Nextclade data on disk."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import pandas as pd
+from ._nextclade_utils import strip_compression
+
+
+def default_cache_dir():
+    """Gets the default VARGRAM cache directory.
+
+    Returns
+    -------
+    str
+        The 'vargram' directory under $XDG_CACHE_HOME (or ~/.cache).
+
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'vargram')
+
+
+def hash_file(file_path, hasher):
+    """Updates the hasher with the contents of the file or the FASTA files of a directory."""
+    if os.path.isdir(file_path):
+        for file in sorted(os.listdir(file_path)):
+            if strip_compression(file)[0].endswith(('.fasta', '.fa')):
+                hasher.update(file.encode())
+                hash_file(os.path.join(file_path, file), hasher)
+        return
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(block)
+
+
+def cache_key(user_input, format, options=None):
+    """Creates the cache key of wrangled Nextclade data.
+
+    Parameters
+    ----------
+    user_input : dict
+        The user input to the Wrangler. Inputs may be file paths, lists of file paths or dataset names.
+    format : str
+        The format of the data.
+    options : dict
+        Other options that change the wrangled data, such as the version of the
+        Nextclade dataset and of Nextclade (see _sequence_cache.dataset_version()).
+
+    Returns
+    -------
+    str or None
+        Hash of the input file contents, the options and the VARGRAM version.
+        None if the data cannot be cached (e.g. a DataFrame is provided).
+
+    """
+    from .. import __version__
+
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({'version': __version__, 'format': format,
+                              'options': options or {}}, sort_keys=True).encode())
+    for key in ['data', 'seq', 'ref', 'gene', 'meta']:
+        if key not in user_input.keys():
+            continue
+        values = user_input[key]
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return None
+        hasher.update(key.encode())
+        for value in values:
+            if os.path.exists(value):
+                hash_file(value, hasher)
+            else: # Nextclade dataset name
+                hasher.update(value.encode())
+    return hasher.hexdigest()
+
+
+def load_cache(cache_dir, key):
+    """Loads cached wrangled data.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    key : str
+        The cache key.
+
+    Returns
+    -------
+    dict or None
+        The wrangled data ('data', 'annotation', 'counts') or None if not cached.
+
+    """
+    entry_dir = os.path.join(cache_dir, 'analyses', key)
+    entry_path = os.path.join(entry_dir, 'entry.json')
+    if not os.path.isfile(entry_path):
+        return None
+    with open(entry_path) as entry_file:
+        entry = json.load(entry_file)
+    cached = {'data': pd.read_parquet(os.path.join(entry_dir, 'data.parquet')),
+              'counts': entry.get('counts')}
+    if entry.get('annotation'):
+        cached['annotation'] = pd.read_parquet(os.path.join(entry_dir, 'annotation.parquet'))
+    os.utime(entry_dir) # Marking as recently used
+    return cached
+
+
+def store_cache(cache_dir, key, data, annotation=None, counts=None, max_size=None):
+    """Stores wrangled data in the cache as Parquet files.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    key : str
+        The cache key.
+    data : pandas.DataFrame
+        The wrangled data.
+    annotation : pandas.DataFrame
+        The genome annotation.
+    counts : str
+        The column of pre-aggregated counts, if any.
+    max_size : float
+        Maximum size of the cached analyses in megabytes.
+
+    Returns
+    -------
+    None
+
+    """
+    analyses_dir = os.path.join(cache_dir, 'analyses')
+    os.makedirs(analyses_dir, exist_ok=True)
+
+    # Writing to a temporary directory first so that entries are never partially written
+    temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=analyses_dir)
+    try:
+        data.to_parquet(os.path.join(temp_dir, 'data.parquet'), index=False)
+        if annotation is not None:
+            annotation.to_parquet(os.path.join(temp_dir, 'annotation.parquet'), index=False)
+        with open(os.path.join(temp_dir, 'entry.json'), 'w') as entry_file:
+            json.dump({'counts': counts, 'annotation': annotation is not None}, entry_file)
+        entry_dir = os.path.join(analyses_dir, key)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.replace(temp_dir, entry_dir)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+    if max_size is not None:
+        prune_cache(cache_dir, max_size)
+
+
+def prune_cache(cache_dir, max_size):
+    """Removes the least recently used cached analyses until the cache fits the size limit.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    max_size : float
+        Maximum size of the cached analyses in megabytes.
+
+    Returns
+    -------
+    None
+
+    """
+    analyses_dir = os.path.join(cache_dir, 'analyses')
+    entries = []
+    for key in os.listdir(analyses_dir):
+        entry_dir = os.path.join(analyses_dir, key)
+        if key.startswith('.tmp_') or not os.path.isdir(entry_dir):
+            continue
+        entry_size = sum(os.path.getsize(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(entry_dir), entry_size, entry_dir))
+
+    total_size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry_dir in sorted(entries):
+        if total_size <= max_size * 1024 * 1024:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= entry_size
+
+
+def clear_cache(cache_dir=None, datasets=False, sequences=False):
+    """Removes all cached analyses.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory. Uses the default VARGRAM cache directory if not provided.
+    datasets : bool, default:False
+        Determines whether the downloaded Nextclade datasets are also removed.
+    sequences : bool, default:False
+        Determines whether the stored Nextclade results of each sequence are also removed.
+
+    Returns
+    -------
+    None
+
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    subdirs = ['analyses']
+    if datasets:
+        subdirs.append('datasets')
+    if sequences:
+        subdirs.append('sequences')
+    for subdir in subdirs:
+        if os.path.exists(os.path.join(cache_dir, subdir)):
+            shutil.rmtree(os.path.join(cache_dir, subdir))
@@ -0,0 +1,316 @@
+"""Module for caching Nextclade reference datasets on disk."""
+
+from ._cache import default_cache_dir
+from ._nextclade_cli import dataset_command, run_command
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+
+# Files of a downloaded Nextclade dataset used by VARGRAM
+DATASET_FILES = ['reference.fasta', 'genome_annotation.gff3']
+
+# Seconds for which the cached catalogue of Nextclade datasets is used without updating
+CATALOGUE_TTL = 24 * 60 * 60
+
+# Seconds after which a lock file held on another host is assumed to be left by a crashed process
+LOCK_STALE = 24 * 60 * 60
+
+
+def dataset_dir(name, tag=None, cache_dir=None):
+    """Gets the cache directory of a Nextclade dataset.
+
+    Parameters
+    ----------
+    name : str
+        Name or shortcut of the Nextclade dataset (e.g. 'nextstrain/sars-cov-2/wuhan-hu-1/orfs').
+    tag : str
+        Version tag of the dataset. The latest version is used if not provided.
+    cache_dir : str
+        The cache directory. Uses the default VARGRAM cache directory if not provided.
+
+    Returns
+    -------
+    str
+        The directory 'datasets/<name>/<tag>' (or 'datasets/<name>/latest') in the cache directory.
+
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    return os.path.join(cache_dir, 'datasets', name.replace('/', '__'), tag or 'latest')
+
+
+def is_downloaded(target_dir):
+    """Checks whether the dataset files have been downloaded to the directory."""
+    return all(os.path.isfile(os.path.join(target_dir, file)) for file in DATASET_FILES)
+
+
+def stale_lock(lock_path, stale=LOCK_STALE):
+    """Checks whether a lock file is left by a crashed process.
+
+    The lock file holds the host name and process ID of its owner. A lock held on 
+    this host is stale only if its owner is no longer running, however long it is held.
+    Other locks (e.g. held on another host sharing the cache) are stale once they are older than stale.
+
+    Parameters
+    ----------
+    lock_path : str
+        Path of the lock file.
+    stale : float
+        Seconds after which a lock file whose owner cannot be checked is assumed to be stale.
+
+    Returns
+    -------
+    os.stat_result or None
+        The status of the lock file if it is stale, so that only this lock file is removed. 
+        None if the lock is held or released.
+
+    """
+    try:
+        status = os.stat(lock_path)
+        with open(lock_path) as lock_file:
+            owner = lock_file.read().split()
+    except FileNotFoundError: # Released in the meantime
+        return None
+    if len(owner) == 2 and owner[0] == socket.gethostname() and owner[1].isdigit():
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return status
+        except PermissionError: # Running as another user
+            pass
+        return None
+    if time.time() - status.st_mtime > stale:
+        return status
+    return None
+
+
+def acquire_lock(lock_path, timeout=None, stale=LOCK_STALE):
+    """Creates a lock file, waiting while another process holds it.
+
+    Parameters
+    ----------
+    lock_path : str
+        Path of the lock file.
+    timeout : float
+        Maximum seconds to wait for the lock. Waits as long as the lock is held if not provided.
+    stale : float
+        Seconds after which a lock file whose owner cannot be checked is assumed to be 
+        left by a crashed process (see stale_lock()).
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    TimeoutError
+        If the lock is not acquired within the timeout.
+
+    """
+    start = time.monotonic()
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            status = stale_lock(lock_path, stale=stale)
+            if status is not None:
+                try:
+                    if os.stat(lock_path).st_ino == status.st_ino: # Not yet replaced by another process
+                        os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+        else:
+            with os.fdopen(fd, 'w') as lock_file:
+                lock_file.write(f'{socket.gethostname()} {os.getpid()}\n')
+            return
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"Timed out waiting for the lock {lock_path}.")
+        time.sleep(0.1)
+
+
+def get_dataset(name, tag=None, cache_dir=None, refresh=False):
+    """Gets a Nextclade dataset, downloading it only if it is not yet cached.
+
+    The download is written to a temporary directory and moved into place,
+    while a lock file ensures that concurrent runs and processes download
+    the dataset only once.
+
+    Parameters
+    ----------
+    name : str
+        Name or shortcut of the Nextclade dataset.
+    tag : str
+        Version tag of the dataset. The latest version is downloaded if not provided
+        and is then kept until refreshed.
+    cache_dir : str
+        The cache directory. Uses the default VARGRAM cache directory if not provided.
+    refresh : bool, default:False
+        Determines whether a cached dataset is downloaded again.
+
+    Returns
+    -------
+    str
+        The directory of the dataset files.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails to download the dataset.
+
+    """
+    target_dir = dataset_dir(name, tag=tag, cache_dir=cache_dir)
+    if is_downloaded(target_dir) and not refresh:
+        return target_dir
+
+    parent_dir = os.path.dirname(target_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    lock_path = target_dir + '.lock'
+    acquire_lock(lock_path)
+    try:
+        if is_downloaded(target_dir) and not refresh: # Downloaded by another process while waiting
+            return target_dir
+        temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent_dir)
+        try:
+            run_command(dataset_command(name, temp_dir, tag=tag))
+            if os.path.exists(target_dir):
+                shutil.rmtree(target_dir)
+            os.replace(temp_dir, target_dir)
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+    finally:
+        os.remove(lock_path)
+    return target_dir
+
+
+def is_cached(name, cache_dir=None):
+    """Checks whether any version of the Nextclade dataset has been downloaded to the cache."""
+    name_dir = os.path.dirname(dataset_dir(name, cache_dir=cache_dir))
+    if not os.path.isdir(name_dir):
+        return False
+    return any(is_downloaded(os.path.join(name_dir, tag)) for tag in os.listdir(name_dir) 
+               if not tag.startswith('.tmp_'))
+
+
+def fetch_catalogue():
+    """Lists the names and shortcuts of the Nextclade datasets with Nextclade CLI.
+
+    Returns
+    -------
+    dict
+        The dataset 'names' and 'shortcuts'.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails to list the datasets (e.g. there is no network).
+
+    """
+    dataset_names_only = run_command(['nextclade', 'dataset', 'list', '--only-names']).split()
+    dataset_list_full = run_command(['nextclade', 'dataset', 'list'])
+    shortcut_parentheses = r'\(shortcuts:(.*?)\)' # getting all shortcuts enclosed in parentheses
+    shortcut_quotes = r'"(.*?)"' # getting the individual shortcuts enclosed in double quotes
+    dataset_shortcuts = re.findall(shortcut_parentheses, dataset_list_full)
+    dataset_shortcuts = ' '.join(dataset_shortcuts)
+    dataset_shortcuts = re.findall(shortcut_quotes, dataset_shortcuts)
+    return {'names': dataset_names_only, 'shortcuts': dataset_shortcuts}
+
+
+def dataset_catalogue(cache_dir=None, ttl=CATALOGUE_TTL, refresh=False):
+    """Gets the catalogue of Nextclade datasets, listing the datasets only if the cached catalogue is old.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory. Uses the default VARGRAM cache directory if not provided.
+    ttl : float
+        Seconds for which the cached catalogue is used without listing the datasets again.
+    refresh : bool, default:False
+        Determines whether the datasets are listed again regardless of the age of the cached catalogue.
+
+    Returns
+    -------
+    dict or None
+        The dataset 'names' and 'shortcuts'. If the datasets cannot be listed (e.g. there is no network), 
+        the old cached catalogue is returned, or None if there is none.
+
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    catalogue_path = os.path.join(cache_dir, 'datasets', 'catalogue.json')
+    cached = None
+    if os.path.isfile(catalogue_path):
+        try:
+            with open(catalogue_path) as catalogue_file:
+                cached = json.load(catalogue_file)
+        except (OSError, ValueError): # Unreadable catalogue is listed again
+            cached = None
+    if cached is not None and not refresh and time.time() - cached['fetched'] < ttl:
+        return cached
+
+    try:
+        catalogue = fetch_catalogue()
+    except (FileNotFoundError, RuntimeError):
+        return cached
+    catalogue['fetched'] = time.time()
+
+    # Writing to a temporary file first so that the catalogue is never partially written
+    os.makedirs(os.path.dirname(catalogue_path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(catalogue_path))
+    with os.fdopen(fd, 'w') as catalogue_file:
+        json.dump(catalogue, catalogue_file)
+    os.replace(temp_path, catalogue_path)
+    return catalogue
+
+
+def check_reference(ref, tag=None, cache_dir=None, refresh=False):
+    """Checks whether provided reference name is in Nextclade.
+
+    A dataset that is already in the cache is valid without listing the datasets. 
+    Otherwise, the name is checked against the cached catalogue of datasets
+    (see dataset_catalogue()).
+    
+    Parameters
+    ----------
+    ref : str 
+        The dataset name.
+    tag : str
+        Version tag of the dataset.
+    cache_dir : str
+        The cache directory. Uses the default VARGRAM cache directory if not provided.
+    refresh : bool, default:False
+        Determines whether the datasets are listed again.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ValueError
+        If Nextclade reference dataset name is not recognized, or if it cannot be 
+        checked because the datasets cannot be listed and the dataset is not cached.
+
+    """
+    if not refresh and is_downloaded(dataset_dir(ref, tag=tag, cache_dir=cache_dir)):
+        return None
+    catalogue = dataset_catalogue(cache_dir=cache_dir, refresh=refresh)
+    if catalogue is None:
+        if is_cached(ref, cache_dir=cache_dir):
+            return None
+        raise ValueError(f"Nextclade reference name '{ref}' cannot be checked. The Nextclade datasets "
+                         "cannot be listed (e.g. there is no network) and the dataset has not been downloaded before.")
+    if ref not in catalogue['names'] and ref not in catalogue['shortcuts']:
+        raise ValueError(f"Nextclade reference name '{ref}' not recognized. "
+                         "Run 'nextclade dataset list' to see valid names and shortcuts.")
+    return None
+
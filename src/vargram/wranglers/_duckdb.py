@@ -0,0 +1,203 @@
+"""Module for wrangling Nextclade analysis output out-of-core with the DuckDB engine."""
+
+from ._nextclade_utils import strip_compression, present_columns, qc_columns, count_prefixed_mutations
+import pandas as pd
+import os
+import shutil
+import tempfile
+
+# Compressions that DuckDB reads directly. Other compressed files are loaded in chunks.
+DUCKDB_COMPRESSIONS = [None, 'gz', 'zst']
+
+
+def import_duckdb():
+    """Imports DuckDB, which is an optional dependency.
+
+    Returns
+    -------
+    module
+        The duckdb module.
+
+    Raises
+    ------
+    ImportError
+        If DuckDB is not installed.
+
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("The DuckDB engine requires duckdb. Install with 'pip install vargram[duckdb]'.")
+    return duckdb
+
+
+def quote(value):
+    """Quotes a string as an SQL string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def quote_column(column):
+    """Quotes a column name as an SQL identifier (e.g. "qc.overallStatus")."""
+    return '"' + column.replace('"', '""') + '"'
+
+
+def add_source(connection, name, table_object, columns, chunksize=100000):
+    """Makes a Nextclade table available to DuckDB as a view or a table.
+
+    Uncompressed, gzip and zstd files are scanned directly by DuckDB. DataFrames
+    are registered as is and other compressed files are loaded into a table
+    in chunks. All columns are read as strings.
+
+    Parameters
+    ----------
+    connection : duckdb.DuckDBPyConnection
+        The database connection.
+    name : str
+        The name of the view or table.
+    table_object : str or pandas.DataFrame
+        File path of the Nextclade analysis output or its DataFrame.
+    columns : list
+        The Nextclade columns to read.
+    chunksize : int, default:100000
+        Number of rows loaded at a time from files DuckDB cannot read.
+
+    Returns
+    -------
+    list
+        The columns of the source.
+
+    """
+    if isinstance(table_object, pd.DataFrame):
+        # Nullable strings, so that missing values stay NULL instead of becoming 'nan'
+        table = table_object[[col for col in table_object.columns if col in columns]].astype('string')
+        connection.register(name, table)
+        return table.columns.tolist()
+
+    root, compression = strip_compression(table_object)
+    ext = os.path.splitext(root)[1]
+    match ext:
+        case '.csv':
+            delimiter = ';'
+        case '.tsv':
+            delimiter = '\t'
+        case _:
+            raise ValueError(f"Unrecognized file extension. Expecting .csv or .tsv file but got {ext}")
+    source_columns = present_columns(table_object, delimiter, columns)
+
+    if compression in DUCKDB_COMPRESSIONS:
+        connection.execute(f"CREATE VIEW {name} AS SELECT * FROM read_csv({quote(table_object)}, "
+                           f"delim={quote(delimiter)}, header=true, all_varchar=true)")
+        return source_columns
+
+    chunks = pd.read_csv(table_object, delimiter=delimiter, usecols=source_columns,
+                         chunksize=chunksize, dtype=str)
+    for i, chunk in enumerate(chunks):
+        connection.register('chunk', chunk)
+        if i == 0:
+            connection.execute(f"CREATE TABLE {name} AS SELECT * FROM chunk")
+        else:
+            connection.execute(f"INSERT INTO {name} BY NAME SELECT * FROM chunk")
+        connection.unregister('chunk')
+    return source_columns
+
+
+def qc_condition(qc):
+    """Creates the SQL condition and parameters of the QC criteria (see _nextclade_utils.qc_filter())."""
+    conditions = ['true']
+    parameters = []
+    if not qc:
+        return conditions[0], parameters
+    for flag in ['errors', 'warnings']:
+        if qc.get(flag):
+            conditions.append(f"coalesce(trim({quote_column(flag)}, ' \t\n\r'), '') = ''")
+    if qc.get('status') is not None:
+        status = [qc['status']] if isinstance(qc['status'], str) else qc['status']
+        conditions.append(f"{quote_column('qc.overallStatus')} IN ({', '.join('?' for _ in status)})")
+        parameters.extend(status)
+    if qc.get('coverage') is not None:
+        conditions.append(f"TRY_CAST({quote_column('coverage')} AS DOUBLE) >= ?")
+        parameters.append(qc['coverage'])
+    return ' AND '.join(conditions), parameters
+
+
+def count_nextclade_duckdb(tables, columns, batches=None, qc=None, memory_limit=None):
+    """Counts the mutations per batch and gene out-of-core with DuckDB.
+
+    The amino acid mutation columns are joined, split and unnested, and the
+    prefixed mutations (e.g. ORF1b:G662S) are counted per batch by DuckDB
+    (see _nextclade_utils.count_prefixed_mutations()). Intermediate data that
+    does not fit in memory is spilled to a temporary database directory,
+    which is under $TMPDIR and is removed afterwards.
+
+    Parameters
+    ----------
+    tables : list
+        File paths or DataFrames of Nextclade analysis output.
+    columns : list
+        The Nextclade columns to read.
+    batches : list
+        Batch name of each table without a batch column. Defaults to 'my_batch'.
+    qc : dict
+        The QC criteria (see _nextclade_utils.qc_filter()).
+    memory_limit : str
+        Maximum memory used by DuckDB before spilling to disk (e.g. '4GB').
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns,
+        the parsed position and type columns and an unsigned integer count column.
+
+    Raises
+    ------
+    ValueError
+        If a Nextclade column needed by the QC criteria is missing,
+        if no mutation is found or if a mutation has no gene prefix.
+
+    """
+    duckdb = import_duckdb()
+    aa_columns = ['aaSubstitutions', 'aaDeletions', 'aaInsertions']
+    needed_columns = aa_columns + qc_columns(qc)
+    if batches is None:
+        batches = ['my_batch'] * len(tables)
+
+    database_dir = tempfile.mkdtemp(prefix='vargram_duckdb_')
+    connection = duckdb.connect(os.path.join(database_dir, 'vargram.duckdb'))
+    try:
+        connection.execute(f"SET temp_directory={quote(database_dir)}")
+        if memory_limit is not None:
+            connection.execute(f"SET memory_limit={quote(memory_limit)}")
+
+        # Combining the sources, keeping only the needed columns
+        selects = []
+        for i, (table, batch) in enumerate(zip(tables, batches)):
+            source_columns = add_source(connection, f'source_{i}', table, columns)
+            missing_columns = [col for col in qc_columns(qc) if col not in source_columns]
+            if missing_columns:
+                raise ValueError(f"Nextclade column(s) needed for QC not found: {', '.join(missing_columns)}")
+            batch_column = 'CAST("batch" AS VARCHAR)' if 'batch' in source_columns else quote(batch)
+            selected = [f"{batch_column} AS batch"]
+            for col in needed_columns:
+                if col in source_columns:
+                    selected.append(f"CAST({quote_column(col)} AS VARCHAR) AS {quote_column(col)}")
+                else:
+                    selected.append(f"NULL::VARCHAR AS {quote_column(col)}")
+            selects.append(f"SELECT {', '.join(selected)} FROM source_{i}")
+
+        condition, parameters = qc_condition(qc)
+        joined_mutations = ', '.join(f"coalesce({quote_column(col)}, '')" for col in aa_columns)
+        query = f"""
+            SELECT batch, mutation, count(*) AS count
+            FROM (
+                SELECT batch, unnest(string_split(concat_ws(',', {joined_mutations}), ',')) AS mutation
+                FROM ({' UNION ALL '.join(selects)})
+                WHERE {condition}
+            )
+            WHERE mutation != ''
+            GROUP BY batch, mutation
+        """
+        prefixed_counts = connection.execute(query, parameters).df()
+    finally:
+        connection.close()
+        shutil.rmtree(database_dir, ignore_errors=True)
+    return count_prefixed_mutations(prefixed_counts)
@@ -4,97 +4,465 @@
 # 1. A single FASTA containing multiple sequences (1 batch)
 # 2. A directory containing N FASTA files, each containing multiple sequences (N batches)
 
-from ._nextclade_utils import input_checker
-from ._nextclade_cli import create_command, capture_output
+from ._nextclade_utils import input_checker, strip_compression, batch_name, qc_filter, count_nextclade, count_mutations
+from ._nextclade_cli import create_command, dataset_paths, capture_output, stream_output
+from ._datasets import check_reference, get_dataset
+from . import _sequence_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import math
+import mmap
 import os
 import pandas as pd
 import tempfile
 import shutil
+import warnings
+
+# Size in bytes of FASTA per shard when the number of shards is not provided
+SHARD_SIZE = 64 * 1024 * 1024
+
+
+def cpu_budget(num_batches, processes=None, cpus=None):
+    """Splits the CPU budget between concurrent Nextclade runs and the threads of each run.
+
+    Parameters
+    ----------
+    num_batches : int
+        Number of FASTA batches.
+    processes : int
+        Number of concurrent Nextclade runs. Defaults to as many batches as there are CPUs.
+    cpus : int
+        Total number of CPUs to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    int
+        Number of concurrent Nextclade runs.
+    int
+        Number of threads (--jobs) of each Nextclade run.
+
+    """
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    if processes is None:
+        processes = cpus
+    processes = max(1, min(processes, num_batches))
+    return processes, max(1, cpus // processes)
+
+
+def fasta_shard_offsets(file_path, num_shards):
+    """Splits a FASTA file into shards of about equal size at record boundaries.
+
+    The file is memory-mapped and only searched for the record headers ('>' at the 
+    start of a line) nearest to the equal-size split points, without parsing the records.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the (uncompressed) FASTA file.
+    num_shards : int
+        Number of shards. Fewer shards are returned if the file has fewer records.
+
+    Returns
+    -------
+    list
+        The (start, end) byte offsets of each shard.
+
+    """
+    size = os.path.getsize(file_path)
+    if num_shards <= 1 or size == 0:
+        return [(0, size)]
+    boundaries = [0]
+    with open(file_path, 'rb') as fasta_file, mmap.mmap(fasta_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta_map:
+        for i in range(1, num_shards):
+            start = max(size * i // num_shards - 1, boundaries[-1])
+            header_position = fasta_map.find(b'\n>', start)
+            if header_position == -1:
+                break
+            if header_position + 1 > boundaries[-1]:
+                boundaries.append(header_position + 1)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def write_fasta_shards(file_path, num_shards, shard_dir):
+    """Writes the shards of a FASTA file (see fasta_shard_offsets()).
+
+    Each shard keeps the name of the FASTA file, so that it has the same batch name,
+    and is written to its own subdirectory of the shard directory.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the (uncompressed) FASTA file.
+    num_shards : int
+        Number of shards.
+    shard_dir : str
+        Directory where the shards are written.
+
+    Returns
+    -------
+    list
+        The file paths of the shards.
+
+    """
+    shard_paths = []
+    with open(file_path, 'rb') as fasta_file:
+        for i, (start, end) in enumerate(fasta_shard_offsets(file_path, num_shards)):
+            os.makedirs(os.path.join(shard_dir, f'shard_{i}'))
+            shard_path = os.path.join(shard_dir, f'shard_{i}', os.path.basename(file_path))
+            fasta_file.seek(start)
+            with open(shard_path, 'wb') as shard_file:
+                remaining = end - start
+                while remaining > 0:
+                    block = fasta_file.read(min(remaining, 1 << 20))
+                    shard_file.write(block)
+                    remaining -= len(block)
+            shard_paths.append(shard_path)
+    return shard_paths
+
+
+def batch_command(seq, nextclade_input, read_options, chunksize=None, **command_kwargs):
+    """Creates the Nextclade command of a FASTA batch, piping only the read columns if a chunk size is provided."""
+    if chunksize is not None:
+        nextclade_command, _ = create_command(input={**nextclade_input, 'seq': seq}, pipe=True, 
+                                              columns=read_options['columns'], **command_kwargs)
+    else:
+        nextclade_command, _ = create_command(input={**nextclade_input, 'seq': seq}, **command_kwargs)
+    return nextclade_command
+
+
+def run_batch(seq, nextclade_input, read_options, qc, retries=1, chunksize=None, **command_kwargs):
+    """Runs Nextclade on one FASTA batch, retrying if Nextclade fails.
+
+    If a chunk size is provided, Nextclade writes the analysis output to a pipe
+    and the mutations are counted chunk by chunk while Nextclade is still running.
+
+    Parameters
+    ----------
+    seq : str
+        FASTA file path of the batch.
+    nextclade_input : dict
+        The user input to nextclade().
+    read_options : dict
+        Options for reading the analysis output (see capture_output()).
+    qc : dict
+        The QC criteria (see qc_filter()).
+    retries : int, default:1
+        Number of times a failed run is repeated.
+    chunksize : int
+        Number of analysis rows read from the pipe at a time.
+    **command_kwargs
+        Other arguments to create_command().
+
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis output of the sequences that pass the QC criteria, with a batch column.
+        If a chunk size is provided, the mutation counts of the batch (see count_nextclade()).
+
+    Raises
+    ------
+    RuntimeError
+        If Nextclade fails on every attempt.
+
+    """
+    nextclade_command = batch_command(seq, nextclade_input, read_options, chunksize=chunksize, **command_kwargs)
+    for attempt in range(retries + 1):
+        try:
+            if chunksize is not None: # Counts of a failed attempt are discarded
+                return count_nextclade(stream_output(nextclade_command, chunksize=chunksize), 
+                                       batch=batch_name(seq), allow_empty=True, qc=qc)
+            output = capture_output(nextclade_command, **read_options)
+            break
+        except RuntimeError:
+            if attempt == retries:
+                raise
+    output = qc_filter(output, qc)
+    output.insert(0, 'batch', batch_name(seq))
+    return output
 
 
 def nextclade(**kwargs):
     """Takes input sequence FASTA files and transforms it 
     into a DataFrame to be plotted by VARGRAM.
 
+    If a directory of FASTA files is provided, the batches are run concurrently, 
+    sharing the CPUs between the concurrent runs and the threads of each run.
+    A single large FASTA file is split into shards that are run concurrently 
+    and merged back into one batch. If a chunk size is provided, the analysis 
+    output is piped from Nextclade and counted while the alignment is running, 
+    without writing it to disk. If incremental, sequences analysed before are
+    not run again (see _sequence_cache). If collapsed, identical sequences 
+    are run once and the results are expanded back to each sequence name.
+
     Parameters
     ----------
     seq : str
-        FASTA file path of the sequences.
+        FASTA file path of the sequences. Compressed FASTA files (e.g. '.fasta.gz') 
+        are passed to Nextclade as is and decompressed by Nextclade.
     ref : str
         FASTA file path of the reference sequence.
     gene : str
         GFF3 file path of the genome annotation.
+    columns : list
+        Nextclade analysis columns to read. All columns are read if not provided.
+    read_engine : str
+        The pandas.read_csv engine used to read the analysis output (e.g. 'pyarrow').
+    chunksize : int
+        Number of analysis rows read from the Nextclade pipe at a time. 
+        If provided, the mutation counts are returned instead of the analysis output.
+    qc : dict
+        The QC criteria applied to each batch as it is read (see qc_filter()).
+        Sequences with errors or warnings are removed if not provided.
+    processes : int
+        Number of batches run at the same time. Defaults to the number of CPUs.
+    cpus : int
+        Number of CPUs shared by the runs. Defaults to the number of CPUs.
+    retries : int, default:1
+        Number of times a failed batch is run again.
+    shards : int
+        Number of shards a single uncompressed FASTA file is split into and run at the same time.
+        Defaults to one shard per 64 MB of FASTA, up to the number of CPUs.
+    tag : str
+        Version tag of the Nextclade dataset if a dataset name is provided as ref.
+    cache_dir : str
+        The cache directory where Nextclade datasets are kept. Defaults to ~/.cache/vargram.
+    refresh : bool, default:False
+        Determines whether a cached Nextclade dataset is downloaded again.
+    incremental : bool, default:False
+        Determines whether the Nextclade results of each sequence are stored in the cache 
+        directory (requires pyarrow). Only sequences without stored results for the same 
+        reference, annotation and Nextclade version are then run by Nextclade.
+    collapse : bool, default:False
+        Determines whether identical sequences (ignoring letter case) are collapsed,
+        so that only one sequence of each group is run by Nextclade.
     
     Returns
     -------
-    None
+    pandas.DataFrame
+        The analysis output with a batch column, sorted by batch and sequence name,
+        or the mutation counts if a chunk size is provided (see _nextclade_utils.count_mutations()).
+    pandas.DataFrame
+        The genome annotation.
 
     Raises
     ------
     ValueError
         If Nextclade analysis dataframe is empty.
+        If the Nextclade dataset name is not recognized (see _datasets.check_reference()).
+    RuntimeError
+        If Nextclade fails on every batch. Batches that fail while others 
+        succeed are left out with a warning.
 
     """
-    input_checker(kwargs)
     try:
         # Creating secure temporary directory to store Nextclade analysis output file
         secure_analysis_dir = tempfile.mkdtemp(prefix="secure_analysis_dir")
+        plan = plan_runs(kwargs, secure_analysis_dir)
+
+        # Getting Nextclade analysis output per FASTA batch, running batches concurrently
+        outputs = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=plan['processes']) as executor:
+            futures = {executor.submit(run_batch, batch, **batch_arguments(plan, batch)): batch 
+                       for batch in plan['batches']}
+            for future in as_completed(futures):
+                try:
+                    outputs[futures[future]] = future.result()
+                except RuntimeError as e:
+                    failures[futures[future]] = e
+        nextclade_output, annotation = collect_runs(plan, outputs, failures)
+
+    # Remove created directory
+    finally:
+        if os.path.exists(secure_analysis_dir):
+            shutil.rmtree(secure_analysis_dir)
+    return nextclade_output, annotation
+
+
+def plan_runs(kwargs, secure_analysis_dir):
+    """Prepares the Nextclade runs of the FASTA batches (see nextclade()).
+
+    Gets the Nextclade dataset, keeps only the distinct sequences if collapsed
+    and only those without stored results if incremental, and splits a single 
+    FASTA file into shards.
+
+    Parameters
+    ----------
+    kwargs : dict
+        The arguments to nextclade(). Options other than the user input are popped.
+    secure_analysis_dir : str
+        The temporary directory of the runs.
+
+    Returns
+    -------
+    dict
+        The runs ('batches') and the options for running them and collecting their output.
+
+    """
+    # Getting options for reading the analysis output and for running the batches
+    plan = {'read_options': {'columns': kwargs.pop('columns', None), 'engine': kwargs.pop('read_engine', None)},
+            'chunksize': kwargs.pop('chunksize', None),
+            'qc': kwargs.pop('qc', {'errors': True, 'warnings': True}),
+            'retries': kwargs.pop('retries', 1),
+            'incremental': kwargs.pop('incremental', False),
+            'collapse': kwargs.pop('collapse', False),
+            'secure_analysis_dir': secure_analysis_dir}
+    processes = kwargs.pop('processes', None)
+    cpus = kwargs.pop('cpus', None)
+    shards = kwargs.pop('shards', None)
+    dataset_options = {'tag': kwargs.pop('tag', None), 'cache_dir': kwargs.pop('cache_dir', None),
+                       'refresh': kwargs.pop('refresh', False)}
+    input_checker(kwargs)
+    plan['input'] = kwargs
+
+    if os.path.isdir(kwargs["seq"]): # Case 1: A directory of FASTA files is provided
+        files = sorted(os.listdir(kwargs["seq"]))
+        inputs = [os.path.join(kwargs["seq"], file) for file in files if strip_compression(file)[0].endswith(('.fasta', '.fa'))]
+        if len(inputs) == 0:
+            raise ValueError("Directory contains no FASTA file. Ensure FASTA has extension '.fasta' or '.fa' (optionally compressed, e.g. '.fasta.gz').")
+    else: # Case 2: One FASTA file provided
+        inputs = [kwargs["seq"]]
+    plan['inputs'] = inputs
+
+    # Getting the Nextclade dataset from the cache, downloading it once for all batches and runs
+    ref_dir = None
+    if not os.path.isfile(kwargs["ref"]):
+        check_reference(kwargs["ref"], **dataset_options)
+        ref_dir = get_dataset(kwargs["ref"], **dataset_options)
+    ref_path, plan['gene_path'] = dataset_paths(kwargs, ref_dir=ref_dir)
+    plan['ref_dir'] = ref_dir
+
+    # Keeping only the distinct sequences (without stored results), each written once and named by its hash
+    batches = inputs
+    plan['run_qc'] = plan['qc']
+    plan['run_chunksize'] = plan['chunksize']
+    plan['collapse'] = plan['collapse'] or plan['incremental']
+    if plan['collapse']:
+        known = set()
+        if plan['incremental']:
+            plan['version_dir'] = _sequence_cache.store_dir(_sequence_cache.dataset_version(ref_path, plan['gene_path']),
+                                                            cache_dir=dataset_options['cache_dir'])
+            known = _sequence_cache.stored_hashes(plan['version_dir'])
+        plan['sequences'] = {}
+        plan['runs'] = {}
+        for i, file in enumerate(inputs):
+            # Keeping the batch name of the input FASTA file, in a directory of its own
+            new_path = os.path.join(secure_analysis_dir, 'new', str(i), f'{batch_name(file)}.fasta')
+            os.makedirs(os.path.dirname(new_path))
+            plan['sequences'][file], written = _sequence_cache.write_new_sequences(file, known, new_path)
+            if written:
+                plan['runs'][new_path] = file
+        batches = list(plan['runs'])
+        # Results are QC-filtered after expanding, as stored results are not QC-filtered
+        if plan['incremental']:
+            plan['read_options']['columns'] = ['seqName'] + _sequence_cache.SEQUENCE_COLUMNS
+        elif plan['read_options']['columns'] is not None and 'seqName' not in plan['read_options']['columns']:
+            plan['read_options']['columns'] = plan['read_options']['columns'] + ['seqName']
+        plan['run_qc'] = None
+        plan['run_chunksize'] = None
 
-        # Creating secure temporary directory to store Nextclade 
-        # reference and genome annotation if Nextclade reference name is provided
-        secure_ref_dir = tempfile.mkdtemp(prefix="secure_ref_dir")
-
-        if os.path.isdir(kwargs["seq"]): # Case 1: A directory of FASTA files is provided
-            files = os.listdir(kwargs["seq"])
-            batches = [file for file in files if file.endswith(('.fasta', '.fa'))]
-            if len(batches) == 0:
-                raise ValueError("Directory contains no FASTA file. Ensure FASTA has extension '.fasta' or '.fa'.")
-
-            # Getting Nextclade analysis output per FASTA batch and concatenating 
-            # the dataframes
-            seq_dir = kwargs["seq"]
-            outputs = []
-            kwargs_mod = kwargs
-            for batch in batches:
-                # Getting Nexctlade output
-                kwargs_mod["seq"] = os.path.join(seq_dir,batch)
-                nextclade_command, gene_path = create_command(input = kwargs_mod, secure_analysis_dir = secure_analysis_dir, secure_ref_dir = secure_ref_dir) 
-                out = capture_output(nextclade_command)
-
-                # Appending output
-                batch_name = os.path.splitext(batch)[0]
-                out.insert(0, 'batch', batch_name)
-                outputs.append(out)
-            nextclade_output = pd.concat(outputs, ignore_index=True)   
-        else: # Case 2: One FASTA file provided
-            nextclade_command, gene_path = create_command(input = kwargs, secure_analysis_dir = secure_analysis_dir, secure_ref_dir = secure_ref_dir) 
-            nextclade_output = capture_output(nextclade_command)
-
-            # Add batch name
-            batch_name = os.path.basename(kwargs['seq'])
-            batch_name = os.path.splitext(batch_name)[0]
-            nextclade_output.insert(0, 'batch', batch_name)
+    # Splitting a single FASTA file into shards
+    if not os.path.isdir(kwargs["seq"]) and len(batches) == 1:
+        if shards is None:
+            shards = min(cpus or os.cpu_count() or 1, 
+                         math.ceil(os.path.getsize(batches[0]) / SHARD_SIZE))
+        if shards > 1 and strip_compression(batches[0])[1] is None: # Compressed files are not split
+            batches = write_fasta_shards(batches[0], shards, secure_analysis_dir)
+    plan['batches'] = batches
+    plan['sharded'] = len(batches) > 1 and not os.path.isdir(kwargs["seq"])
+    plan['processes'], plan['jobs'] = cpu_budget(len(batches), processes=processes, cpus=cpus)
+    return plan
+
+
+def batch_arguments(plan, batch):
+    """Gets the arguments to run_batch() of a batch of the planned runs (see plan_runs())."""
+    # Shards and collapsed batches write their analysis output next to their own FASTA file, 
+    # as they may share the FASTA file name (e.g. collapsed 'a.fasta' and 'a.fasta.gz')
+    own_dir = plan['sharded'] or plan['collapse']
+    return {'nextclade_input': plan['input'], 'read_options': plan['read_options'], 'qc': plan['run_qc'],
+            'retries': plan['retries'], 'chunksize': plan['run_chunksize'], 
+            'secure_analysis_dir': os.path.dirname(batch) if own_dir else plan['secure_analysis_dir'],
+            'ref_dir': plan['ref_dir'], 'jobs': plan['jobs']}
+
+
+def collect_runs(plan, outputs, failures):
+    """Combines the output of the planned runs (see plan_runs()).
+
+    Parameters
+    ----------
+    plan : dict
+        The planned runs.
+    outputs : dict
+        The output of each successful run (see run_batch()).
+    failures : dict
+        The error of each failed run.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis output or the mutation counts (see nextclade()).
+    pandas.DataFrame
+        The genome annotation.
+
+    Raises
+    ------
+    ValueError
+        If Nextclade analysis dataframe is empty.
+    RuntimeError
+        If Nextclade fails on a shard or on every batch.
+
+    """
+    if failures and plan['sharded']: # A batch with missing shards is incomplete
+        raise RuntimeError(f"Nextclade failed on a shard of {os.path.basename(plan['input']['seq'])}: {next(iter(failures.values()))}")
+
+    batches = plan['batches']
+    if plan['collapse']:
+        # Storing the new results, then expanding the (stored) results to the sequences of each input
+        results = pd.DataFrame(columns=['seqHash'])
+        if outputs:
+            results = pd.concat(outputs.values(), ignore_index=True).drop(columns='batch')
+            results = results.rename(columns={'seqName': 'seqHash'})
+        if plan['incremental']:
+            _sequence_cache.store_results(plan['version_dir'], results)
+            hashes = pd.concat([plan['sequences'][file]['seqHash'] for file in plan['inputs']])
+            results = _sequence_cache.load_results(plan['version_dir'], hashes)
+        failures = {plan['runs'][batch]: error for batch, error in failures.items()}
+        batches = plan['inputs']
+        outputs = {}
+        for file in batches:
+            if file in failures:
+                continue
+            missing = ~plan['sequences'][file]['seqHash'].isin(results['seqHash'])
+            if missing.any() and failures: # Sequences collapsed into a failed batch
+                failures[file] = RuntimeError(f"{missing.sum()} sequence(s) are identical to sequences of a failed batch.")
+                continue
+            expanded = qc_filter(_sequence_cache.expand_results(plan['sequences'][file], results, file), plan['qc'])
+            if plan['chunksize'] is not None:
+                expanded = count_nextclade([expanded], allow_empty=True)
+            outputs[file] = expanded
+
+    if failures:
+        failed = '\n'.join(f"{os.path.basename(batch)}: {error}" for batch, error in failures.items())
+        if not outputs:
+            raise RuntimeError(f"Nextclade failed on all batches:\n{failed}")
+        warnings.warn(f"Nextclade failed on {len(failures)} batch(es), which are left out:\n{failed}")
+    if plan['chunksize'] is not None: # Summing the counts of the batches, which also merges the shards
+        nextclade_output = count_mutations([outputs[batch] for batch in batches if batch in outputs], 
+                                           allow_empty=True)
+    else:
+        nextclade_output = pd.concat([outputs[batch] for batch in batches if batch in outputs], ignore_index=True)
 
         # Sorting by batch name and seq name:
         nextclade_output.sort_values(by=['batch', 'seqName'], inplace=True)
         nextclade_output.reset_index(drop=True, inplace=True)
 
-        # Getting annotation
-        gff_columns = ["seqname", "source", "feature", "start", "end", "score",
-                       "strand", "frame", "attribute"]
-        annotation = pd.read_csv(gene_path, sep="\t", comment="#", 
-                                 header=None, names=gff_columns)
-
-    # Remove created directories
-    finally:
-        if os.path.exists(secure_analysis_dir):
-            shutil.rmtree(secure_analysis_dir)
-        if os.path.exists(secure_ref_dir):
-            shutil.rmtree(secure_ref_dir)
+    # Getting annotation
+    gff_columns = ["seqname", "source", "feature", "start", "end", "score",
+                   "strand", "frame", "attribute"]
+    annotation = pd.read_csv(plan['gene_path'], sep="\t", comment="#", 
+                             header=None, names=gff_columns)
 
-    # Removing sequences with warnings or errors
-    nextclade_output.drop(nextclade_output.dropna(subset=['warnings']).index)
-    nextclade_output.drop(nextclade_output.dropna(subset=['errors']).index)
     if nextclade_output.empty:
         raise ValueError("Nextclade analysis DataFrame is empty.")
-    return nextclade_output, annotation
\ No newline at end of file
+    return nextclade_output, annotation
@@ -0,0 +1,147 @@
+"""Module for running Nextclade with asyncio subprocesses."""
+
+from ._nextclade import plan_runs, batch_arguments, batch_command, collect_runs
+from ._nextclade_cli import capture_output_async, stream_output_async
+from ._nextclade_utils import batch_name, qc_filter, count_nextclade, count_mutations
+from contextlib import aclosing
+import asyncio
+import inspect
+import os
+import shutil
+import tempfile
+
+
+async def count_stream_async(nextclade_chunks, batch='my_batch', qc=None):
+    """Counts the mutations over an asynchronous stream of Nextclade output chunks (see count_nextclade()).
+
+    Each chunk is counted in a worker thread and added to the running counts.
+
+    """
+    counts = None
+    async with aclosing(nextclade_chunks) as chunks:
+        async for chunk in chunks:
+            chunk_counts = await asyncio.to_thread(count_nextclade, [chunk], batch=batch, allow_empty=True, qc=qc)
+            counts = chunk_counts if counts is None else count_mutations([counts, chunk_counts], allow_empty=True)
+    if counts is None:
+        return count_mutations([], allow_empty=True)
+    return counts
+
+
+async def run_batch_async(seq, nextclade_input, read_options, qc, retries=1, chunksize=None, **command_kwargs):
+    """Runs Nextclade on one FASTA batch as an asyncio subprocess, retrying if Nextclade fails (see _nextclade.run_batch()).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis output of the sequences that pass the QC criteria, with a batch column.
+        If a chunk size is provided, the mutation counts of the batch.
+
+    Raises
+    ------
+    RuntimeError
+        If Nextclade fails on every attempt.
+
+    """
+    nextclade_command = batch_command(seq, nextclade_input, read_options, chunksize=chunksize, **command_kwargs)
+    for attempt in range(retries + 1):
+        try:
+            if chunksize is not None: # Counts of a failed attempt are discarded
+                return await count_stream_async(stream_output_async(nextclade_command, chunksize=chunksize),
+                                                batch=batch_name(seq), qc=qc)
+            output = await capture_output_async(nextclade_command, **read_options)
+            break
+        except RuntimeError:
+            if attempt == retries:
+                raise
+    output = qc_filter(output, qc)
+    output.insert(0, 'batch', batch_name(seq))
+    return output
+
+
+async def run_batches_async(plan):
+    """Runs the planned Nextclade runs concurrently (see _nextclade.plan_runs()), yielding each as it completes.
+
+    At most as many runs as planned processes run at the same time.
+    Runs still in progress are cancelled, killing their subprocesses,
+    if the generator is closed or the awaiting task is cancelled.
+
+    Parameters
+    ----------
+    plan : dict
+        The planned runs.
+
+    Yields
+    ------
+    str
+        The FASTA file path of the run.
+    pandas.DataFrame or None
+        The output of the run (see run_batch_async()), or None if it failed.
+    RuntimeError or None
+        The error of the run if it failed.
+
+    """
+    semaphore = asyncio.Semaphore(plan['processes'])
+    async def run(batch):
+        async with semaphore:
+            try:
+                return batch, await run_batch_async(batch, **batch_arguments(plan, batch)), None
+            except RuntimeError as e:
+                return batch, None, e
+
+    tasks = [asyncio.create_task(run(batch)) for batch in plan['batches']]
+    try:
+        for next_completed in asyncio.as_completed(tasks):
+            yield await next_completed
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def nextclade_async(on_batch=None, **kwargs):
+    """Awaitable counterpart of _nextclade.nextclade() running Nextclade with asyncio subprocesses.
+
+    Preparing the runs and combining their output are done in worker threads,
+    so that the event loop stays free while Nextclade is running.
+
+    Parameters
+    ----------
+    on_batch : callable
+        Called with the batch name and the output of each Nextclade run as it completes
+        (see run_batch_async()). Coroutine functions are awaited. Each shard of a sharded
+        FASTA file is a run, and incremental runs only hold the new sequences.
+    **kwargs
+        The arguments to _nextclade.nextclade().
+
+    Returns
+    -------
+    pandas.DataFrame
+        The analysis output or the mutation counts (see _nextclade.nextclade()).
+    pandas.DataFrame
+        The genome annotation.
+
+    Raises
+    ------
+    asyncio.CancelledError
+        If the awaiting task is cancelled. Running Nextclade subprocesses are killed.
+
+    """
+    secure_analysis_dir = tempfile.mkdtemp(prefix="secure_analysis_dir")
+    try:
+        plan = await asyncio.to_thread(plan_runs, kwargs, secure_analysis_dir)
+        outputs = {}
+        failures = {}
+        async with aclosing(run_batches_async(plan)) as runs:
+            async for batch, output, error in runs:
+                if error is not None:
+                    failures[batch] = error
+                    continue
+                outputs[batch] = output
+                if on_batch is not None:
+                    called = on_batch(batch_name(batch), output)
+                    if inspect.isawaitable(called):
+                        await called
+        return await asyncio.to_thread(collect_runs, plan, outputs, failures)
+    finally:
+        if os.path.exists(secure_analysis_dir):
+            shutil.rmtree(secure_analysis_dir)
@@ -1,8 +1,64 @@
 """Module that creates Nextclade command and captures Nextclade output."""
 
+import asyncio
+import io
 import subprocess
 import os
+import tempfile
 import pandas as pd
+from ._nextclade_utils import present_columns
+
+# Maximum length in bytes of an analysis row read from an asyncio pipe
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+def dataset_command(ref, ref_dir, tag=None):
+    """Creates the command that downloads a Nextclade dataset.
+
+    Parameters
+    ----------
+    ref : str
+        Name of the Nextclade dataset.
+    ref_dir : str
+        Directory to store the reference sequence and genome annotation.
+    tag : str
+        Version tag of the dataset. The latest version is downloaded if not provided.
+
+    Returns
+    -------
+    list
+        A list whose elements constitute the Nextclade command.
+
+    """
+    command = ["nextclade", "dataset", "get", "-n", ref, "-o", ref_dir]
+    if tag is not None:
+        command = command + ["--tag", tag]
+    return command
+
+
+def dataset_paths(input, ref_dir=None):
+    """Gets the file paths of the reference sequence and the genome annotation.
+
+    Parameters
+    ----------
+    input : dict
+        Dictionary containing the user input to nextclade().
+    ref_dir : str
+        Directory of the downloaded Nextclade dataset (see _datasets.get_dataset())
+        if a dataset name is provided.
+
+    Returns
+    -------
+    str
+        File path of the reference sequence.
+    str
+        File path of the genome annotation.
+
+    """
+    if os.path.isfile(input["ref"]): # Reference FASTA is provided
+        return input["ref"], input["gene"]
+    # Name of Nextclade reference is provided
+    return os.path.join(ref_dir, 'reference.fasta'), os.path.join(ref_dir, 'genome_annotation.gff3')
 
 
 def create_command(**kwargs):
@@ -14,76 +70,275 @@ def create_command(**kwargs):
         Dictionary containing the user input to nextclade().
     secure_analysis_dir : str
         Secure temporary directory to store Nexclade analysis TSV output.
-    secure_ref_dir : str
-        Secure temporary directory to store reference sequence from Nextclade.
+    ref_dir : str
+        Directory of the downloaded Nextclade dataset (see _datasets.get_dataset()) 
+        if a dataset name is provided.
+    jobs : int
+        Number of threads used by Nextclade. Nextclade uses all CPUs if not provided.
+    pipe : bool, default:False
+        Determines whether Nextclade writes the analysis TSV output to stdout instead of a file.
+    columns : list
+        Analysis columns that Nextclade writes. All columns are written if not provided.
 
     Returns
     -------
     list
         A list whose elements constitute the Nextclade command.
+    str
+        File path of the genome annotation.
 
     """
 
     # Getting user input
     input = kwargs["input"]
     seq = input["seq"]
-    ref = input["ref"]   
 
     # Getting nextread-created directories
     secure_analysis_dir = kwargs["secure_analysis_dir"]
-    secure_ref_dir = kwargs["secure_ref_dir"]
 
     # Creating command based on user input
-    if os.path.isfile(ref): # Reference FASTA is provided
-        nextclade_command = f"nextclade run -r {ref} -t {os.path.join(secure_analysis_dir, 'analysis.tsv')}".split()
-        if "gene" in input: # Gene annotation is provided
-            gene = input["gene"]
-            nextclade_command = nextclade_command + ["-m", gene]
-        nextclade_command = nextclade_command + [seq]
-        gene_path = gene
-    else: # Name of Nextclade reference is provided
-        secure_ref_dir = kwargs["secure_analysis_dir"]
-        # Get dataset first and then run the command
-        gene_path = os.path.join(secure_ref_dir, 'genome_annotation.gff3')
-        first_command = f"nextclade dataset get -n {ref} -o {secure_ref_dir}".split()
-        second_command = f"nextclade run -r {os.path.join(secure_ref_dir, 'reference.fasta')} -m {gene_path} -t {os.path.join(secure_analysis_dir, 'analysis.tsv')} {seq}".split()
-        nextclade_command = [first_command, second_command]
+    ref_path, gene_path = dataset_paths(input, ref_dir=kwargs.get("ref_dir"))
+
+    # Naming the output after the FASTA file so that batches can run at the same time
+    analysis_path = os.path.join(secure_analysis_dir, f"{os.path.basename(seq)}.tsv")
+    if kwargs.get("pipe", False):
+        analysis_path = "-" # Standard output
+    nextclade_command = ["nextclade", "run", "-r", ref_path, "-m", gene_path, "-t", analysis_path]
+    if kwargs.get("jobs") is not None:
+        nextclade_command = nextclade_command + ["--jobs", str(kwargs["jobs"])]
+    if kwargs.get("columns") is not None:
+        # VARGRAM adds the batch column itself
+        selection = ",".join(col for col in kwargs["columns"] if col != "batch")
+        nextclade_command = nextclade_command + ["--output-columns-selection", selection]
+    nextclade_command = nextclade_command + [seq]
     return nextclade_command, gene_path
 
 
-def capture_output(command):
+def run_command(command):
+    """Runs a Nextclade CLI command.
+
+    Parameters
+    ----------
+    command : list
+        The Nextclade CLI command.
+
+    Returns
+    -------
+    str
+        The standard output of the command.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails.
+
+    """
+    try:
+        return subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    except FileNotFoundError:
+        raise FileNotFoundError("Nextclade executable not found. Make sure it is included in the system $PATH.")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Error running Nextclade (exit code {e.returncode}): {e.stderr.strip()}")
+
+
+def capture_output(command, columns=None, engine=None):
     """Runs Nextclade CLI and captures the output.
 
     Parameters
     ----------
-    command : str
+    command : list
         The Nextclade CLI command.
+    columns : list
+        Analysis columns to read. All columns are read if not provided.
+    engine : str
+        The pandas.read_csv engine (e.g. 'pyarrow' for multithreaded parsing).
 
     Returns
     -------
     pandas.DataFrame
         A DataFrame of the Nextclade analysis TSV output.
 
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails or does not write the analysis output.
+
+    """
+    run_command(command)
+    return read_output(command, columns=columns, engine=engine)
+
+
+def read_output(command, columns=None, engine=None):
+    """Reads the analysis TSV output written by a Nextclade CLI command (see capture_output())."""
+    analysis_file_path = command[command.index("-t") + 1]
+    if not os.path.isfile(analysis_file_path):
+        raise RuntimeError(f"Nextclade did not write the analysis output {analysis_file_path}.")
+
+    # Reading Nextclade analysis TSV output
+    usecols = None
+    if columns is not None:
+        usecols = present_columns(analysis_file_path, '\t', columns)
+    analysis_dataframe = pd.read_csv(analysis_file_path, delimiter='\t', usecols=usecols, engine=engine)
+    # Removing index column
+    analysis_dataframe.drop('index', axis=1, inplace=True, errors='ignore')
+    return analysis_dataframe
+
+
+def stream_output(command, chunksize=10000):
+    """Runs Nextclade CLI, reading the analysis TSV output from a pipe while Nextclade is running.
+
+    Parameters
+    ----------
+    command : list
+        The Nextclade CLI command writing the analysis TSV output to stdout (see create_command()).
+    chunksize : int, default:10000
+        Number of analysis rows per yielded DataFrame.
+
+    Yields
+    ------
+    pandas.DataFrame
+        Chunks of the Nextclade analysis TSV output.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails. Chunks read before the failure have already been yielded.
+
+    """
+    # Nextclade logs to stderr, which is kept in a file so that the pipe never blocks on it
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        except FileNotFoundError:
+            raise FileNotFoundError("Nextclade executable not found. Make sure it is included in the system $PATH.")
+        try:
+            for chunk in pd.read_csv(process.stdout, delimiter='\t', chunksize=chunksize):
+                yield chunk.drop('index', axis=1, errors='ignore')
+        except pd.errors.EmptyDataError: # Nextclade wrote nothing, e.g. it failed on start
+            pass
+        finally:
+            process.stdout.close()
+            if process.poll() is None: # Reading stopped early, e.g. the generator was closed
+                process.kill()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors='replace').strip()
+            raise RuntimeError(f"Error running Nextclade (exit code {returncode}): {stderr}")
+
+
+async def run_command_async(command, stdout=asyncio.subprocess.PIPE):
+    """Runs a Nextclade CLI command as an asyncio subprocess.
+
+    The subprocess is killed if the awaiting task is cancelled.
+
+    Parameters
+    ----------
+    command : list
+        The Nextclade CLI command.
+    stdout : int, default:asyncio.subprocess.PIPE
+        Where the standard output is written.
+
+    Returns
+    -------
+    str
+        The standard output of the command.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails.
+
     """
     try:
-        if len(command) != 2: # Reference FASTA is provided
-            subprocess.run(command, check=True)
-            analysis_arg_ind = command.index("-t") + 1
-            analysis_file_path = command[analysis_arg_ind]
-        else: # Name of Nextclade reference is provided
-            analysis_arg_ind = command[1].index("-t") + 1
-            analysis_file_path = command[1][analysis_arg_ind]
-            for line in command:
-                subprocess.run(line, check=True)
-
-        # Reading Nextclade analysis TSV output
-        analysis_dataframe = pd.read_csv(analysis_file_path, delimiter='\t')
-        # Removing index column
-        analysis_dataframe.drop('index', axis=1, inplace=True)
-        return analysis_dataframe
-    except subprocess.CalledProcessError as e:
-        print(f"Error running Nextclade: {e}")
+        process = await asyncio.create_subprocess_exec(*command, stdout=stdout, stderr=asyncio.subprocess.PIPE)
     except FileNotFoundError:
-        print("Nextclade executable not found. Make sure it is included in the system $PATH.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
\ No newline at end of file
+        raise FileNotFoundError("Nextclade executable not found. Make sure it is included in the system $PATH.")
+    try:
+        output, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"Error running Nextclade (exit code {process.returncode}): {stderr.decode(errors='replace').strip()}")
+    return output.decode(errors='replace') if output is not None else ''
+
+
+async def capture_output_async(command, columns=None, engine=None):
+    """Runs Nextclade CLI as an asyncio subprocess and captures the output (see capture_output()).
+
+    The analysis output is read in a worker thread, so that the event loop is not blocked.
+
+    """
+    await run_command_async(command, stdout=asyncio.subprocess.DEVNULL)
+    return await asyncio.to_thread(read_output, command, columns=columns, engine=engine)
+
+
+async def stream_output_async(command, chunksize=10000):
+    """Runs Nextclade CLI as an asyncio subprocess, reading the analysis TSV output from a pipe (see stream_output()).
+
+    Chunks are parsed in a worker thread, so that the event loop is not blocked. 
+    The subprocess is killed if reading stops early or the awaiting task is cancelled.
+
+    Parameters
+    ----------
+    command : list
+        The Nextclade CLI command writing the analysis TSV output to stdout (see create_command()).
+    chunksize : int, default:10000
+        Number of analysis rows per yielded DataFrame.
+
+    Yields
+    ------
+    pandas.DataFrame
+        Chunks of the Nextclade analysis TSV output.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+    RuntimeError
+        If Nextclade fails. Chunks read before the failure have already been yielded.
+
+    """
+    # Nextclade logs to stderr, which is kept in a file so that the pipe never blocks on it
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            # Analysis rows with many mutations may be longer than the default line limit
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=stderr_file,
+                                                           limit=LINE_LIMIT)
+        except FileNotFoundError:
+            raise FileNotFoundError("Nextclade executable not found. Make sure it is included in the system $PATH.")
+
+        def parse(header, lines):
+            chunk = pd.read_csv(io.BytesIO(header + b''.join(lines)), delimiter='\t')
+            return chunk.drop('index', axis=1, errors='ignore')
+
+        try:
+            header = await process.stdout.readline()
+            lines = []
+            async for line in process.stdout:
+                lines.append(line)
+                if len(lines) == chunksize:
+                    yield await asyncio.to_thread(parse, header, lines)
+                    lines = []
+            if lines:
+                yield await asyncio.to_thread(parse, header, lines)
+        finally:
+            if process.returncode is None and process.stdout.at_eof() is False:
+                process.kill()
+            returncode = await process.wait()
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors='replace').strip()
+            raise RuntimeError(f"Error running Nextclade (exit code {returncode}): {stderr}")
+
@@ -1,8 +1,85 @@
 """Module to perform auxiliary tasks for nextclade function."""
 
 import re
-import subprocess
+import json
 import os
+import glob
+import io
+import gzip
+import bz2
+import lzma
+import pandas as pd
+import numpy as np
+
+# Extensions of compressed files that are decompressed on the fly
+COMPRESSION_EXTENSIONS = ['gz', 'bz2', 'xz', 'zst']
+
+# Types of amino acid mutations
+MUTATION_TYPES = ['sub', 'del', 'in']
+
+# Nextclade analysis columns used by VARGRAM
+NEXTCLADE_COLUMNS = ['batch', 'seqName', 'aaSubstitutions', 'aaDeletions', 'aaInsertions', 'warnings', 'errors']
+
+
+def strip_compression(file_path):
+    """Removes the compression extension of a file path.
+
+    Parameters
+    ----------
+    file_path : str
+        File path, possibly ending with a compression extension (e.g. '.gz').
+
+    Returns
+    -------
+    root : str
+        File path without the compression extension.
+    compression : str or None
+        The compression extension or None if the file is not compressed.
+
+    """
+    root, ext = os.path.splitext(file_path)
+    compression = ext.lower().lstrip('.')
+    if compression in COMPRESSION_EXTENSIONS:
+        return root, compression
+    return file_path, None
+
+
+def open_text(file_path):
+    """Opens a plain or compressed text file for reading as a stream.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the text file.
+
+    Returns
+    -------
+    file object
+        Text stream of the decompressed contents.
+
+    Raises
+    ------
+    ImportError
+        If a Zstandard-compressed file is given but zstandard is not installed.
+
+    """
+    _, compression = strip_compression(file_path)
+    match compression:
+        case 'gz':
+            return gzip.open(file_path, 'rt')
+        case 'bz2':
+            return bz2.open(file_path, 'rt')
+        case 'xz':
+            return lzma.open(file_path, 'rt')
+        case 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("Reading .zst files requires zstandard. Install with 'pip install vargram[zstd]'.")
+            binary_stream = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+            return io.TextIOWrapper(binary_stream)
+        case _:
+            return open(file_path)
 
 
 def check_file_extension(file_path, valid_extensions):
@@ -11,7 +88,7 @@ def check_file_extension(file_path, valid_extensions):
     Parameters
     ----------
     file_path : str
-        File path to be checked.
+        File path to be checked. Compression extensions (e.g. '.gz') are ignored.
     valid_extensions : list
         List of valid extensions to be checked against.
 
@@ -23,48 +100,73 @@ def check_file_extension(file_path, valid_extensions):
         Truth value of validity of the file extension.
 
     """
-    file_extension = file_path.lower().split('.')[-1]
+    file_extension = strip_compression(file_path)[0].lower().split('.')[-1]
     if file_extension in valid_extensions:
         return file_extension, True
     else:
         return file_extension, False
 
 
-def check_reference(ref):
-    """Checks whether provided reference name is in Nextclade.
-    
+def batch_name(file_path):
+    """Gets the batch name of a file, i.e. its name without (compression) extensions."""
+    file_name = os.path.basename(strip_compression(file_path)[0])
+    return os.path.splitext(file_name)[0]
+
+
+def delimited_files(data):
+    """Gets the delimited Nextclade output files from a directory, a glob pattern or a list.
+
     Parameters
     ----------
-    ref : str 
-        The dataset name.
+    data : str, list or pandas.DataFrame
+        The user-provided data.
 
     Returns
     -------
-    None
+    list or None
+        Sorted list of file paths. None if data is a single file or a DataFrame.
 
     Raises
     ------
     ValueError
-        If Nextclade reference dataset name is not recognized.
+        If no CSV or TSV file is found.
 
     """
-    dataset_names_only = subprocess.check_output(['nextclade', 'dataset', 'list', '--only-names']).decode(encoding='utf-8').split()  
-    dataset_list_full = subprocess.check_output(['nextclade', 'dataset', 'list']).decode(encoding='utf-8')
-    shortcut_parentheses = r'\(shortcuts:(.*?)\)' # getting all shortcuts enclosed in parentheses
-    shortcut_quotes = r'"(.*?)"' # getting the individual shortcuts enclosed in double quotes
-    dataset_shortcuts = re.findall(shortcut_parentheses, dataset_list_full)
-    dataset_shortcuts = ' '.join(dataset_shortcuts)
-    dataset_shortcuts = re.findall(shortcut_quotes, dataset_shortcuts)
+    if isinstance(data, (list, tuple)):
+        files = list(data)
+    elif isinstance(data, str) and os.path.isdir(data):
+        files = [os.path.join(data, file) for file in sorted(os.listdir(data)) 
+                 if os.path.splitext(strip_compression(file)[0])[1] in ['.csv', '.tsv']]
+    elif isinstance(data, str) and any(char in data for char in '*?['):
+        files = sorted(glob.glob(data))
+    else:
+        return None
+    
+    if len(files) == 0:
+        raise ValueError(f"No CSV or TSV file found in {data}.")
+    return files
+
+
+def present_columns(file_path, delimiter, columns):
+    """Gets the columns of a delimited file that are among the requested columns.
+    
+    Parameters
+    ----------
+    file_path : str
+        Path of the delimited file.
+    delimiter : str
+        Delimiter of the file.
+    columns : list
+        Requested column names.
+
+    Returns
+    -------
+    list
+        Requested column names present in the file header, in file order.
 
-    if ref not in dataset_names_only and ref not in dataset_shortcuts:
-        try:
-            name_not_recognized = ("Nextclade reference name not recognized. " 
-                                    "See valid names and shortcuts below.")
-            raise ValueError(name_not_recognized)
-        except ValueError as e:
-            dataset_list_command = ['nextclade', 'dataset', 'list']
-            subprocess.run(dataset_list_command, check=True)
-    return None
+    """
+    header = pd.read_csv(file_path, delimiter=delimiter, nrows=0).columns
+    return [col for col in header if col in columns]
 
 
 def input_checker(kwargs):
@@ -120,8 +222,7 @@ def input_checker(kwargs):
         if key == "seq" and not os.path.isfile(kwargs["seq"]):
             continue
         if key == "ref" and not os.path.isfile(kwargs["ref"]):
-            check_reference(kwargs["ref"]) # Check if provided reference name is recognized instead
-            continue
+            continue # Reference name is checked against the dataset catalogue (see _datasets.check_reference())
         file_extension, validity = check_file_extension(kwargs[key], valid_extensions[key])
         if not validity:
             raise ValueError(f"Unsupported {file_type[key]} file format: {file_extension}")
@@ -193,23 +294,218 @@ def get_mutation_type(mutation):
         return 'sub'
 
 
-def process_nextclade(nextclade_output):
-    """Gets the unique mutations and their individual counts.
+def qc_columns(qc):
+    """Gets the Nextclade analysis columns needed by the QC criteria.
+
+    Parameters
+    ----------
+    qc : dict or None
+        The QC criteria (see qc_filter()).
+
+    Returns
+    -------
+    list
+        Names of the needed Nextclade columns.
+
+    Raises
+    ------
+    TypeError
+        If an unexpected QC criterion is provided.
+
+    """
+    if not qc:
+        return []
+    qc_keys = {'status': 'qc.overallStatus', 'errors': 'errors', 
+               'warnings': 'warnings', 'coverage': 'coverage'}
+    unexpected_keys = set(qc.keys()) - set(qc_keys.keys())
+    if unexpected_keys:
+        raise TypeError(f"Unexpected QC criteria: {', '.join(unexpected_keys)}")
+    return [qc_keys[key] for key in qc.keys() if qc[key] is not None and qc[key] is not False]
+
+
+def qc_filter(nextclade_output, qc):
+    """Keeps only the sequences that pass the QC criteria.
 
     Parameters
     ----------
     nextclade_output : pandas.DataFrame
-        A subset (for multiple batches) of the DataFrame produced by nextclade().
+        A DataFrame of Nextclade analysis output.
+    qc : dict or None
+        The QC criteria. 'status' is the accepted qc.overallStatus value(s)
+        (e.g. ['good', 'mediocre']), 'errors' and 'warnings' determine whether
+        sequences with errors or warnings are removed, and 'coverage' is the
+        minimum coverage. No filtering is done if qc is None or empty.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The sequences that pass the QC criteria.
+
+    Raises
+    ------
+    ValueError
+        If a Nextclade column needed by the QC criteria is missing.
+
+    """
+    needed_columns = qc_columns(qc)
+    if not needed_columns:
+        return nextclade_output
+    missing_columns = [col for col in needed_columns if col not in nextclade_output.columns]
+    if missing_columns:
+        raise ValueError(f"Nextclade column(s) needed for QC not found: {', '.join(missing_columns)}")
+
+    passed = pd.Series(True, index=nextclade_output.index)
+    for flag in ['errors', 'warnings']:
+        if qc.get(flag):
+            messages = nextclade_output[flag].fillna('').astype(str).str.strip()
+            passed &= messages == ''
+    if qc.get('status') is not None:
+        status = [qc['status']] if isinstance(qc['status'], str) else qc['status']
+        passed &= nextclade_output['qc.overallStatus'].isin(status)
+    if qc.get('coverage') is not None:
+        passed &= pd.to_numeric(nextclade_output['coverage'], errors='coerce') >= qc['coverage']
+    return nextclade_output[passed].copy()
+
+
+def passes_qc(record, qc):
+    """Checks whether a Nextclade JSON record passes the QC criteria (see qc_filter())."""
+    if not qc:
+        return True
+    qc_columns(qc)
+    if qc.get('errors') and record.get('errors'):
+        return False
+    if qc.get('warnings') and record.get('warnings'):
+        return False
+    if qc.get('status') is not None:
+        status = [qc['status']] if isinstance(qc['status'], str) else qc['status']
+        if (record.get('qc') or {}).get('overallStatus') not in status:
+            return False
+    if qc.get('coverage') is not None and (record.get('coverage') or 0) < qc['coverage']:
+        return False
+    return True
+
+
+def mutation_records(mutations, known=None):
+    """Parses gene-stripped mutations into integer positions and mutation types.
+
+    Each unique mutation is parsed only once. The position is the last number
+    in the mutation (e.g. 18 for L18F and 214 for the insertion 214:EPE) and 
+    the type follows get_mutation_type(). Mutations whose position and type
+    are already known (e.g. from structured NDJSON records) are not parsed.
+
+    Parameters
+    ----------
+    mutations : pandas.Series
+        The (categorical) gene-stripped mutations.
+    known : pandas.DataFrame
+        The known position and type columns, indexed by mutation (see known_records()).
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of int32 position and categorical type columns,
+        with the same index as the mutations.
+
+    Raises
+    ------
+    ValueError
+        If the position is not parsed.
+
+    """
+    labels = pd.Categorical(mutations)
+    unique_mutations = pd.Series(labels.categories, dtype=str)
+    unique_positions = np.zeros(len(unique_mutations), dtype=np.int32)
+    unique_types = np.zeros(len(unique_mutations), dtype=np.int8)
+    unknown = np.ones(len(unique_mutations), dtype=bool)
+    if known is not None:
+        known = known.reindex(unique_mutations)
+        unknown = known['position'].isna().to_numpy()
+        unique_positions[~unknown] = known['position'].to_numpy()[~unknown]
+        unique_types[~unknown] = pd.Categorical(known['type'], categories=MUTATION_TYPES).codes[~unknown]
+    if unknown.any():
+        parsed_mutations = unique_mutations[unknown]
+        positions = parsed_mutations.str.extract(r'(\d+)\D*$')[0]
+        if positions.isna().any():
+            raise ValueError(f"Failed to parse mutation for position: '{parsed_mutations[positions.isna()].iloc[0]}'.")
+        unique_positions[unknown] = positions.astype(np.int32).to_numpy()
+        unique_types[unknown] = np.select([parsed_mutations.str.contains('-', regex=False).to_numpy(),
+                                           parsed_mutations.str.contains(':', regex=False).to_numpy()], 
+                                          [MUTATION_TYPES.index('del'), MUTATION_TYPES.index('in')], 
+                                          MUTATION_TYPES.index('sub'))
+    records = pd.DataFrame({'position': unique_positions[labels.codes],
+                            'type': pd.Categorical.from_codes(unique_types[labels.codes], categories=MUTATION_TYPES)},
+                           index=mutations.index if isinstance(mutations, pd.Series) else None)
+    return records
+
+
+def known_records(mutation_data):
+    """Gets the position and type of each distinct mutation of DataFrames that already have them.
+
+    Parameters
+    ----------
+    mutation_data : list of pandas.DataFrame
+        DataFrames with mutation, position and type columns.
+
+    Returns
+    -------
+    pandas.DataFrame or None
+        The position and type columns, indexed by mutation (see mutation_records()).
+        None if no DataFrame is given.
+
+    """
+    if not mutation_data:
+        return None
+    records = pd.concat([data[['mutation', 'position', 'type']].astype({'mutation': str}) for data in mutation_data], 
+                        ignore_index=True)
+    return records.drop_duplicates(subset='mutation').set_index('mutation')
+
+
+def add_mutation_records(mutation_data, known=None):
+    """Adds the parsed position and type columns after the mutation column.
+
+    Parameters
+    ----------
+    mutation_data : pandas.DataFrame
+        A DataFrame with a mutation column.
+    known : pandas.DataFrame
+        The known position and type of mutations, which are not parsed (see mutation_records()).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The DataFrame with position and type columns.
+
+    """
+    records = mutation_records(mutation_data['mutation'], known=known)
+    pos_index = mutation_data.columns.get_loc('mutation') + 1
+    mutation_data.insert(pos_index, 'position', records['position'])
+    mutation_data.insert(pos_index + 1, 'type', records['type'])
+    return mutation_data
+
+
+def explode_mutations(nextclade_output, records=True, carry=None):
+    """Generates a row per amino acid mutation of each sequence.
+
+    Parameters
+    ----------
+    nextclade_output : pandas.DataFrame
+        A DataFrame of Nextclade analysis output with a batch column.
+    records : bool, default:True
+        Determines whether the parsed position and type columns are added.
+    carry : list
+        Per-sequence columns (e.g. joined metadata) repeated for each mutation of the sequence.
     
     Returns
     -------
     pandas.DataFrame
-        A DataFrame of unique mutations and their counts.
+        A DataFrame with categorical batch, gene and mutation columns 
+        (and position and type columns if records is True), followed by the carried columns.
+        May be empty if no sequence has a mutation.
     
     Raises
     ------
     ValueError
-        If created mutation column of analysis DataFrame is empty.
+        If a mutation has no gene prefix.
 
     """
     # Nextclade columns
@@ -217,32 +513,267 @@ def process_nextclade(nextclade_output):
     aa_del = 'aaDeletions'
     aa_ins = 'aaInsertions'
 
-    # Compiling all amino acid mutations (substitution, deletion, insertion) into a single column
-    single_column = nextclade_output.copy()
+    # Compiling all amino acid mutations (substitution, deletion, insertion) into a single
+    # comma-separated string per sequence, column-wise
+    aa_columns = [nextclade_output[col].fillna('').astype(str) for col in [aa_sub, aa_del, aa_ins]]
+    mutation_strings = aa_columns[0].str.cat(aa_columns[1:], sep=',')
+    carry = carry or []
+    single_column = pd.DataFrame({'batch': nextclade_output['batch'].to_numpy(),
+                                  'mutation': mutation_strings.to_numpy()})
+    for col in carry:
+        single_column[col] = nextclade_output[col].to_numpy()
+
+    # Generating a row per mutation
+    # Each row therefore may not be unique
+    single_column['mutation'] = single_column['mutation'].str.split(',')
+    exploded = single_column.explode('mutation', ignore_index=True)
+
+    # Remove empty strings (i.e. empty mutation columns or sequences with no mutation at all)
+    exploded = exploded[exploded['mutation'] != '']
+
+    # Creating gene column and removing gene prefix of mutations in one pass
+    gene_and_mutation = exploded['mutation'].str.extract(r'^([^:]+):(.*)$')
+    unparsed = gene_and_mutation[0].isna()
+    if unparsed.any():
+        raise ValueError(f"Failed to parse mutation for gene: '{exploded.loc[unparsed, 'mutation'].iloc[0]}'.")
+
+    # Rearranging, dictionary-encoding the highly repetitive columns
+    exploded_mutations = mutation_frame(exploded['batch'], gene_and_mutation[0], gene_and_mutation[1])
+    if records:
+        exploded_mutations = add_mutation_records(exploded_mutations)
+    for col in carry:
+        exploded_mutations[col] = exploded[col].to_numpy()
+    return exploded_mutations
+
+
+def process_nextclade(nextclade_output, carry=None):
+    """Gets the unique mutations and their individual counts.
+
+    Parameters
+    ----------
+    nextclade_output : pandas.DataFrame
+        A subset (for multiple batches) of the DataFrame produced by nextclade().
+    carry : list
+        Per-sequence columns kept for each mutation (see explode_mutations()).
     
-    # Turn all NA mutations into empty strings
-    single_column[aa_sub] = single_column[aa_sub].fillna('')
-    single_column[aa_del] = single_column[aa_del].fillna('')
-    single_column[aa_ins] = single_column[aa_ins].fillna('')
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of unique mutations and their counts.
+    
+    Raises
+    ------
+    ValueError
+        If created mutation column of analysis DataFrame is empty.
+
+    """
+    processed_nextclade = explode_mutations(nextclade_output, carry=carry)
+    if processed_nextclade.empty:
+        raise ValueError("Processed Nextclade analysis DataFrame is empty. Potentially sequences do not have any mutation.")
+    return processed_nextclade
 
-    # Per row, join the mutations into one (comma-separated) string in one column
-    single_column['mutation'] = single_column.apply(lambda row: ','.join(filter(None, [row[aa_sub], row[aa_del], row[aa_ins]])), axis=1)
+
+def count_mutations(mutation_chunks, allow_empty=False):
+    """Counts the mutations per batch and gene over chunks of exploded mutations.
+
+    Only the running counts are kept in memory, 
+    so that memory depends on the number of distinct mutations
+    and not on the number of sequences.
+
+    Parameters
+    ----------
+    mutation_chunks : iterable of pandas.DataFrame
+        Chunks of batch, gene and mutation rows (e.g. from explode_mutations()).
+        Chunks with a count column (e.g. partial counts) are summed instead.
+        The position and type columns of chunks that have them are kept instead of parsed again.
+    allow_empty : bool, default:False
+        Determines whether an empty DataFrame is returned when there are no mutations.
+    
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns, 
+        the parsed position and type columns and an unsigned integer count column.
     
-    # Remove rows with empty strings (i.e. sequence has no mutation at all)
-    single_column = single_column[single_column['mutation'] != '']
-    if single_column.empty:
+    Raises
+    ------
+    ValueError
+        If no mutation is found in any of the chunks and allow_empty is False.
+
+    """
+    index_columns = ['batch', 'gene', 'mutation']
+    counts = None
+    recorded = [] # Distinct mutations of chunks that already have positions and types
+    for chunk in mutation_chunks:
+        if 'position' in chunk.columns and 'type' in chunk.columns:
+            recorded.append(chunk[['mutation', 'position', 'type']].drop_duplicates(subset='mutation'))
+        if 'count' in chunk.columns:
+            chunk_counts = chunk.groupby(index_columns, sort=False, observed=True)['count'].sum()
+        else:
+            chunk_counts = chunk.groupby(index_columns, sort=False, observed=True).size()
+        if counts is None:
+            counts = chunk_counts
+        else:
+            counts = counts.add(chunk_counts, fill_value=0)
+
+    if counts is None or counts.empty:
+        if allow_empty:
+            return add_mutation_records(mutation_frame([], [], [])).assign(count=np.array([], dtype=np.uint8))
         raise ValueError("Processed Nextclade analysis DataFrame is empty. Potentially sequences do not have any mutation.")
+    # Using the smallest integer type that can hold the total count
+    count_dtype = np.min_scalar_type(int(counts.sum()))
+    counted_nextclade = counts.astype(count_dtype).rename('count').reset_index()
+    for col in index_columns:
+        counted_nextclade[col] = counted_nextclade[col].astype('category')
+    counted_nextclade.sort_values(by=index_columns, inplace=True)
+    counted_nextclade.reset_index(drop=True, inplace=True)
+    return add_mutation_records(counted_nextclade, known=known_records(recorded))
+
+
+def count_nextclade(nextclade_chunks, batch='my_batch', allow_empty=False, qc=None):
+    """Counts the mutations per batch and gene over chunks of Nextclade output.
+
+    Parameters
+    ----------
+    nextclade_chunks : iterable of pandas.DataFrame
+        Chunks of Nextclade analysis output.
+    batch : str, default:'my_batch'
+        Batch name of chunks without a batch column.
+    allow_empty : bool, default:False
+        Determines whether an empty DataFrame is returned when there are no mutations.
+    qc : dict
+        The QC criteria applied to each chunk before exploding (see qc_filter()).
     
-    # Generating a row per mutation
-    # Each row therefore may not be unique
-    single_column['mutation'] = single_column['mutation'].apply(lambda x: x.split(',')).copy()
-    exploded = single_column.explode('mutation')
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns, 
+        the parsed position and type columns and an unsigned integer count column.
+
+    """
+    def exploded_chunks():
+        for chunk in nextclade_chunks:
+            chunk = qc_filter(chunk, qc)
+            if 'batch' not in chunk.columns:
+                chunk.insert(0, 'batch', batch)
+            yield explode_mutations(chunk, records=False)
+    return count_mutations(exploded_chunks(), allow_empty=allow_empty)
+
+
+def mutation_frame(batches, genes, mutations):
+    """Creates a DataFrame of categorical batch, gene and mutation columns from lists."""
+    return pd.DataFrame({'batch': pd.Categorical(batches),
+                         'gene': pd.Categorical(genes),
+                         'mutation': pd.Categorical(mutations)})
+
+
+def count_prefixed_mutations(prefixed_counts):
+    """Splits counted gene-prefixed mutations (e.g. ORF1b:G662S) into gene and mutation.
 
-    # Creating gene column and removing gene prefix of mutations
-    exploded['gene'] = exploded['mutation'].apply(lambda x: parse_mutation(x, 'gene'))
-    exploded['mutation'] = exploded['mutation'].apply(lambda x: parse_mutation(x, 'gene_removal'))
+    Only the distinct prefixed mutations of each batch are parsed, 
+    so that external engines (e.g. Polars, DuckDB) only need to count the prefixed mutations.
 
-    # Rearranging
-    exploded.reset_index(drop=True, inplace=True)
-    processed_nextclade = exploded[['batch', 'gene', 'mutation']]
-    return processed_nextclade
\ No newline at end of file
+    Parameters
+    ----------
+    prefixed_counts : pandas.DataFrame
+        A DataFrame of batch, prefixed mutation and count columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns,
+        the parsed position and type columns and an unsigned integer count column.
+
+    Raises
+    ------
+    ValueError
+        If no mutation is found or if a mutation has no gene prefix.
+
+    """
+    gene_and_mutation = prefixed_counts['mutation'].astype(str).str.extract(r'^([^:]+):(.*)$')
+    unparsed = gene_and_mutation[0].isna()
+    if unparsed.any():
+        raise ValueError(f"Failed to parse mutation for gene: '{prefixed_counts.loc[unparsed, 'mutation'].iloc[0]}'.")
+    counts = mutation_frame(prefixed_counts['batch'].astype(str), gene_and_mutation[0], gene_and_mutation[1])
+    counts['count'] = prefixed_counts['count'].to_numpy()
+    return count_mutations([counts])
+
+
+def read_nextclade_ndjson(file_path, chunksize=None, qc=None, seq_names=False):
+    """Reads Nextclade NDJSON output one record (sequence) at a time.
+
+    The positions and types of mutations are taken directly from the structured 
+    amino acid substitutions, deletions and insertions of each record, and only
+    the mutation names are built from them. Positions in Nextclade JSON output 
+    are 0-based and are shifted to the 1-based positions of the Nextclade TSV output.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the Nextclade NDJSON file, which may be compressed.
+    chunksize : int
+        Number of records per yielded DataFrame. All records are yielded
+        as one DataFrame if not provided.
+    qc : dict
+        The QC criteria (see qc_filter()). Records that fail are skipped.
+    seq_names : bool, default:False
+        Determines whether a categorical seqName column of the sequence of each mutation is added.
+
+    Yields
+    ------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns, the position 
+        and type columns (see mutation_records()) and a seqName column if seq_names is True.
+
+    """
+    sub_code, del_code, in_code = [MUTATION_TYPES.index(mutation_type) for mutation_type in ['sub', 'del', 'in']]
+
+    def ndjson_frame():
+        frame = mutation_frame(batches, genes, mutations)
+        frame['position'] = np.array(positions, dtype=np.int32)
+        frame['type'] = pd.Categorical.from_codes(np.array(types, dtype=np.int8), categories=MUTATION_TYPES)
+        if seq_names:
+            frame['seqName'] = pd.Categorical(names)
+        return frame
+
+    batches, genes, mutations, positions, types, names = [], [], [], [], [], []
+    num_records = 0
+    with open_text(file_path) as ndjson_file:
+        for line in ndjson_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            num_records += 1
+            if passes_qc(record, qc):
+                batch = record.get('batch', 'my_batch')
+                num_mutations = len(mutations)
+                for sub in record.get('aaSubstitutions') or []:
+                    position = sub['pos'] + 1
+                    batches.append(batch)
+                    genes.append(sub.get('cdsName', sub.get('gene')))
+                    mutations.append(f"{sub['refAa']}{position}{sub['qryAa']}")
+                    positions.append(position)
+                    types.append(sub_code)
+                for deletion in record.get('aaDeletions') or []:
+                    position = deletion['pos'] + 1
+                    batches.append(batch)
+                    genes.append(deletion.get('cdsName', deletion.get('gene')))
+                    mutations.append(f"{deletion['refAa']}{position}-")
+                    positions.append(position)
+                    types.append(del_code)
+                for insertion in record.get('aaInsertions') or []:
+                    position = insertion['pos'] + 1
+                    batches.append(batch)
+                    genes.append(insertion.get('cds', insertion.get('cdsName', insertion.get('gene'))))
+                    mutations.append(f"{position}:{insertion['ins']}")
+                    positions.append(position)
+                    types.append(in_code)
+                if seq_names:
+                    names.extend([record.get('seqName')] * (len(mutations) - num_mutations))
+
+            if chunksize is not None and num_records % chunksize == 0:
+                yield ndjson_frame()
+                batches, genes, mutations, positions, types, names = [], [], [], [], [], []
+    
+    if batches or chunksize is None:
+        yield ndjson_frame()
@@ -0,0 +1,192 @@
+"""Module for wrangling Nextclade analysis output with the Polars engine."""
+
+from ._nextclade_utils import strip_compression, open_text, qc_columns, count_prefixed_mutations
+import pandas as pd
+import os
+import shutil
+import tempfile
+
+
+def import_polars():
+    """Imports Polars, which is an optional dependency.
+
+    Returns
+    -------
+    module
+        The polars module.
+
+    Raises
+    ------
+    ImportError
+        If Polars is not installed.
+
+    """
+    try:
+        import polars
+    except ImportError:
+        raise ImportError("The Polars engine requires polars. Install with 'pip install vargram[polars]'.")
+    return polars
+
+
+def decompress(file_path, temp_dir):
+    """Decompresses a compressed text file into the directory as a stream, so that it can be scanned.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the compressed file.
+    temp_dir : str
+        Directory of the decompressed file.
+
+    Returns
+    -------
+    str
+        File path of the decompressed file.
+
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=os.path.basename(strip_compression(file_path)[0]), dir=temp_dir)
+    with open_text(file_path) as compressed_file, open(fd, 'w', encoding=compressed_file.encoding) as decompressed_file:
+        shutil.copyfileobj(compressed_file, decompressed_file, 1 << 20)
+    return temp_path
+
+
+def scan_nextclade(table_object, columns, batch='my_batch', temp_dir=None):
+    """Lazily reads delimited Nextclade output as strings.
+
+    Compressed files cannot be scanned by Polars, so they are first 
+    decompressed into the temporary directory (see decompress()).
+
+    Parameters
+    ----------
+    table_object : str or pandas.DataFrame
+        File path of the Nextclade analysis output (may be compressed) or its DataFrame.
+    columns : list
+        The Nextclade columns to read.
+    batch : str, default:'my_batch'
+        Batch name if there is no batch column.
+    temp_dir : str
+        Directory of the decompressed files, which must be kept until the query is collected.
+        Required if the file is compressed.
+
+    Returns
+    -------
+    polars.LazyFrame
+        The projected analysis output.
+
+    """
+    pl = import_polars()
+    if isinstance(table_object, pd.DataFrame):
+        analysis = pl.from_pandas(table_object[[col for col in table_object.columns if col in columns]]).lazy()
+    else:
+        root, compression = strip_compression(table_object)
+        ext = os.path.splitext(root)[1]
+        match ext:
+            case '.csv':
+                delimiter = ';'
+            case '.tsv':
+                delimiter = '\t'
+            case _:
+                raise ValueError(f"Unrecognized file extension. Expecting .csv or .tsv file but got {ext}")
+        if compression is not None:
+            table_object = decompress(table_object, temp_dir)
+        analysis = pl.scan_csv(table_object, separator=delimiter, infer_schema=False)
+        header = analysis.collect_schema().names()
+        analysis = analysis.select([col for col in header if col in columns])
+    if 'batch' not in analysis.collect_schema().names():
+        analysis = analysis.with_columns(pl.lit(batch).alias('batch'))
+    return analysis.with_columns(pl.col('batch').cast(pl.String))
+
+
+def filter_qc(analysis, qc):
+    """Keeps only the sequences that pass the QC criteria (see _nextclade_utils.qc_filter()).
+
+    Parameters
+    ----------
+    analysis : polars.LazyFrame
+        The Nextclade analysis output.
+    qc : dict or None
+        The QC criteria.
+
+    Returns
+    -------
+    polars.LazyFrame
+        The sequences that pass the QC criteria.
+
+    Raises
+    ------
+    ValueError
+        If a Nextclade column needed by the QC criteria is missing.
+
+    """
+    pl = import_polars()
+    needed_columns = qc_columns(qc)
+    if not needed_columns:
+        return analysis
+    missing_columns = [col for col in needed_columns if col not in analysis.collect_schema().names()]
+    if missing_columns:
+        raise ValueError(f"Nextclade column(s) needed for QC not found: {', '.join(missing_columns)}")
+
+    for flag in ['errors', 'warnings']:
+        if qc.get(flag):
+            analysis = analysis.filter(pl.col(flag).cast(pl.String).fill_null('').str.strip_chars() == '')
+    if qc.get('status') is not None:
+        status = [qc['status']] if isinstance(qc['status'], str) else qc['status']
+        analysis = analysis.filter(pl.col('qc.overallStatus').is_in(status))
+    if qc.get('coverage') is not None:
+        coverage = pl.col('coverage').cast(pl.Float64, strict=False)
+        analysis = analysis.filter(coverage >= qc['coverage'])
+    return analysis
+
+
+def count_nextclade_polars(tables, columns, batches=None, qc=None):
+    """Counts the mutations per batch and gene with a lazy, multithreaded Polars query.
+
+    The amino acid mutation columns are joined, split and exploded, and the
+    prefixed mutations (e.g. ORF1b:G662S) are counted per batch by Polars
+    (see _nextclade_utils.count_prefixed_mutations()).
+
+    Parameters
+    ----------
+    tables : list
+        File paths or DataFrames of Nextclade analysis output.
+    columns : list
+        The Nextclade columns to read.
+    batches : list
+        Batch name of each table without a batch column. Defaults to 'my_batch'.
+    qc : dict
+        The QC criteria (see _nextclade_utils.qc_filter()).
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame of categorical batch, gene and mutation columns,
+        the parsed position and type columns and an unsigned integer count column.
+
+    Raises
+    ------
+    ValueError
+        If no mutation is found or if a mutation has no gene prefix.
+
+    """
+    pl = import_polars()
+    aa_columns = ['aaSubstitutions', 'aaDeletions', 'aaInsertions']
+
+    if batches is None:
+        batches = ['my_batch'] * len(tables)
+    with tempfile.TemporaryDirectory(prefix='vargram_polars') as temp_dir:
+        scans = [scan_nextclade(table, columns, batch=batch, temp_dir=temp_dir) for table, batch in zip(tables, batches)]
+        analysis = filter_qc(pl.concat(scans, how='diagonal_relaxed'), qc)
+
+        prefixed_counts = (
+            analysis
+            .select(pl.col('batch'),
+                    pl.concat_str([pl.col(col).cast(pl.String).fill_null('') for col in aa_columns],
+                                  separator=',').str.split(',').alias('mutation'))
+            .explode('mutation')
+            .filter(pl.col('mutation') != '')
+            .group_by(['batch', 'mutation'])
+            .len(name='count')
+            .collect()
+            .to_pandas()
+        )
+    return count_prefixed_mutations(prefixed_counts)
@@ -0,0 +1,290 @@
+"""Module for caching the Nextclade results of each sequence on disk."""
+
+from ._cache import default_cache_dir
+from ._datasets import acquire_lock
+from ._nextclade_cli import run_command
+from ._nextclade_utils import open_text, batch_name
+import hashlib
+import os
+import tempfile
+import uuid
+import pandas as pd
+
+# Nextclade analysis columns kept for each sequence
+SEQUENCE_COLUMNS = ['aaSubstitutions', 'aaDeletions', 'aaInsertions', 'warnings', 'errors',
+                    'qc.overallStatus', 'coverage']
+
+# Number of stored parts after which the parts are compacted into one
+MAX_PARTS = 32
+
+
+def read_fasta(file_path):
+    """Reads the records of a plain or compressed FASTA file one at a time.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the FASTA file.
+
+    Yields
+    ------
+    str
+        The sequence name (the header without '>').
+    str
+        The sequence.
+
+    """
+    name = None
+    lines = []
+    with open_text(file_path) as fasta_file:
+        for line in fasta_file:
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(lines)
+                name = line[1:].strip()
+                lines = []
+            elif name is not None:
+                lines.append(line.strip())
+    if name is not None:
+        yield name, ''.join(lines)
+
+
+def sequence_hash(sequence):
+    """Hashes a sequence, ignoring letter case."""
+    return hashlib.blake2b(sequence.upper().encode(), digest_size=16).hexdigest()
+
+
+def dataset_version(ref_path, gene_path):
+    """Identifies the Nextclade dataset and Nextclade version that produce the results.
+
+    Parameters
+    ----------
+    ref_path : str
+        File path of the reference sequence.
+    gene_path : str
+        File path of the genome annotation.
+
+    Returns
+    -------
+    str
+        Hash of the reference and annotation contents and of the Nextclade version.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the Nextclade executable is not found.
+
+    """
+    hasher = hashlib.sha256()
+    hasher.update(run_command(['nextclade', '--version']).strip().encode())
+    for file_path in [ref_path, gene_path]:
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def store_dir(version, cache_dir=None):
+    """Gets the directory of the stored sequence results of a dataset version."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    return os.path.join(cache_dir, 'sequences', version)
+
+
+def stored_parts(version_dir):
+    """Lists the stored Parquet parts, skipping partially written ones."""
+    if not os.path.isdir(version_dir):
+        return []
+    return sorted(os.path.join(version_dir, file) for file in os.listdir(version_dir)
+                  if file.endswith('.parquet') and not file.startswith('.tmp_'))
+
+
+def read_parts(version_dir, read_part):
+    """Reads each stored Parquet part, without locking the parts.
+
+    Compaction writes the combined part before removing the old parts (see compact_parts()),
+    so if a part is removed while the parts are read, the parts listed again hold every result.
+
+    Parameters
+    ----------
+    version_dir : str
+        The directory of the dataset version (see store_dir()).
+    read_part : callable
+        Called with the file path of each part, returning its DataFrame.
+
+    Returns
+    -------
+    list of pandas.DataFrame
+        The DataFrame of each part.
+
+    """
+    while True:
+        try:
+            return [read_part(part) for part in stored_parts(version_dir)]
+        except FileNotFoundError: # Removed by compaction
+            continue
+
+
+def stored_hashes(version_dir):
+    """Gets the hashes of the sequences whose results are stored.
+
+    Parameters
+    ----------
+    version_dir : str
+        The directory of the dataset version (see store_dir()).
+
+    Returns
+    -------
+    set
+        The sequence hashes.
+
+    """
+    hashes = set()
+    for part_hashes in read_parts(version_dir, lambda part: pd.read_parquet(part, columns=['seqHash'])):
+        hashes.update(part_hashes['seqHash'].tolist())
+    return hashes
+
+
+def write_new_sequences(file_path, known, new_path):
+    """Writes the sequences of a FASTA file that have not been analysed to a new FASTA file.
+
+    Each new sequence is written once, named by its hash, and its hash is added to the known hashes.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the (possibly compressed) FASTA file.
+    known : set
+        Hashes of the stored or already written sequences.
+    new_path : str
+        File path of the FASTA file of new sequences.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The seqName and seqHash of each sequence of the FASTA file, in order.
+    bool
+        Whether any new sequence is written.
+
+    """
+    names = []
+    hashes = []
+    written = False
+    with open(new_path, 'w') as new_file:
+        for name, sequence in read_fasta(file_path):
+            seq_hash = sequence_hash(sequence)
+            names.append(name)
+            hashes.append(seq_hash)
+            if seq_hash not in known:
+                known.add(seq_hash)
+                new_file.write(f'>{seq_hash}\n{sequence}\n')
+                written = True
+    if not written:
+        os.remove(new_path)
+    return pd.DataFrame({'seqName': names, 'seqHash': hashes}), written
+
+
+def store_results(version_dir, results):
+    """Stores the results of new sequences as a new Parquet part.
+
+    Parameters
+    ----------
+    version_dir : str
+        The directory of the dataset version (see store_dir()).
+    results : pandas.DataFrame
+        The seqHash and the Nextclade columns of each sequence (see SEQUENCE_COLUMNS).
+
+    Returns
+    -------
+    None
+
+    """
+    if results.empty:
+        return
+    os.makedirs(version_dir, exist_ok=True)
+    results = results.reindex(columns=['seqHash'] + SEQUENCE_COLUMNS).astype('string')
+    write_part(version_dir, results)
+    if len(stored_parts(version_dir)) > MAX_PARTS:
+        compact_parts(version_dir)
+
+
+def write_part(version_dir, results):
+    """Writes a Parquet part through a temporary file so that parts are never partially written."""
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.parquet', dir=version_dir)
+    os.close(fd)
+    try:
+        results.to_parquet(temp_path, index=False)
+        os.replace(temp_path, os.path.join(version_dir, f'part-{uuid.uuid4().hex}.parquet'))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def compact_parts(version_dir):
+    """Combines the stored Parquet parts into one, keeping one result per sequence.
+
+    The combined part is written before the old parts are removed, so that readers need 
+    no lock (see read_parts()). Compaction is skipped while another process is compacting.
+    """
+    lock_path = os.path.join(version_dir, 'compact.lock')
+    try:
+        acquire_lock(lock_path, timeout=0)
+    except TimeoutError:
+        return
+    try:
+        parts = stored_parts(version_dir)
+        if len(parts) <= 1:
+            return
+        combined = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+        write_part(version_dir, combined.drop_duplicates(subset='seqHash'))
+        for part in parts:
+            os.remove(part)
+    finally:
+        os.remove(lock_path)
+
+
+def load_results(version_dir, hashes):
+    """Loads the stored results of the given sequences.
+
+    Parameters
+    ----------
+    version_dir : str
+        The directory of the dataset version (see store_dir()).
+    hashes : iterable
+        The sequence hashes.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The seqHash and the Nextclade columns of each stored sequence.
+
+    """
+    hashes = list(set(hashes))
+    loaded = read_parts(version_dir, lambda part: pd.read_parquet(part, filters=[('seqHash', 'in', hashes)]))
+    loaded = [part for part in loaded if not part.empty]
+    if not loaded:
+        return pd.DataFrame(columns=['seqHash'] + SEQUENCE_COLUMNS, dtype='string')
+    return pd.concat(loaded, ignore_index=True).drop_duplicates(subset='seqHash')
+
+
+def expand_results(sequences, results, batch):
+    """Gives each sequence of a FASTA batch its stored results.
+
+    Parameters
+    ----------
+    sequences : pandas.DataFrame
+        The seqName and seqHash of each sequence (see write_new_sequences()).
+    results : pandas.DataFrame
+        The stored results (see load_results()).
+    batch : str
+        The FASTA file path of the batch.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The batch, seqName and Nextclade columns of each sequence with results.
+
+    """
+    expanded = pd.merge(sequences, results, how='inner', on='seqHash').drop(columns='seqHash')
+    expanded.insert(0, 'batch', batch_name(batch))
+    return expanded
@@ -0,0 +1,159 @@
+"""Module for watching a directory of batch files and wrangling only new or changed batches."""
+
+from ._nextclade_utils import strip_compression, delimited_files, count_mutations
+import os
+import warnings
+import pandas as pd
+
+
+def watched_files(user_input):
+    """Gets the batch files currently in the watched input.
+
+    Parameters
+    ----------
+    user_input : dict
+        The user input to the Wrangler, with a directory of FASTA files ('seq')
+        or a directory, glob pattern or list of Nextclade analysis files ('data').
+
+    Returns
+    -------
+    list
+        Sorted list of file paths, each of which is a batch. Hidden files are skipped.
+
+    Raises
+    ------
+    ValueError
+        If the input is not a directory of FASTA files or multiple Nextclade analysis files.
+
+    """
+    if 'seq' in user_input.keys():
+        seq = user_input['seq']
+        if not isinstance(seq, str) or not os.path.isdir(seq):
+            raise ValueError("Watching requires a directory of FASTA files ('seq') or of Nextclade analysis files ('data').")
+        files = [os.path.join(seq, file) for file in sorted(os.listdir(seq))
+                 if strip_compression(file)[0].endswith(('.fasta', '.fa'))]
+    else:
+        data = user_input.get('data')
+        if isinstance(data, str) and strip_compression(data)[0].endswith('.ndjson'):
+            data = None
+        try:
+            files = delimited_files(data)
+        except ValueError: # No file yet
+            files = []
+        if files is None:
+            raise ValueError("Watching requires a directory of FASTA files ('seq') or of Nextclade analysis files ('data').")
+    return [file for file in files if not os.path.basename(file).startswith('.')]
+
+
+def file_signature(file_path):
+    """Gets the modification time and size of a file. None if the file no longer exists."""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def batch_input(user_input, file_path):
+    """Gets the user input of a single batch file of the watched input."""
+    if 'seq' in user_input.keys():
+        return {**user_input, 'seq': file_path}
+    return {**user_input, 'data': [file_path]} # A list so that the file name is the batch name
+
+
+def combine_batches(wrangled_batches):
+    """Combines the wrangled data of each batch (see Wrangler.get_wrangled_data()).
+
+    Parameters
+    ----------
+    wrangled_batches : list of dict
+        The wrangled data of each batch, in batch order.
+
+    Returns
+    -------
+    dict
+        The wrangled data of all batches. Mutation counts are summed,
+        otherwise the exploded mutations are concatenated.
+
+    """
+    combined = dict(wrangled_batches[0])
+    tables = [wrangled['data'] for wrangled in wrangled_batches]
+    if combined.get('counts') is not None:
+        combined['data'] = count_mutations(tables)
+        return combined
+    data = pd.concat(tables, ignore_index=True)
+    for col in ['batch', 'gene', 'mutation']:
+        if col in data.columns:
+            data[col] = data[col].astype('category')
+    combined['data'] = data
+    return combined
+
+
+class BatchWatcher():
+
+    def __init__(self, user_input, wrangle):
+        """Keeps the wrangled data of each batch file of a watched input.
+
+        Parameters
+        ----------
+        user_input : dict
+            The user input to the Wrangler (see watched_files()).
+        wrangle : callable
+            Called with the user input of a single batch file (see batch_input()),
+            returning its wrangled data (see Wrangler.get_wrangled_data()).
+
+        Returns
+        -------
+        None
+
+        """
+        self.user_input = user_input
+        self.wrangle = wrangle
+        self.batches = {} # File path: (signature, wrangled data or None if it failed)
+        self.pending = {} # File path: signature when last seen, for files not yet wrangled
+
+    def update(self):
+        """Wrangles the new or changed batch files and forgets the removed ones.
+
+        A new or changed file is wrangled once its modification time and size
+        are the same as in the previous update, so that files still being written are left
+        for a later update. Batches that fail are left out with a warning until the file changes.
+
+        Returns
+        -------
+        bool
+            Whether any batch is added, changed or removed.
+
+        """
+        files = watched_files(self.user_input)
+        changed = False
+        for file in list(self.batches.keys()):
+            if file not in files:
+                del self.batches[file]
+                changed = True
+        self.pending = {file: signature for file, signature in self.pending.items() if file in files}
+
+        for file in files:
+            signature = file_signature(file)
+            if signature is None or (file in self.batches and self.batches[file][0] == signature):
+                continue
+            if self.pending.get(file) != signature: # Still being written or just seen
+                self.pending[file] = signature
+                continue
+            del self.pending[file]
+            try:
+                wrangled = self.wrangle(batch_input(self.user_input, file))
+            except (RuntimeError, ValueError) as e:
+                warnings.warn(f"Batch {os.path.basename(file)} is left out until it changes: {e}")
+                wrangled = None
+            self.batches[file] = (signature, wrangled)
+            changed = True
+        return changed
+
+    def wrangled_data(self):
+        """Combines the wrangled data of the batches (see combine_batches()). None if no batch is wrangled."""
+        wrangled_batches = [self.batches[file][1] for file in sorted(self.batches.keys())
+                            if self.batches[file][1] is not None]
+        if not wrangled_batches:
+            return None
+        return combine_batches(wrangled_batches)
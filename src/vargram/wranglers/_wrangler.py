@@ -2,15 +2,45 @@
 
 from ._nextclade import nextclade
 from . import _nextclade_utils
+from . import _cache
+from . import _polars
+from . import _duckdb
+from ._nextclade_utils import NEXTCLADE_COLUMNS
+from ._nextclade_cli import dataset_paths
+from ._datasets import check_reference, get_dataset
+from ._sequence_cache import dataset_version
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import os
+import warnings
 
-def read_table(table_object, nextclade_file=False):
-    """Read tabular data (CSV, TSV or pandas.DataFrame)."""
+# Columns of the exploded mutations besides the Nextclade columns (see Wrangler._join_metadata())
+MUTATION_COLUMNS = ['batch', 'gene', 'mutation', 'position', 'type']
+
+# Suffix of metadata columns that share the name of a data column
+META_SUFFIX = '_meta'
+
+# Total size in bytes of delimited Nextclade files from which they are read in a process pool by default
+PARALLEL_READ_SIZE = 16 * 1024 * 1024
+
+def read_table(table_object, nextclade_file=False, chunksize=None, columns=None, engine=None):
+    """Read tabular data (CSV, TSV or pandas.DataFrame). Files may be compressed (e.g. '.tsv.gz').
+    
+    If chunksize is given, an iterator of DataFrames with at most chunksize rows is returned instead.
+    If columns is given, only the listed columns that are present are read.
+    The engine (e.g. 'pyarrow' for multithreaded parsing) is passed to pandas.read_csv.
+    The pyarrow engine cannot read in chunks, so the C engine is used instead when chunksize is given.
+    """
     if isinstance(table_object, pd.DataFrame):
         table = table_object
+        if columns is not None:
+            table = table[[col for col in table.columns if col in columns]]
+        if chunksize is not None:
+            return (table.iloc[start:start + chunksize].copy() for start in range(0, len(table), chunksize))
+        table = table.copy() # Modified in place later, leaving the user's DataFrame unchanged
     elif isinstance(table_object, str):
-        ext = os.path.splitext(table_object)[1]
+        ext = os.path.splitext(_nextclade_utils.strip_compression(table_object)[0])[1]
         if nextclade_file:
             csv_delim = ';'
         else:
@@ -30,18 +60,64 @@ def read_table(table_object, nextclade_file=False):
             case _:
                 raise ValueError(f"Unrecognized file extension. Expecting .csv or .tsv file but got {ext}")
         
-        table = pd.read_csv(table_object, delimiter=delimiter) 
+        usecols = None
+        if columns is not None:
+            usecols = _nextclade_utils.present_columns(table_object, delimiter, columns)
+        if chunksize is not None and engine == 'pyarrow':
+            engine = 'c'
+        table = pd.read_csv(table_object, delimiter=delimiter, chunksize=chunksize, 
+                            usecols=usecols, engine=engine) 
     else:
         raise ValueError("Unrecognized object. Expecting pandas.DataFrame object or delimited text file (CSV, TSV, or GFF).")
     
     return table
 
+def read_metadata(metadata, key, columns=None, keys=None, chunksize=100000):
+    """Read metadata (CSV, TSV or pandas.DataFrame) for joining with the sequences.
+    
+    If columns is given, only the key and the listed columns that are present are read.
+    If keys is given, only rows whose key is in keys are kept as each chunk of chunksize rows is read.
+    """
+    if columns is not None:
+        columns = [key] + [col for col in columns if col != key]
+    if isinstance(metadata, pd.DataFrame):
+        chunks = [metadata if columns is None else metadata[[col for col in metadata.columns if col in columns]]]
+    else:
+        chunks = read_table(metadata, chunksize=chunksize, columns=columns)
+    if keys is None:
+        return pd.concat(chunks, ignore_index=True)
+    keys = pd.Index(keys).astype(str)
+    return pd.concat([chunk[chunk[key].astype(str).isin(keys)] for chunk in chunks], ignore_index=True)
+
+def read_nextclade_file(file_path, columns=None, engine=None, chunksize=None, qc=None, explode=True):
+    """Read and process one delimited Nextclade output file as its own batch.
+    
+    The file name is used as the batch name unless the file has a batch column.
+    Sequences that fail the QC criteria are removed before exploding.
+    Returns the exploded mutations, the mutation counts if chunksize is given,
+    or the sequences if explode is False.
+    """
+    batch = _nextclade_utils.batch_name(file_path)
+    if chunksize is not None:
+        read_chunks = read_table(file_path, nextclade_file=True, chunksize=chunksize, columns=columns, engine=engine)
+        return _nextclade_utils.count_nextclade(read_chunks, batch=batch, allow_empty=True, qc=qc)
+    read_data = _nextclade_utils.qc_filter(read_table(file_path, nextclade_file=True, columns=columns, engine=engine), qc)
+    if 'batch' not in read_data.columns:
+        read_data.insert(0, 'batch', batch)
+    read_data.sort_values(by=['batch', 'seqName'], inplace=True)
+    read_data.reset_index(drop=True, inplace=True)
+    if not explode:
+        return read_data
+    return _nextclade_utils.explode_mutations(read_data)
+
 class Wrangler():
 
     def __init__(self, wrangler_kwargs):
         """Determine which plot to process data for."""
         self.wrangler_kwargs = wrangler_kwargs
         self.plot = wrangler_kwargs['plot']
+        self.plot_kwargs = wrangler_kwargs.pop('plot_kwargs', None)
+        self.run_nextclade = wrangler_kwargs.pop('run_nextclade', nextclade) # Replaced when awaited
         self.format = wrangler_kwargs.get('format')
         self.wrangled_data = dict()
         del wrangler_kwargs['plot']
@@ -63,39 +139,308 @@ class Wrangler():
 
         return self.wrangled_data
             
-    def _profile(self):
-        """Perform appropriate data wrangling method for Profile()."""
-        profile_formats = ['nextclade_fasta', 'nextclade_delimited', 'vargram', 'delimited', '_test']
+    def _nextclade_columns(self):
+        """Get the Nextclade analysis columns needed for the profile."""
+        columns = NEXTCLADE_COLUMNS + _nextclade_utils.qc_columns(self._qc())
+        if 'meta' in self.user_input.keys():
+            columns.append(self._metadata_join()[0])
+        return columns
 
-        # Assigning default format values
-        if self.format is None:
-            if 'seq' in self.user_input.keys():
-                self.format = 'nextclade_fasta'
-            elif 'data' in self.user_input.keys():
-                self.format = 'nextclade_delimited'
-        elif self.format not in profile_formats:
-            raise ValueError(f"Unrecognized format: {self.format}.")
+    def _metadata_join(self):
+        """Get the columns of the data and of the metadata to join on."""
+        if 'join' not in self.user_input.keys():
+            missing_join_error=("Missing 'join' argument. Provide column name(s) " 
+                                "to (outer) merge data and metadata on.")
+            raise ValueError(missing_join_error)
+        join = self.user_input['join']
+        if isinstance(join, str):
+            join = [join]
+        if len(join) != 1:
+            return join[0], join[1]
+        if self.format in ['nextclade_fasta', 'nextclade_delimited', 'nextclade_ndjson']:
+            # Automatically joining on the Nextclade sequence name
+            return 'seqName', join[0]
+        return join[0], join[0]
+
+    def _plot_columns(self):
+        """Get the data columns referenced by the plot. None if not known."""
+        if self.plot_kwargs is None:
+            return None
+        referenced = [self.plot_kwargs.get(arg) for arg in ['x', 'y', 'group', 'stack']]
+        return [col for col in referenced if col]
+
+    def _join_metadata(self, sequences):
+        """Left join the metadata onto each sequence (row) of Nextclade analysis output.
+
+        Only the metadata columns referenced by the plot are read 
+        and only the rows of sequences in the analysis are kept.
+        Metadata columns that share the name of a data column (e.g. 'batch') are 
+        suffixed with '_meta', with a warning unless the suffixed column is referenced.
+        Returns the joined sequences and the joined metadata columns.
+        """
+        data_key, meta_key = self._metadata_join()
+        if data_key not in sequences.columns:
+            raise ValueError(f"Column '{data_key}' to join metadata on not found in the Nextclade analysis.")
+        data_columns = list(sequences.columns) + [col for col in MUTATION_COLUMNS if col not in sequences.columns]
+        columns = self._plot_columns()
+        if columns is not None:
+            referenced = columns
+            columns = [col for col in columns if col not in data_columns]
+            columns += [col[:-len(META_SUFFIX)] for col in columns if col.endswith(META_SUFFIX)]
+        metadata = read_metadata(self.user_input['meta'], meta_key, columns=columns, 
+                                 keys=sequences[data_key].unique())
+        clashing = [col for col in metadata.columns if col != meta_key and col in data_columns]
+        metadata = metadata.rename(columns={col: col + META_SUFFIX for col in clashing})
+        unreferenced = [col for col in clashing if columns is None or col + META_SUFFIX not in referenced]
+        if unreferenced:
+            warnings.warn(f"Metadata column(s) {', '.join(unreferenced)} share the name of data columns "
+                          f"and are renamed to {', '.join(col + META_SUFFIX for col in unreferenced)}.")
+        metadata = metadata.rename(columns={meta_key: data_key})
+        meta_columns = [col for col in metadata.columns if col != data_key]
+        metadata[data_key] = metadata[data_key].astype(str)
+        joined = sequences.assign(**{data_key: sequences[data_key].astype(str)})
+        joined = pd.merge(joined, metadata[[data_key] + meta_columns], how='left', on=data_key)
+        return joined, meta_columns
+
+    def _explode_with_metadata(self, sequences):
+        """Explode the mutations of the sequences, joining metadata first if provided."""
+        if 'meta' not in self.user_input.keys():
+            return _nextclade_utils.process_nextclade(sequences)
+        sequences, meta_columns = self._join_metadata(sequences)
+        return _nextclade_utils.process_nextclade(sequences, carry=meta_columns)
+
+    def _qc(self):
+        """Get the QC criteria for filtering sequences.
+        
+        Sequences with errors or warnings are removed by default when Nextclade is run by VARGRAM.
+        """
+        qc = self.user_input.get('qc')
+        if qc is None and self.format == 'nextclade_fasta':
+            return {'errors': True, 'warnings': True}
+        if not qc:
+            return None
+        return qc
+
+    def _engine(self):
+        """Get the execution engine for wrangling Nextclade data."""
+        engine = self.user_input.get('engine', 'pandas')
+        if engine not in ['pandas', 'polars', 'duckdb']:
+            raise ValueError(f"Unrecognized engine: {engine}. Expecting 'pandas', 'polars' or 'duckdb'.")
+        if engine != 'pandas' and 'meta' in self.user_input.keys():
+            raise ValueError(f"Metadata cannot be joined to mutation counts of the {engine} engine. Use engine='pandas' to join metadata.")
+        return engine
+
+    def _count_with_engine(self, tables, batches=None):
+        """Count the mutations of Nextclade analysis tables with the Polars or DuckDB engine."""
+        if self._engine() == 'polars':
+            self.data = _polars.count_nextclade_polars(tables, self._nextclade_columns(), 
+                                                       batches=batches, qc=self._qc())
+        else:
+            self.data = _duckdb.count_nextclade_duckdb(tables, self._nextclade_columns(), 
+                                                       batches=batches, qc=self._qc(),
+                                                       memory_limit=self.user_input.get('memory_limit'))
+        self.wrangled_data["counts"] = 'count'
+
+    def _get_cache_entry(self):
+        """Get the cache directory and key of the wrangled data. None if caching is disabled."""
+        nextclade_formats = ['nextclade_fasta', 'nextclade_delimited', 'nextclade_ndjson']
+        if not self.user_input.get('cache', False) or self.format not in nextclade_formats:
+            return None
+        counted = self.user_input.get('chunksize') is not None or self._engine() != 'pandas'
+        options = {'counted': counted, 'qc': self._qc(), 'tag': self.user_input.get('tag')}
+        if 'meta' in self.user_input.keys():
+            options['meta'] = {'join': self._metadata_join(), 'columns': self._plot_columns()}
+        if self.format == 'nextclade_fasta':
+            options['dataset'] = self._dataset_version()
+        cache_input = self.user_input
+        if self.data_files is not None:
+            cache_input = {**self.user_input, 'data': self.data_files}
+        key = _cache.cache_key(cache_input, self.format, options)
+        if key is None:
+            return None
+        cache_dir = self.user_input.get('cache_dir')
+        if cache_dir is None:
+            cache_dir = _cache.default_cache_dir()
+        return cache_dir, key
+
+    def _dataset_version(self):
+        """Get the version of the Nextclade dataset and of Nextclade that analyse the sequences.
+        
+        A dataset name is resolved to its downloaded dataset, so that cached analyses 
+        are not used once the dataset or Nextclade is updated (see _sequence_cache.dataset_version()).
+        None if the reference or annotation is not provided.
+        """
+        ref = self.user_input.get('ref')
+        if not isinstance(ref, str):
+            return None
+        ref_dir = None
+        if not os.path.isfile(ref):
+            dataset_options = {'tag': self.user_input.get('tag'), 'cache_dir': self.user_input.get('cache_dir'),
+                               'refresh': self.user_input.get('cache') == 'refresh'}
+            check_reference(ref, **dataset_options)
+            ref_dir = get_dataset(ref, **dataset_options)
+            self._dataset_refreshed = dataset_options['refresh'] # Not downloaded again by the run
+        elif not isinstance(self.user_input.get('gene'), str):
+            return None
+        return dataset_version(*dataset_paths(self.user_input, ref_dir=ref_dir))
+
+    def _load_cache(self):
+        """Load wrangled data from the cache. Returns False if there is no cached data."""
+        if self._cache_entry is None or self.user_input.get('cache') == 'refresh':
+            return False
+        cached = _cache.load_cache(*self._cache_entry)
+        if cached is None:
+            return False
+        self.data = cached['data']
+        if cached.get('annotation') is not None:
+            self.wrangled_data["annotation"] = cached['annotation']
+        if cached['counts'] is not None:
+            self.wrangled_data["counts"] = cached['counts']
+        return True
+
+    def _store_cache(self):
+        """Store wrangled data in the cache."""
+        if self._cache_entry is None:
+            return
+        _cache.store_cache(*self._cache_entry, self.data, 
+                           annotation=self.wrangled_data.get('annotation'),
+                           counts=self.wrangled_data.get('counts'),
+                           max_size=self.user_input.get('cache_size', 1024))
 
-        # Wrangling data
+    def _read_nextclade_files(self):
+        """Read and process multiple delimited Nextclade output files, in a process pool if they are large."""
+        chunksize = self.user_input.get('chunksize')
+        if chunksize is not None and 'meta' in self.user_input.keys():
+            raise ValueError("Metadata cannot be joined to streamed mutation counts. Remove 'chunksize' to join metadata.")
+        explode = 'meta' not in self.user_input.keys() # Joining metadata before exploding
+        read_file = partial(read_nextclade_file, columns=self._nextclade_columns(),
+                            engine=self.user_input.get('read_engine'), chunksize=chunksize, qc=self._qc(),
+                            explode=explode)
+        processes = self.user_input.get('processes')
+        if processes is None:
+            # Small inputs are read in this process, as starting workers costs more than it saves
+            total_size = sum(os.path.getsize(file) for file in self.data_files)
+            processes = (os.cpu_count() or 1) if total_size >= PARALLEL_READ_SIZE else 1
+        processes = min(processes, len(self.data_files))
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                partial_results = list(executor.map(read_file, self.data_files))
+        else:
+            partial_results = [read_file(file) for file in self.data_files]
+
+        # Merging the partial results
+        if chunksize is not None:
+            self.data = _nextclade_utils.count_mutations(partial_results)
+            self.wrangled_data["counts"] = 'count'
+            return
+        self.data = pd.concat(partial_results, ignore_index=True)
+        if not explode:
+            self.data = self._explode_with_metadata(self.data)
+            return
+        if self.data.empty:
+            raise ValueError("Processed Nextclade analysis DataFrame is empty. Potentially sequences do not have any mutation.")
+        for col in ['batch', 'gene', 'mutation']:
+            self.data[col] = self.data[col].astype('category')
+
+    def _read_profile_data(self):
+        """Read and wrangle the data according to its format."""
         match self.format:
             case 'nextclade_fasta':
-                nextclade_kwargs = {key: self.user_input[key] for key in ['seq', 'ref', 'gene'] if key in self.user_input.keys()}
-                read_data, annotation = nextclade(**nextclade_kwargs)
-                self.data = _nextclade_utils.process_nextclade(read_data)
+                nextclade_kwargs = {key: self.user_input[key] for key in ['seq', 'ref', 'gene', 'read_engine', 'chunksize', 'processes', 'cpus', 'retries', 'shards', 'incremental', 'collapse', 'tag', 'cache_dir'] if key in self.user_input.keys()}
+                nextclade_kwargs['refresh'] = self.user_input.get('cache') == 'refresh' and not self._dataset_refreshed
+                nextclade_kwargs['columns'] = self._nextclade_columns()
+                nextclade_kwargs['qc'] = self._qc()
+                if self.user_input.get('chunksize') is not None and 'meta' in self.user_input.keys():
+                    raise ValueError("Metadata cannot be joined to streamed mutation counts. Remove 'chunksize' to join metadata.")
+                read_data, annotation = self.run_nextclade(**nextclade_kwargs)
+                if self.user_input.get('chunksize') is not None:
+                    # Mutations were counted as Nextclade piped the analysis output
+                    self.data = read_data
+                    self.wrangled_data["counts"] = 'count'
+                elif self._engine() != 'pandas':
+                    self._count_with_engine([read_data])
+                else:
+                    self.data = self._explode_with_metadata(read_data)
                 self.wrangled_data["annotation"] = annotation
+            case 'nextclade_delimited' if self._engine() != 'pandas':
+                # Counting with a Polars or DuckDB query, each file as a batch
+                if self.data_files is not None:
+                    batches = [_nextclade_utils.batch_name(file) for file in self.data_files]
+                    self._count_with_engine(self.data_files, batches=batches)
+                else:
+                    self._count_with_engine([self.user_input['data']])
+            case 'nextclade_delimited' if self.data_files is not None:
+                # Multiple files, each as a batch
+                self._read_nextclade_files()
+            case 'nextclade_delimited' if self.user_input.get('chunksize') is not None:
+                # Streaming the table and keeping only the running mutation counts
+                if 'meta' in self.user_input.keys():
+                    raise ValueError("Metadata cannot be joined to streamed mutation counts. Remove 'chunksize' to join metadata.")
+                tabular_data = self.user_input['data']
+                read_chunks = read_table(tabular_data, nextclade_file=True, chunksize=self.user_input['chunksize'],
+                                         columns=self._nextclade_columns(), engine=self.user_input.get('read_engine'))
+                self.data = _nextclade_utils.count_nextclade(read_chunks, qc=self._qc())
+                self.wrangled_data["counts"] = 'count'
+            case 'nextclade_ndjson':
+                join_metadata = 'meta' in self.user_input.keys()
+                read_chunks = _nextclade_utils.read_nextclade_ndjson(self.user_input['data'],
+                                                                     chunksize=self.user_input.get('chunksize'),
+                                                                     qc=self._qc(), seq_names=join_metadata)
+                if self.user_input.get('chunksize') is not None:
+                    if 'meta' in self.user_input.keys():
+                        raise ValueError("Metadata cannot be joined to streamed mutation counts. Remove 'chunksize' to join metadata.")
+                    self.data = _nextclade_utils.count_mutations(read_chunks)
+                    self.wrangled_data["counts"] = 'count'
+                else:
+                    self.data = next(read_chunks) # With the positions and types of the records
+                    if self.data.empty:
+                        raise ValueError("Processed Nextclade analysis DataFrame is empty. Potentially sequences do not have any mutation.")
+                    if join_metadata: # Joining on the sequence name of each mutation
+                        self.data = self._join_metadata(self.data)[0].drop(columns='seqName')
             case 'nextclade_delimited':
                 tabular_data = self.user_input['data']
-                read_data = read_table(tabular_data, nextclade_file=True)
+                read_data = read_table(tabular_data, nextclade_file=True, 
+                                       columns=self._nextclade_columns(), engine=self.user_input.get('read_engine'))
+                read_data = _nextclade_utils.qc_filter(read_data, self._qc())
                 if 'batch' not in read_data.columns:
                     read_data.insert(0, 'batch', 'my_batch')
                 read_data.sort_values(by=['batch', 'seqName'], inplace=True)
                 read_data.reset_index(drop=True, inplace=True)
-                self.data = _nextclade_utils.process_nextclade(read_data)
+                self.data = self._explode_with_metadata(read_data)
             case _:
                 tabular_data = self.user_input['data']
                 read_data = read_table(tabular_data)
                 self.data = read_table(tabular_data, nextclade_file=False)
 
+    def _profile(self):
+        """Perform appropriate data wrangling method for Profile()."""
+        profile_formats = ['nextclade_fasta', 'nextclade_delimited', 'nextclade_ndjson', 'vargram', 'delimited', '_test']
+
+        # Assigning default format values
+        if self.format is None:
+            if 'seq' in self.user_input.keys():
+                self.format = 'nextclade_fasta'
+            elif isinstance(self.user_input.get('data'), str) and _nextclade_utils.strip_compression(self.user_input['data'])[0].endswith('.ndjson'):
+                self.format = 'nextclade_ndjson'
+            elif 'data' in self.user_input.keys():
+                self.format = 'nextclade_delimited'
+        elif self.format not in profile_formats:
+            raise ValueError(f"Unrecognized format: {self.format}.")
+
+        self._engine() # Checking the engine before reading any data
+
+        # Getting multiple delimited files (directory, glob pattern or list) if provided
+        self.data_files = None
+        if self.format == 'nextclade_delimited':
+            self.data_files = _nextclade_utils.delimited_files(self.user_input.get('data'))
+
+        # Wrangling data, loading Nextclade data from the cache if enabled
+        self._dataset_refreshed = False
+        self._cache_entry = self._get_cache_entry()
+        if not self._load_cache():
+            self._read_profile_data()
+            self._store_cache()
+
         # Getting annotation data if provided
         annotation_provided = 'gene' in self.user_input.keys()
         annotation_not_yet_read = self.wrangled_data.get('annotation') is None
@@ -104,25 +449,10 @@ class Wrangler():
             self.wrangled_data["annotation"] = annotation
 
         # Adding metadata if available
-        if 'meta' in self.user_input.keys():
-            # Getting columns to merge on 
-            if 'join' not in self.user_input.keys():
-                missing_join_error=("Missing 'join' argument. Provide column name(s) " 
-                                    "to (outer) merge data and metadata on.")
-                raise ValueError(missing_join_error)
-            elif isinstance(self.user_input['join'], str): 
-                join = [self.user_input['join']]
-            else:
-                join = self.user_input['join']
-            metadata = self.user_input['meta']
-            if len(join) != 1:
-                metadata.rename(columns={join[1]:join[0]}, inplace=True)
-                self.data = pd.merge(self.data, metadata, how='outer', on=join[0])
-            elif self.format == 'nextclade_fasta' or self.format == 'nextclade_delimited': 
-                # If 'seq' is provided, automatically join on nextclade_sequence_name
-                nextclade_seqname = 'seqName'
-                metadata.rename(columns={join[0]:nextclade_seqname}, inplace=True)
-                self.data = pd.merge(self.data, metadata, 
-                                      how='outer', on=nextclade_seqname)
-            else: 
-                self.data = pd.merge(self.data, metadata, how='outer', on=join)
\ No newline at end of file
+        # Metadata of Nextclade data is joined per sequence before exploding
+        nextclade_formats = ['nextclade_fasta', 'nextclade_delimited', 'nextclade_ndjson']
+        if 'meta' in self.user_input.keys() and self.format not in nextclade_formats:
+            data_key, meta_key = self._metadata_join()
+            metadata = read_metadata(self.user_input['meta'], meta_key)
+            metadata.rename(columns={meta_key:data_key}, inplace=True)
+            self.data = pd.merge(self.data, metadata, how='outer', on=data_key)
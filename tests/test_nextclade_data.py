@@ -0,0 +1,554 @@
+"""Tests whether Nextclade analysis output is wrangled correctly."""
+
+from vargram.wranglers._nextclade_utils import (process_nextclade, parse_mutation, get_mutation_type,
+                                                check_file_extension, qc_filter, NEXTCLADE_COLUMNS,
+                                                read_nextclade_ndjson, mutation_records, count_mutations)
+from vargram.wranglers._wrangler import read_table, read_metadata
+from vargram.wranglers import _wrangler
+from vargram import vargram, clear_cache
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib.pyplot as plt
+import pandas as pd
+import pytest
+import gzip
+import os
+import re
+import shutil
+import warnings
+import json
+
+
+def rowwise_process_nextclade(nextclade_output):
+    """Reference row-by-row explode of the Nextclade amino acid mutation columns."""
+    rows = []
+    for _, row in nextclade_output.iterrows():
+        mutation_columns = [row[col] for col in ['aaSubstitutions', 'aaDeletions', 'aaInsertions']]
+        mutation_string = ','.join(filter(None, [col if isinstance(col, str) else '' for col in mutation_columns]))
+        for mutation in filter(None, mutation_string.split(',')):
+            rows.append([row['batch'], parse_mutation(mutation, 'gene'), parse_mutation(mutation, 'gene_removal')])
+    return pd.DataFrame(rows, columns=['batch', 'gene', 'mutation'])
+
+
+@pytest.fixture(params=['omicron_analysis_cli', 'XBB_analysis_web'])
+def analysis_data(request):
+    """Read a Nextclade analysis file, adding a batch column if absent."""
+    analysis = pd.read_csv(f'tests/test_data/analysis/{request.param}.tsv', delimiter='\t')
+    if 'batch' not in analysis.columns:
+        analysis.insert(0, 'batch', 'my_batch')
+    return analysis
+
+
+class TestProcessNextclade:
+
+    def test_explode(self, analysis_data):
+        """Exploded mutations should match the row-wise reference, row for row."""
+        result = process_nextclade(analysis_data)[['batch', 'gene', 'mutation']]
+        expected = rowwise_process_nextclade(analysis_data)
+        assert result.astype(str).equals(expected.astype(str))
+
+    def test_records(self, analysis_data):
+        """Parsed positions and types should match the mutation names."""
+        result = process_nextclade(analysis_data)
+        expected_positions = result['mutation'].astype(str).apply(lambda x: int(parse_mutation(x, 'position')))
+        expected_types = result['mutation'].astype(str).apply(get_mutation_type)
+        assert result['position'].astype(int).equals(expected_positions)
+        assert result['type'].astype(str).equals(expected_types)
+
+    def test_categorical(self, analysis_data):
+        """Exploded columns should be dictionary-encoded."""
+        result = process_nextclade(analysis_data)[['batch', 'gene', 'mutation', 'type']]
+        assert all(isinstance(dtype, pd.CategoricalDtype) for dtype in result.dtypes)
+
+    def test_empty(self, analysis_data):
+        """Sequences without any mutation should raise an error."""
+        no_mutations = analysis_data.copy()
+        no_mutations[['aaSubstitutions', 'aaDeletions', 'aaInsertions']] = None
+        with pytest.raises(ValueError):
+            process_nextclade(no_mutations)
+
+    def test_unparsed(self, analysis_data):
+        """Mutations without a gene prefix should raise an error."""
+        malformed = analysis_data.copy()
+        malformed.loc[0, 'aaSubstitutions'] = 'G662S'
+        with pytest.raises(ValueError):
+            process_nextclade(malformed)
+
+
+@pytest.fixture(params=[(1, 'counts'), (10, 'counts'), (1, 'weights'), (10, 'weights')])
+def profile_params(request):
+    """Threshold and y-axis type of the profile."""
+    return request.param
+
+
+class TestStreamedNextclade:
+
+    def test_chunked_stat(self, profile_params):
+        """Profile data from streamed counts should equal profile data from the whole table."""
+        threshold, ytype = profile_params
+        analysis_file = 'tests/test_data/analysis/omicron_analysis_cli.tsv'
+        vg = vargram(data=analysis_file)
+        vg.profile(threshold=threshold, ytype=ytype)
+        expected = vg.stat()
+        vg = vargram(data=analysis_file, chunksize=7)
+        vg.profile(threshold=threshold, ytype=ytype)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+
+class TestReadNextclade:
+
+    def test_projected_read(self):
+        """Only the columns used by VARGRAM should be read, in file order."""
+        analysis_file = 'tests/test_data/analysis/XBB_analysis_web.tsv'
+        result = read_table(analysis_file, nextclade_file=True, columns=NEXTCLADE_COLUMNS)
+        expected = pd.read_csv(analysis_file, delimiter='\t')[['seqName', 'aaSubstitutions', 'aaDeletions', 
+                                                               'aaInsertions', 'warnings', 'errors']]
+        assert result.equals(expected)
+
+    def test_pyarrow_stat(self):
+        """Profile data should not depend on the CSV parsing engine."""
+        pytest.importorskip('pyarrow')
+        analysis_file = 'tests/test_data/analysis/omicron_analysis_cli.tsv'
+        vg = vargram(data=analysis_file)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        vg = vargram(data=analysis_file, read_engine='pyarrow')
+        vg.profile(threshold=1)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+
+    def test_dataframe_read(self):
+        """A DataFrame input should be read without changing it or warning about chained assignment."""
+        analysis = pd.read_csv('tests/test_data/analysis/XBB_analysis_web.tsv', delimiter='\t')
+        original = analysis.copy()
+        vg = vargram(data=analysis)
+        vg.profile(threshold=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', getattr(pd.errors, 'SettingWithCopyWarning', UserWarning))
+            vg.stat()
+        plt.close('all')
+        pd.testing.assert_frame_equal(analysis, original)
+
+    def test_pyarrow_chunked_stat(self, tmp_path):
+        """Streamed profile data should not fail with the pyarrow engine, which cannot read in chunks."""
+        pytest.importorskip('pyarrow')
+        analysis_file = 'tests/test_data/analysis/omicron_analysis_cli.tsv'
+        vg = vargram(data=analysis_file)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        combined = pd.read_csv(analysis_file, delimiter='\t')
+        for batch, batch_data in combined.groupby('batch'):
+            batch_data.drop(columns='batch').to_csv(tmp_path / f'{batch}.tsv', sep='\t', index=False)
+        for data in [analysis_file, str(tmp_path)]:
+            vg = vargram(data=data, read_engine='pyarrow', chunksize=20, processes=1)
+            vg.profile(threshold=1)
+            result = vg.stat()
+            assert result.equals(expected)
+        plt.close('all')
+
+class TestCachedNextclade:
+
+    def setup_method(self):
+        pytest.importorskip('pyarrow')
+
+    def test_cached_stat(self, tmp_path):
+        """Profile data from the cache should equal freshly wrangled profile data."""
+        analysis_file = 'tests/test_data/analysis/omicron_analysis_cli.tsv'
+        results = []
+        for _ in range(2):
+            vg = vargram(data=analysis_file, cache=True, cache_dir=str(tmp_path))
+            vg.profile(threshold=1)
+            results.append(vg.stat())
+        plt.close('all')
+        assert len(os.listdir(tmp_path / 'analyses')) == 1
+        assert results[0].equals(results[1])
+
+    def test_cache_size(self, tmp_path):
+        """Only the most recently cached analysis should be kept when the size limit is small."""
+        cache_size = 1024
+        for analysis in ['BA1_analysis_cli', 'BA2_analysis_cli']:
+            vg = vargram(data=f'tests/test_data/analysis/{analysis}.tsv', cache=True, 
+                         cache_dir=str(tmp_path), cache_size=cache_size)
+            vg.profile(threshold=1)
+            vg.stat()
+            # Limiting the cache to a bit more than the size of the first analysis
+            entry_dir = tmp_path / 'analyses' / os.listdir(tmp_path / 'analyses')[0]
+            cache_size = 1.5 * sum(file.stat().st_size for file in entry_dir.iterdir()) / (1024 * 1024)
+        plt.close('all')
+        assert len(os.listdir(tmp_path / 'analyses')) == 1
+
+    def test_clear_cache(self, tmp_path):
+        """Clearing the cache should remove all cached analyses."""
+        vg = vargram(data='tests/test_data/analysis/BA1_analysis_cli.tsv', cache=True, cache_dir=str(tmp_path))
+        vg.profile(threshold=1)
+        vg.stat()
+        plt.close('all')
+        clear_cache(str(tmp_path))
+        assert not os.path.exists(tmp_path / 'analyses')
+
+
+def write_ndjson(analysis, ndjson_path):
+    """Write Nextclade analysis rows as NDJSON records with 0-based structured mutations."""
+    with open(ndjson_path, 'w') as ndjson_file:
+        for _, row in analysis.iterrows():
+            record = {'seqName': row['seqName'], 'aaSubstitutions': [], 'aaDeletions': [], 'aaInsertions': []}
+            for mutation_type in ['aaSubstitutions', 'aaDeletions', 'aaInsertions']:
+                if not isinstance(row[mutation_type], str):
+                    continue
+                for mutation in row[mutation_type].split(','):
+                    gene, name = mutation.split(':', 1)
+                    if mutation_type == 'aaInsertions':
+                        pos, ins = name.split(':')
+                        record[mutation_type].append({'cds': gene, 'pos': int(pos) - 1, 'ins': ins})
+                    else:
+                        match = re.match(r'(\D+)(\d+)(\D+)', name)
+                        record[mutation_type].append({'cdsName': gene, 'pos': int(match.group(2)) - 1,
+                                                      'refAa': match.group(1), 'qryAa': match.group(3)})
+            ndjson_file.write(json.dumps(record) + '\n')
+
+
+class TestNdjsonNextclade:
+
+    @pytest.mark.parametrize('chunksize', [None, 5])
+    def test_ndjson_stat(self, tmp_path, chunksize):
+        """Profile data from NDJSON output should equal profile data from TSV output."""
+        analysis_file = 'tests/test_data/analysis/XBB_analysis_web.tsv'
+        ndjson_path = str(tmp_path / 'analysis.ndjson')
+        write_ndjson(pd.read_csv(analysis_file, delimiter='\t'), ndjson_path)
+        with open(ndjson_path, 'rb') as ndjson_file, gzip.open(ndjson_path + '.gz', 'wb') as compressed_file:
+            shutil.copyfileobj(ndjson_file, compressed_file)
+        vg = vargram(data=analysis_file)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        for data in [ndjson_path, ndjson_path + '.gz']: # Detected without format
+            vg = vargram(data=data, chunksize=chunksize)
+            vg.profile(threshold=1)
+            result = vg.stat()
+            assert result.equals(expected)
+        plt.close('all')
+
+    @pytest.mark.parametrize('chunksize', [None, 5])
+    def test_ndjson_records(self, tmp_path, chunksize):
+        """Positions and types of NDJSON records should be taken from the records, not parsed again."""
+        ndjson_path = str(tmp_path / 'analysis.ndjson')
+        write_ndjson(pd.read_csv('tests/test_data/analysis/XBB_analysis_web.tsv', delimiter='\t'), ndjson_path)
+        chunks = list(read_nextclade_ndjson(ndjson_path, chunksize=chunksize))
+        for chunk in chunks:
+            expected = mutation_records(chunk['mutation'])
+            pd.testing.assert_frame_equal(chunk[['position', 'type']], expected)
+
+        # Mutation names without digits cannot be parsed, yet are counted with the positions of their records
+        letters = str.maketrans('0123456789', 'abcdefghij')
+        renamed = chunks[0].assign(mutation=chunks[0]['mutation'].astype(str).str.translate(letters))
+        counts = count_mutations([renamed])
+        positions = renamed.drop_duplicates(subset='mutation').set_index('mutation')['position']
+        assert counts['position'].tolist() == positions[counts['mutation'].astype(str)].tolist()
+
+
+class TestCompressedInput:
+
+    @pytest.mark.parametrize('compression', ['gz', 'zst'])
+    def test_compressed_stat(self, tmp_path, compression):
+        """Profile data from a compressed analysis file should equal profile data from the plain file."""
+        if compression == 'zst':
+            pytest.importorskip('zstandard')
+        analysis_file = 'tests/test_data/analysis/BA1_analysis_cli.tsv'
+        compressed_path = str(tmp_path / f'BA1_analysis_cli.tsv.{compression}')
+        pd.read_csv(analysis_file, delimiter='\t').to_csv(compressed_path, sep='\t', index=False)
+        vg = vargram(data=analysis_file)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        vg = vargram(data=compressed_path)
+        vg.profile(threshold=1)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+    def test_compressed_extension(self):
+        """Compression extensions should be ignored when checking file extensions."""
+        assert check_file_extension('sequences.fasta.gz', ['fa', 'fasta']) == ('fasta', True)
+        assert check_file_extension('sequences.gz', ['fa', 'fasta']) == ('sequences', False)
+
+
+class TestMultipleFiles:
+
+    @pytest.mark.parametrize('chunksize', [None, 20])
+    def test_files_stat(self, tmp_path, chunksize):
+        """Profile data from separate batch files should equal profile data from the combined file."""
+        combined = pd.read_csv('tests/test_data/analysis/omicron_analysis_cli.tsv', delimiter='\t')
+        for batch, batch_data in combined.groupby('batch'):
+            batch_data.drop(columns='batch').to_csv(tmp_path / f'{batch}.tsv', sep='\t', index=False)
+        vg = vargram(data='tests/test_data/analysis/omicron_analysis_cli.tsv')
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        for data in [str(tmp_path), str(tmp_path / '*.tsv'), sorted(str(file) for file in tmp_path.iterdir())]:
+            vg = vargram(data=data, chunksize=chunksize, processes=2)
+            vg.profile(threshold=1)
+            result = vg.stat()
+            assert result.equals(expected)
+        plt.close('all')
+
+
+    def test_pool_size(self, monkeypatch, tmp_path):
+        """Small files should be read without a process pool, and a pool should not have more workers than files."""
+        combined = pd.read_csv('tests/test_data/analysis/omicron_analysis_cli.tsv', delimiter='\t')
+        for batch, batch_data in combined.groupby('batch'):
+            batch_data.drop(columns='batch').to_csv(tmp_path / f'{batch}.tsv', sep='\t', index=False)
+        pools = []
+        class RecordingExecutor(ThreadPoolExecutor):
+            def __init__(self, max_workers):
+                pools.append(max_workers)
+                super().__init__(max_workers=max_workers)
+        monkeypatch.setattr(_wrangler, 'ProcessPoolExecutor', RecordingExecutor)
+        monkeypatch.setattr(_wrangler.os, 'cpu_count', lambda: 64)
+        for parallel_size in [_wrangler.PARALLEL_READ_SIZE, 0]:
+            monkeypatch.setattr(_wrangler, 'PARALLEL_READ_SIZE', parallel_size)
+            vg = vargram(data=str(tmp_path))
+            vg.profile(threshold=1)
+            vg.stat()
+        plt.close('all')
+        assert pools == [combined['batch'].nunique()]
+
+
+class TestWatchedFiles:
+
+    def test_watched_stat(self, monkeypatch, tmp_path):
+        """Watched profile data should equal profile data of the current files, reading only new files."""
+        combined = pd.read_csv('tests/test_data/analysis/omicron_analysis_cli.tsv', delimiter='\t')
+        batch_dir = tmp_path / 'batches'
+        batch_dir.mkdir()
+        batches = dict(list(combined.groupby('batch')))
+        def expected_csv():
+            vg = vargram(data=str(batch_dir), processes=1)
+            vg.profile(threshold=20)
+            vg.save(str(tmp_path / 'expected.csv'))
+            return pd.read_csv(tmp_path / 'expected.csv')
+
+        read_files = []
+        read_file = _wrangler.read_nextclade_file
+        def recording_read(file_path, **read_options):
+            read_files.append(os.path.basename(file_path))
+            return read_file(file_path, **read_options)
+        monkeypatch.setattr(_wrangler, 'read_nextclade_file', recording_read)
+        names = sorted(batches)
+        for name in names:
+            batches[name].drop(columns='batch').to_csv(batch_dir / f'{name}.tsv', sep='\t', index=False)
+        vg = vargram(data=str(batch_dir), processes=1)
+        vg.profile(threshold=20)
+        vg.watch(str(tmp_path / 'watched.csv'), interval=0.01, max_updates=1)
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'watched.csv'), expected_csv())
+
+        # Adding a batch and removing another
+        read_files.clear()
+        shutil.copy('tests/test_data/analysis/XBB_analysis_web.tsv', batch_dir / 'XBB.tsv')
+        os.remove(batch_dir / f'{names[0]}.tsv')
+        # Saved once the removal is seen and again once the new file is unchanged between checks
+        vg.watch(str(tmp_path / 'watched.csv'), interval=0.01, max_updates=2)
+        assert read_files == ['XBB.tsv']
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'watched.csv'), expected_csv())
+        plt.close('all')
+
+    def test_watched_file(self):
+        """Watching a single file should be reported."""
+        vg = vargram(data='tests/test_data/analysis/omicron_analysis_cli.tsv')
+        vg.profile()
+        with pytest.raises(ValueError, match='Watching requires a directory'):
+            vg.watch('profile.csv', interval=0.01, max_updates=1)
+
+
+class TestQualityControl:
+
+    @pytest.mark.parametrize('qc', [{'status': 'good'}, {'status': ['good', 'mediocre'], 'coverage': 0.9}])
+    def test_qc_stat(self, qc):
+        """Profile data with QC criteria should equal profile data of the passing sequences only."""
+        analysis_file = 'tests/test_data/analysis/XBB_analysis_web.tsv'
+        analysis = pd.read_csv(analysis_file, delimiter='\t')
+        status = [qc['status']] if isinstance(qc['status'], str) else qc['status']
+        passed = analysis['qc.overallStatus'].isin(status) & (analysis['coverage'] >= qc.get('coverage', 0))
+        vg = vargram(data=analysis[passed].reset_index(drop=True))
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        vg = vargram(data=analysis_file, qc=qc)
+        vg.profile(threshold=1)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+    def test_qc_filter(self, analysis_data):
+        """Sequences with warnings or errors should be removed."""
+        flagged = analysis_data.copy()
+        flagged[['warnings', 'errors']] = flagged[['warnings', 'errors']].astype(object)
+        flagged.loc[0, 'warnings'] = 'Some warning'
+        flagged.loc[1, 'errors'] = 'Some error'
+        result = qc_filter(flagged, {'errors': True, 'warnings': True})
+        assert len(result) == len(flagged) - 2
+
+    def test_qc_unexpected(self, analysis_data):
+        """Unknown QC criteria should raise an error."""
+        with pytest.raises(TypeError):
+            qc_filter(analysis_data, {'score': 10})
+
+
+class TestEngines:
+
+    @pytest.mark.parametrize('engine', ['polars', 'duckdb'])
+    def test_engine_stat(self, profile_params, engine):
+        """Profile data from the Polars and DuckDB engines should equal profile data from the pandas engine."""
+        pytest.importorskip(engine)
+        threshold, ytype = profile_params
+        for analysis_file in ['tests/test_data/analysis/omicron_analysis_cli.tsv',
+                              'tests/test_data/analysis/XBB_analysis_web.tsv']:
+            vg = vargram(data=analysis_file)
+            vg.profile(threshold=threshold, ytype=ytype)
+            expected = vg.stat()
+            vg = vargram(data=analysis_file, engine=engine)
+            vg.profile(threshold=threshold, ytype=ytype)
+            result = vg.stat()
+            assert result.equals(expected)
+        plt.close('all')
+
+    @pytest.mark.parametrize('engine', ['polars', 'duckdb'])
+    def test_engine_files_stat(self, tmp_path, engine):
+        """Polars and DuckDB engines should read compressed batch files and apply the QC criteria."""
+        pytest.importorskip(engine)
+        combined = pd.read_csv('tests/test_data/analysis/omicron_analysis_cli.tsv', delimiter='\t')
+        for (batch, batch_data), compression in zip(combined.groupby('batch'), ['gz', 'bz2']):
+            batch_data.drop(columns='batch').to_csv(tmp_path / f'{batch}.tsv.{compression}', sep='\t', index=False)
+        qc = {'status': ['good', 'mediocre']}
+        vg = vargram(data=str(tmp_path), qc=qc)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        vg = vargram(data=str(tmp_path), qc=qc, engine=engine)
+        vg.profile(threshold=1)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+    @pytest.mark.parametrize('engine', ['polars', 'duckdb'])
+    def test_engine_dataframe_stat(self, engine):
+        """Polars and DuckDB engines should count a DataFrame with missing values."""
+        pytest.importorskip(engine)
+        analysis = pd.read_csv('tests/test_data/analysis/XBB_analysis_web.tsv', delimiter='\t')
+        qc = {'errors': True, 'warnings': True, 'coverage': 0.9}
+        vg = vargram(data=analysis, qc=qc)
+        vg.profile(threshold=1)
+        expected = vg.stat()
+        vg = vargram(data=analysis, qc=qc, engine=engine)
+        vg.profile(threshold=1)
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+    def test_polars_compressed_scan(self, tmp_path):
+        """Compressed files should be decompressed into the temporary directory and scanned lazily."""
+        pl = pytest.importorskip('polars')
+        from vargram.wranglers._polars import scan_nextclade
+        analysis = pd.read_csv('tests/test_data/analysis/BA1_analysis_cli.tsv', delimiter='\t')
+        analysis.to_csv(tmp_path / 'BA1.tsv.xz', sep='\t', index=False)
+        temp_dir = tmp_path / 'temp'
+        temp_dir.mkdir()
+        columns = ['seqName', 'aaSubstitutions']
+        scan = scan_nextclade(str(tmp_path / 'BA1.tsv.xz'), columns, batch='BA1', temp_dir=str(temp_dir))
+        assert isinstance(scan, pl.LazyFrame)
+        assert len(os.listdir(temp_dir)) == 1
+        result = scan.collect().to_pandas()
+        assert result.columns.tolist() == columns + ['batch']
+        assert result['aaSubstitutions'].fillna('').tolist() == analysis['aaSubstitutions'].fillna('').tolist()
+
+    def test_duckdb_missing_values(self):
+        """Missing values of a DataFrame should stay NULL in DuckDB."""
+        duckdb = pytest.importorskip('duckdb')
+        from vargram.wranglers._duckdb import add_source
+        analysis = pd.DataFrame({'seqName': ['a', 'b'], 'aaSubstitutions': ['S:N501Y', None],
+                                 'errors': [None, 'Unable to align'], 'warnings': [None, None]})
+        connection = duckdb.connect()
+        add_source(connection, 'analysis', analysis, ['seqName', 'aaSubstitutions', 'errors', 'warnings'])
+        nulls = connection.execute("SELECT count(*) - count(aaSubstitutions), count(*) - count(errors), "
+                                   "count(*) - count(warnings) FROM analysis").fetchone()
+        assert nulls == (1, 1, 2)
+
+    def test_unrecognized_engine(self):
+        """Unknown engines should raise an error."""
+        vg = vargram(data='tests/test_data/analysis/omicron_analysis_cli.tsv', engine='spark')
+        vg.profile()
+        with pytest.raises(ValueError):
+            vg.stat()
+
+
+@pytest.fixture
+def region_metadata(tmp_path):
+    """Write metadata of all but the first three sequences, among unrelated rows."""
+    analysis = pd.read_csv('tests/test_data/analysis/XBB_analysis_web.tsv', delimiter='\t')
+    samples = analysis['seqName'].iloc[3:]
+    metadata = pd.DataFrame({'sample': list(samples) + [f'unrelated_{i}' for i in range(50)],
+                             'region': [f'region_{i % 3}' for i in range(len(samples) + 50)],
+                             'age': range(len(samples) + 50)})
+    metadata_path = tmp_path / 'metadata.csv'
+    metadata.to_csv(metadata_path, index=False)
+    return analysis, metadata, str(metadata_path)
+
+
+class TestMetadataJoin:
+
+    def expected_stat(self, analysis, metadata):
+        """Profile data of the sequences with metadata, using the region as the batch."""
+        joined = analysis.merge(metadata.rename(columns={'sample': 'seqName'}), on='seqName')
+        vg = vargram(data=joined.assign(batch=joined['region']).drop(columns=['region', 'age']))
+        vg.profile(threshold=1)
+        return vg.stat()
+
+    def test_joined_stat(self, region_metadata):
+        """Metadata joined per sequence should stack the mutations of each sequence by metadata column."""
+        analysis, metadata, metadata_path = region_metadata
+        expected = self.expected_stat(analysis, metadata)
+        vg = vargram(data='tests/test_data/analysis/XBB_analysis_web.tsv', meta=metadata_path, join='sample')
+        vg.profile(threshold=1, stack='region')
+        result = vg.stat()
+        plt.close('all')
+        assert result.equals(expected)
+
+    def test_joined_files_stat(self, tmp_path, region_metadata):
+        """Metadata should be joined to the sequences of multiple files and of NDJSON output."""
+        analysis, metadata, metadata_path = region_metadata
+        expected = self.expected_stat(analysis, metadata)
+        files_dir = tmp_path / 'files'
+        files_dir.mkdir()
+        analysis.iloc[:20].to_csv(files_dir / 'first.tsv', sep='\t', index=False)
+        analysis.iloc[20:].to_csv(files_dir / 'second.tsv', sep='\t', index=False)
+        write_ndjson(analysis, tmp_path / 'analysis.ndjson')
+        for data in [str(files_dir), str(tmp_path / 'analysis.ndjson')]:
+            vg = vargram(data=data, meta=metadata_path, join='sample', processes=1)
+            vg.profile(threshold=1, stack='region')
+            result = vg.stat()
+            assert result.equals(expected)
+        plt.close('all')
+
+    def test_clashing_columns(self, tmp_path, region_metadata):
+        """Metadata columns sharing the name of data columns should be kept with a suffix."""
+        analysis, metadata, _ = region_metadata
+        expected = self.expected_stat(analysis, metadata)
+        metadata_path = tmp_path / 'metadata.csv'
+        metadata.rename(columns={'region': 'batch'}).to_csv(metadata_path, index=False)
+        vg = vargram(data='tests/test_data/analysis/XBB_analysis_web.tsv', meta=str(metadata_path), join='sample')
+        vg.profile(threshold=1, stack='batch_meta')
+        result = vg.stat()
+        assert result.equals(expected)
+        plt.close('all')
+
+        # All metadata columns are joined if the plot columns are not known
+        with pytest.warns(UserWarning, match='batch_meta'):
+            joined = _wrangler.Wrangler({'plot': 'Profile', 'data': 'tests/test_data/analysis/XBB_analysis_web.tsv',
+                                         'meta': str(metadata_path), 'join': 'sample'}).get_wrangled_data()['data']
+        assert joined['batch'].eq('my_batch').all()
+        assert joined['batch_meta'].notna().any()
+
+    def test_read_metadata(self, region_metadata):
+        """Only the requested columns of the requested sequences should be read."""
+        analysis, metadata, metadata_path = region_metadata
+        result = read_metadata(metadata_path, 'sample', columns=['region'], keys=analysis['seqName'], chunksize=7)
+        assert result.columns.tolist() == ['sample', 'region']
+        assert result['sample'].tolist() == analysis['seqName'].iloc[3:].tolist()
+
@@ -0,0 +1,532 @@
+"""Tests whether Nextclade runs are scheduled, retried and captured correctly."""
+
+from vargram.wranglers import _nextclade, _datasets, _sequence_cache, _nextclade_async
+from vargram.wranglers._nextclade_async import nextclade_async
+from vargram.wranglers._nextclade import nextclade, cpu_budget
+from vargram.wranglers._nextclade_cli import capture_output, stream_output, capture_output_async, stream_output_async
+from vargram.wranglers._nextclade_utils import count_nextclade
+from vargram.wranglers._datasets import get_dataset, check_reference
+from vargram import vargram, clear_cache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import socket
+import subprocess
+import threading
+import pandas as pd
+import pytest
+import sys
+import time
+import os
+import json
+
+
+def analysis_capture(failing=(), failures_before_success=0):
+    """Create a stand-in for capture_output() returning the test analysis of each FASTA batch.
+
+    Batches whose FASTA name contains a string in failing always fail.
+    Other batches fail the given number of times first.
+    """
+    attempts = {}
+    def capture(command, columns=None, engine=None):
+        seq = command[-1]
+        attempts[seq] = attempts.get(seq, 0) + 1
+        if any(name in seq for name in failing) or attempts[seq] <= failures_before_success:
+            raise RuntimeError("Error running Nextclade (exit code 1): failed")
+        batch = 'BA1_analysis_cli' if 'BA1' in seq else 'BA2_analysis_cli'
+        analysis = pd.read_csv(f'tests/test_data/analysis/{batch}.tsv', delimiter='\t')
+        return analysis.drop(columns=['index', 'batch'], errors='ignore')
+    return capture, attempts
+
+
+class TestCpuBudget:
+
+    @pytest.mark.parametrize('budget, expected', [((3, None, 16), (3, 5)), ((20, None, 4), (4, 1)),
+                                                  ((5, 2, 8), (2, 4)), ((1, None, 8), (1, 8))])
+    def test_cpu_budget(self, budget, expected):
+        """CPUs should be split between the concurrent runs and the threads of each run."""
+        num_batches, processes, cpus = budget
+        assert cpu_budget(num_batches, processes=processes, cpus=cpus) == expected
+
+
+class TestCaptureOutput:
+
+    def test_failed_command(self, tmp_path):
+        """A failed command should raise an error with its output instead of returning None."""
+        command = [sys.executable, '-c', 'import sys; sys.exit("bad input")', '-t', str(tmp_path / 'analysis.tsv')]
+        with pytest.raises(RuntimeError, match='bad input'):
+            capture_output(command)
+
+    def test_missing_executable(self, tmp_path):
+        """A missing executable should raise an error."""
+        with pytest.raises(FileNotFoundError):
+            capture_output(['vargram_missing_executable', '-t', str(tmp_path / 'analysis.tsv')])
+
+    def test_captured_output(self, tmp_path):
+        """The analysis output of a successful command should be read without the index column."""
+        analysis_path = tmp_path / 'analysis.tsv'
+        write = f"open({str(analysis_path)!r}, 'w').write('index\\tseqName\\n0\\ta\\n')"
+        captured = capture_output([sys.executable, '-c', write, '-t', str(analysis_path)])
+        assert captured.columns.tolist() == ['seqName']
+
+
+class TestStreamOutput:
+
+    def test_streamed_output(self):
+        """The piped analysis output should be read in chunks without the index column."""
+        write = "print('index\\tseqName'); [print(f'{i}\\ts{i}') for i in range(5)]"
+        chunks = list(stream_output([sys.executable, '-c', write], chunksize=2))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert pd.concat(chunks)['seqName'].tolist() == [f's{i}' for i in range(5)]
+
+    def test_failed_stream(self):
+        """A command failing after writing part of its output should raise an error with its output."""
+        write = "print('seqName'); print('a', flush=True); import sys; sys.exit('bad input')"
+        with pytest.raises(RuntimeError, match='bad input'):
+            list(stream_output([sys.executable, '-c', write]))
+
+    def test_missing_executable(self):
+        """A missing executable should raise an error."""
+        with pytest.raises(FileNotFoundError):
+            list(stream_output(['vargram_missing_executable']))
+
+
+class TestConcurrentBatches:
+
+    def run(self, monkeypatch, **capture_kwargs):
+        capture, attempts = analysis_capture(**capture_kwargs)
+        monkeypatch.setattr(_nextclade, 'capture_output', capture)
+        output, _ = nextclade(seq='tests/test_data/sequences', ref='tests/test_data/sc2_wuhan_2019.fasta',
+                              gene='tests/test_data/sc2.gff', qc=None, processes=2, cpus=4)
+        return output, attempts
+
+    def test_batches(self, monkeypatch):
+        """Concurrent batches should be combined in batch order."""
+        output, _ = self.run(monkeypatch)
+        assert output['batch'].unique().tolist() == ['sc2_BA1_n80', 'sc2_BA2_n80']
+
+    def test_retried_batches(self, monkeypatch):
+        """Failed batches should be run again."""
+        output, attempts = self.run(monkeypatch, failures_before_success=1)
+        assert output['batch'].nunique() == 2
+        assert all(attempt == 2 for attempt in attempts.values())
+
+    def test_failed_batch(self, monkeypatch):
+        """A batch failing every attempt should be reported without losing the other batches."""
+        with pytest.warns(UserWarning, match='sc2_BA2_n80'):
+            output, _ = self.run(monkeypatch, failing=['BA2'])
+        assert output['batch'].unique().tolist() == ['sc2_BA1_n80']
+
+    def test_failed_batches(self, monkeypatch):
+        """An error should be raised if every batch fails."""
+        with pytest.raises(RuntimeError):
+            self.run(monkeypatch, failing=['BA1', 'BA2'])
+
+    def test_jobs(self, monkeypatch):
+        """Each run should use its share of the CPUs as Nextclade threads."""
+        commands = []
+        capture, _ = analysis_capture()
+        def recording_capture(command, **read_options):
+            commands.append(command)
+            return capture(command, **read_options)
+        monkeypatch.setattr(_nextclade, 'capture_output', recording_capture)
+        nextclade(seq='tests/test_data/sequences', ref='tests/test_data/sc2_wuhan_2019.fasta',
+                  gene='tests/test_data/sc2.gff', processes=2, cpus=4)
+        assert all(command[command.index('--jobs') + 1] == '2' for command in commands)
+        assert len({command[command.index('-t') + 1] for command in commands}) == 2
+
+
+class TestDatasetCache:
+
+    def fake_download(self, monkeypatch, downloads):
+        """Replace the dataset download with writing the dataset files, recording each download."""
+        def run_command(command):
+            downloads.append(command)
+            ref_dir = command[command.index('-o') + 1]
+            for file in _datasets.DATASET_FILES:
+                with open(os.path.join(ref_dir, file), 'w') as dataset_file:
+                    dataset_file.write(file)
+        monkeypatch.setattr(_datasets, 'run_command', run_command)
+
+    def test_downloaded_once(self, monkeypatch, tmp_path):
+        """Concurrent and repeated requests for a dataset should download it once."""
+        downloads = []
+        self.fake_download(monkeypatch, downloads)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            dataset_dirs = list(executor.map(lambda _: get_dataset('sars-cov-2', cache_dir=str(tmp_path)), range(8)))
+        assert len(downloads) == 1
+        assert len(set(dataset_dirs)) == 1
+        assert get_dataset('sars-cov-2', cache_dir=str(tmp_path)) == dataset_dirs[0]
+        assert len(downloads) == 1
+
+    def test_stale_lock(self, monkeypatch, tmp_path):
+        """A lock should be broken only if its owner is no longer running, however old it is."""
+        self.fake_download(monkeypatch, [])
+        lock_path = tmp_path / 'datasets' / 'sars-cov-2' / 'latest.lock'
+        lock_path.parent.mkdir(parents=True)
+        old_time = time.time() - 2 * _datasets.LOCK_STALE
+        lock_path.write_text(f'{socket.gethostname()} {os.getpid()}\n') # Held by a running process
+        os.utime(lock_path, (old_time, old_time))
+        with pytest.raises(TimeoutError):
+            _datasets.acquire_lock(str(lock_path), timeout=0.3)
+
+        finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], 
+                                  capture_output=True, text=True)
+        lock_path.write_text(f'{socket.gethostname()} {finished.stdout.strip()}\n') # Left by a finished process
+        get_dataset('sars-cov-2', cache_dir=str(tmp_path))
+        assert not lock_path.exists()
+
+    def test_tags(self, monkeypatch, tmp_path):
+        """Each tag should be cached separately and refreshing should download again."""
+        downloads = []
+        self.fake_download(monkeypatch, downloads)
+        tagged_dir = get_dataset('nextstrain/sars-cov-2/wuhan-hu-1/orfs', tag='2024-04-25--12-00-00Z', cache_dir=str(tmp_path))
+        latest_dir = get_dataset('nextstrain/sars-cov-2/wuhan-hu-1/orfs', cache_dir=str(tmp_path))
+        assert tagged_dir != latest_dir
+        assert downloads[0][-2:] == ['--tag', '2024-04-25--12-00-00Z']
+        get_dataset('nextstrain/sars-cov-2/wuhan-hu-1/orfs', cache_dir=str(tmp_path), refresh=True)
+        assert len(downloads) == 3
+
+    def test_cleared_datasets(self, monkeypatch, tmp_path):
+        """Datasets should be removed only if requested."""
+        self.fake_download(monkeypatch, [])
+        dataset_path = get_dataset('sars-cov-2', cache_dir=str(tmp_path))
+        clear_cache(str(tmp_path))
+        assert os.path.exists(dataset_path)
+        clear_cache(str(tmp_path), datasets=True)
+        assert not os.path.exists(dataset_path)
+
+
+class TestDatasetCatalogue:
+
+    names = ['nextstrain/sars-cov-2/wuhan-hu-1/orfs', 'nextstrain/mpox/all-clades']
+    full_list = 'nextstrain/sars-cov-2/wuhan-hu-1/orfs (shortcuts: "sars-cov-2", "nextstrain/sars-cov-2")\n'
+
+    def fake_list(self, monkeypatch, listings, online=True):
+        """Replace the listing of datasets, recording each listing."""
+        def run_command(command):
+            listings.append(command)
+            if not online:
+                raise RuntimeError("Error running Nextclade (exit code 1): network unreachable")
+            return '\n'.join(self.names) if '--only-names' in command else self.full_list
+        monkeypatch.setattr(_datasets, 'run_command', run_command)
+
+    def test_cached_catalogue(self, monkeypatch, tmp_path):
+        """Datasets should be listed again only after the cached catalogue expires."""
+        listings = []
+        self.fake_list(monkeypatch, listings)
+        check_reference('sars-cov-2', cache_dir=str(tmp_path))
+        check_reference('nextstrain/mpox/all-clades', cache_dir=str(tmp_path))
+        assert len(listings) == 2
+        catalogue_path = tmp_path / 'datasets' / 'catalogue.json'
+        catalogue = json.loads(catalogue_path.read_text())
+        catalogue['fetched'] -= _datasets.CATALOGUE_TTL + 1
+        catalogue_path.write_text(json.dumps(catalogue))
+        check_reference('sars-cov-2', cache_dir=str(tmp_path))
+        assert len(listings) == 4
+
+    def test_unrecognized_reference(self, monkeypatch, tmp_path):
+        """Unknown dataset names should raise an error."""
+        self.fake_list(monkeypatch, [])
+        with pytest.raises(ValueError, match='not recognized'):
+            check_reference('sars-cov-3', cache_dir=str(tmp_path))
+
+    def test_offline_reference(self, monkeypatch, tmp_path):
+        """Without network, names should be checked against the old catalogue or the downloaded datasets."""
+        self.fake_list(monkeypatch, [])
+        check_reference('sars-cov-2', cache_dir=str(tmp_path))
+        catalogue_path = tmp_path / 'datasets' / 'catalogue.json'
+        catalogue = json.loads(catalogue_path.read_text())
+        catalogue['fetched'] = 0
+        catalogue_path.write_text(json.dumps(catalogue))
+        self.fake_list(monkeypatch, [], online=False)
+        check_reference('sars-cov-2', cache_dir=str(tmp_path)) # Old catalogue
+        catalogue_path.unlink()
+        with pytest.raises(ValueError, match='cannot be checked'):
+            check_reference('sars-cov-2', cache_dir=str(tmp_path))
+        dataset_path = tmp_path / 'datasets' / 'sars-cov-2' / '2024-04-25--12-00-00Z'
+        dataset_path.mkdir(parents=True)
+        for file in _datasets.DATASET_FILES:
+            (dataset_path / file).write_text(file)
+        check_reference('sars-cov-2', cache_dir=str(tmp_path)) # Downloaded dataset
+
+
+def shard_capture(command, columns=None, engine=None):
+    """Stand-in for capture_output() returning the test analysis rows of the sequences in the FASTA."""
+    with open(command[-1]) as fasta_file:
+        seq_names = [line[1:].strip() for line in fasta_file if line.startswith('>')]
+    analysis = pd.read_csv('tests/test_data/analysis/BA1_analysis_cli.tsv', delimiter='\t')
+    return analysis[analysis['seqName'].isin(seq_names)].drop(columns=['index', 'batch'], errors='ignore')
+
+
+class TestShardedFasta:
+
+    fasta_path = 'tests/test_data/sequences/sc2_BA1_n80.fasta'
+
+    @pytest.mark.parametrize('num_shards', [1, 3, 8, 200])
+    def test_shard_offsets(self, num_shards):
+        """Shards should cover the FASTA file, start at a record and be of about equal size."""
+        offsets = _nextclade.fasta_shard_offsets(self.fasta_path, num_shards)
+        with open(self.fasta_path, 'rb') as fasta_file:
+            content = fasta_file.read()
+        assert offsets[0][0] == 0 and offsets[-1][1] == len(content)
+        assert all(end == start for (_, end), (start, _) in zip(offsets[:-1], offsets[1:]))
+        assert all(content[start:start + 1] == b'>' for start, _ in offsets)
+        assert len(offsets) == min(num_shards, content.count(b'>'))
+        if num_shards <= 8:
+            record_size = max(len(record) for record in content.split(b'>'))
+            assert all(abs((end - start) - len(content) / num_shards) < record_size for start, end in offsets)
+
+    def test_sharded_run(self, monkeypatch):
+        """Sharded runs should merge into one batch equal to the unsharded run."""
+        commands = []
+        def recording_capture(command, **read_options):
+            commands.append(command)
+            return shard_capture(command, **read_options)
+        monkeypatch.setattr(_nextclade, 'capture_output', recording_capture)
+        nextclade_kwargs = {'seq': self.fasta_path, 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                            'gene': 'tests/test_data/sc2.gff', 'qc': None}
+        expected, _ = nextclade(**nextclade_kwargs, shards=1)
+        result, _ = nextclade(**nextclade_kwargs, shards=4, cpus=4)
+        assert len(commands) == 5
+        assert result.equals(expected)
+        assert result['batch'].unique().tolist() == ['sc2_BA1_n80']
+
+
+def piped_capture(monkeypatch, capture):
+    """Make stream_output() yield the captured analysis of each batch in chunks, recording the commands."""
+    commands = []
+    def stream(command, chunksize=10000):
+        commands.append(command)
+        analysis = capture(command)
+        for start in range(0, len(analysis), chunksize):
+            yield analysis.iloc[start:start + chunksize].copy()
+    monkeypatch.setattr(_nextclade, 'stream_output', stream)
+    return commands
+
+
+class TestPipedCounts:
+
+    nextclade_kwargs = {'seq': 'tests/test_data/sequences', 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                        'gene': 'tests/test_data/sc2.gff', 'qc': None, 'columns': ['seqName', 'aaSubstitutions']}
+
+    def test_piped_counts(self, monkeypatch):
+        """Piped batches should be counted as the analysis output is read."""
+        capture, _ = analysis_capture()
+        monkeypatch.setattr(_nextclade, 'capture_output', capture)
+        output, _ = nextclade(**self.nextclade_kwargs)
+        expected = count_nextclade([output])
+        commands = piped_capture(monkeypatch, capture)
+        result, _ = nextclade(**self.nextclade_kwargs, chunksize=7)
+        pd.testing.assert_frame_equal(result, expected)
+        for command in commands:
+            assert command[command.index('-t') + 1] == '-'
+            assert command[command.index('--output-columns-selection') + 1] == 'seqName,aaSubstitutions'
+
+    def test_piped_shards(self, monkeypatch):
+        """Piped shards should be counted as one batch."""
+        piped_capture(monkeypatch, shard_capture)
+        kwargs = {**self.nextclade_kwargs, 'seq': TestShardedFasta.fasta_path}
+        expected, _ = nextclade(**kwargs, chunksize=7, shards=1)
+        result, _ = nextclade(**kwargs, chunksize=7, shards=4, cpus=4)
+        pd.testing.assert_frame_equal(result, expected)
+        assert result['batch'].unique().tolist() == ['sc2_BA1_n80']
+
+
+class TestSequenceCache:
+
+    nextclade_kwargs = {'ref': 'tests/test_data/sc2_wuhan_2019.fasta', 'gene': 'tests/test_data/sc2.gff', 
+                        'columns': ['batch', 'seqName', 'aaSubstitutions', 'aaDeletions', 'aaInsertions', 
+                                    'warnings', 'errors']}
+
+    @pytest.fixture
+    def hashed_capture(self, monkeypatch):
+        """Make capture_output() return the test analysis of the sequences named by their hash, recording the FASTA files."""
+        names = {}
+        for file in os.listdir('tests/test_data/sequences'):
+            for name, sequence in _sequence_cache.read_fasta(os.path.join('tests/test_data/sequences', file)):
+                names[_sequence_cache.sequence_hash(sequence)] = name
+        analysis = pd.concat([pd.read_csv(f'tests/test_data/analysis/{batch}.tsv', delimiter='\t') 
+                              for batch in ['BA1_analysis_cli', 'BA2_analysis_cli']])
+        runs = []
+        def capture(command, columns=None, engine=None):
+            hashes = [name for name, _ in _sequence_cache.read_fasta(command[-1])]
+            runs.append(hashes)
+            rows = analysis.set_index('seqName').loc[[names[seq_hash] for seq_hash in hashes]]
+            return rows.reset_index(drop=True).assign(seqName=hashes).drop(columns=['index', 'batch'], errors='ignore')
+        monkeypatch.setattr(_nextclade, 'capture_output', capture)
+        monkeypatch.setattr(_sequence_cache, 'run_command', lambda command: 'nextclade 3.0.0')
+        return runs
+
+    def expected(self, monkeypatch, seq):
+        """Get the counts of the run without the sequence cache."""
+        capture, _ = analysis_capture()
+        with monkeypatch.context() as patch:
+            patch.setattr(_nextclade, 'capture_output', capture)
+            output, _ = nextclade(seq=seq, **self.nextclade_kwargs)
+        return count_nextclade([output])
+
+    def test_repeated_run(self, monkeypatch, tmp_path, hashed_capture):
+        """Stored sequences should not be run again and give the same results."""
+        seq = 'tests/test_data/sequences'
+        first, _ = nextclade(seq=seq, **self.nextclade_kwargs, incremental=True, cache_dir=str(tmp_path))
+        second, _ = nextclade(seq=seq, **self.nextclade_kwargs, incremental=True, cache_dir=str(tmp_path))
+        assert [len(hashes) for hashes in hashed_capture] == [80, 80]
+        pd.testing.assert_frame_equal(first, second)
+        pd.testing.assert_frame_equal(count_nextclade([second]), self.expected(monkeypatch, seq))
+        assert first['batch'].unique().tolist() == ['sc2_BA1_n80', 'sc2_BA2_n80']
+
+    def test_growing_sequences(self, monkeypatch, tmp_path, hashed_capture):
+        """Only the sequences added since the last run should be run."""
+        fasta_path = 'tests/test_data/sequences/sc2_BA1_n80.fasta'
+        records = list(_sequence_cache.read_fasta(fasta_path))
+        grown_path = tmp_path / 'sc2_BA1_n80.fasta'
+        for num_records in [50, 80]:
+            grown_path.write_text(''.join(f'>{name}\n{sequence}\n' for name, sequence in records[:num_records]))
+            result, _ = nextclade(seq=str(grown_path), **self.nextclade_kwargs, incremental=True, 
+                                  cache_dir=str(tmp_path / 'cache'), shards=1)
+        assert [len(hashes) for hashes in hashed_capture] == [50, 30]
+        pd.testing.assert_frame_equal(count_nextclade([result]), self.expected(monkeypatch, fasta_path))
+
+    def test_compacted_parts(self, tmp_path, monkeypatch):
+        """Compacted parts should keep one result per sequence."""
+        monkeypatch.setattr(_sequence_cache, 'MAX_PARTS', 2)
+        for seq_hash in ['a', 'b', 'a']:
+            _sequence_cache.store_results(str(tmp_path), pd.DataFrame({'seqHash': [seq_hash], 'aaSubstitutions': ['S:L18F']}))
+        assert len(_sequence_cache.stored_parts(str(tmp_path))) == 1
+        assert sorted(_sequence_cache.load_results(str(tmp_path), ['a', 'b', 'c'])['seqHash']) == ['a', 'b']
+
+
+    def test_compacted_while_read(self, tmp_path, monkeypatch):
+        """Parts compacted while they are read should be read again from the combined part, without a lock."""
+        for seq_hash in ['a', 'b']:
+            _sequence_cache.store_results(str(tmp_path), pd.DataFrame({'seqHash': [seq_hash], 'aaSubstitutions': ['S:L18F']}))
+        read_parquet = pd.read_parquet
+        compacting = []
+        def compacting_read(path, **read_options):
+            if not compacting and len(_sequence_cache.stored_parts(str(tmp_path))) > 1:
+                compacting.append(path) # Compacting the parts once, before the first part is read
+                _sequence_cache.compact_parts(str(tmp_path))
+                compacting.clear()
+            return read_parquet(path, **read_options)
+        monkeypatch.setattr(_sequence_cache.pd, 'read_parquet', compacting_read)
+        assert _sequence_cache.stored_hashes(str(tmp_path)) == {'a', 'b'}
+        for seq_hash in ['c', 'd']:
+            _sequence_cache.store_results(str(tmp_path), pd.DataFrame({'seqHash': [seq_hash], 'aaSubstitutions': ['S:L18F']}))
+        loaded = _sequence_cache.load_results(str(tmp_path), ['a', 'b', 'c', 'd'])
+        assert sorted(loaded['seqHash']) == ['a', 'b', 'c', 'd']
+        assert len(_sequence_cache.stored_parts(str(tmp_path))) == 1
+
+    def test_concurrent_compaction(self, tmp_path):
+        """Compaction should be skipped while another process is compacting."""
+        for seq_hash in ['a', 'b']:
+            _sequence_cache.store_results(str(tmp_path), pd.DataFrame({'seqHash': [seq_hash], 'aaSubstitutions': ['S:L18F']}))
+        (tmp_path / 'compact.lock').write_text(f'{socket.gethostname()} {os.getpid()}\n')
+        _sequence_cache.compact_parts(str(tmp_path))
+        assert len(_sequence_cache.stored_parts(str(tmp_path))) == 2
+
+class TestAsyncRuns:
+
+    nextclade_kwargs = {'seq': 'tests/test_data/sequences', 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                        'gene': 'tests/test_data/sc2.gff'}
+
+    def async_capture(self, monkeypatch):
+        """Make the blocking and asyncio runs return the test analysis of each FASTA batch."""
+        capture, _ = analysis_capture()
+        async def capture_async(command, columns=None, engine=None):
+            await asyncio.sleep(0.01)
+            return capture(command)
+        async def stream_async(command, chunksize=10000):
+            analysis = capture(command)
+            for start in range(0, len(analysis), chunksize):
+                await asyncio.sleep(0)
+                yield analysis.iloc[start:start + chunksize].copy()
+        monkeypatch.setattr(_nextclade, 'capture_output', capture)
+        piped_capture(monkeypatch, capture)
+        monkeypatch.setattr(_nextclade_async, 'capture_output_async', capture_async)
+        monkeypatch.setattr(_nextclade_async, 'stream_output_async', stream_async)
+
+    def test_failed_command(self, tmp_path):
+        """A failed asyncio subprocess should raise an error with its output."""
+        command = [sys.executable, '-c', 'import sys; sys.exit("bad input")', '-t', str(tmp_path / 'analysis.tsv')]
+        with pytest.raises(RuntimeError, match='bad input'):
+            asyncio.run(capture_output_async(command))
+
+    def test_cancelled_command(self, tmp_path):
+        """A cancelled run should kill its subprocess instead of waiting for it."""
+        command = [sys.executable, '-c', 'import time; time.sleep(30)', '-t', str(tmp_path / 'analysis.tsv')]
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(capture_output_async(command), 0.5))
+        assert time.monotonic() - start < 10
+
+    def test_streamed_output(self):
+        """The piped analysis output should be read in chunks without the index column."""
+        write = "print('index\\tseqName'); [print(f'{i}\\ts{i}') for i in range(5)]"
+        async def read():
+            return [chunk async for chunk in stream_output_async([sys.executable, '-c', write], chunksize=2)]
+        chunks = asyncio.run(read())
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert pd.concat(chunks)['seqName'].tolist() == [f's{i}' for i in range(5)]
+
+    @pytest.mark.parametrize('chunksize', [None, 7])
+    def test_async_nextclade(self, monkeypatch, chunksize):
+        """Awaited runs should give the same output as blocking runs, reporting each batch as it completes."""
+        self.async_capture(monkeypatch)
+        completed = []
+        expected, _ = nextclade(**self.nextclade_kwargs, chunksize=chunksize)
+        result, _ = asyncio.run(nextclade_async(**self.nextclade_kwargs, chunksize=chunksize, 
+                                                on_batch=lambda batch, output: completed.append(batch)))
+        pd.testing.assert_frame_equal(result, expected)
+        assert sorted(completed) == ['sc2_BA1_n80', 'sc2_BA2_n80']
+
+    def test_async_stat(self, monkeypatch):
+        """Profiles awaited concurrently should give the same data as blocking profiles."""
+        self.async_capture(monkeypatch)
+        blocking = vargram(**self.nextclade_kwargs)
+        blocking.profile()
+        expected = blocking.stat()
+        async def stat_concurrently():
+            profiles = [vargram(**self.nextclade_kwargs) for _ in range(2)]
+            for vg in profiles:
+                vg.profile()
+            return await asyncio.gather(*(vg.astat() for vg in profiles))
+        for result in asyncio.run(stat_concurrently()):
+            pd.testing.assert_frame_equal(result, expected)
+
+    def test_async_figure_thread(self, monkeypatch, tmp_path):
+        """Awaited figures should be generated on the calling thread, wrangling in a worker thread."""
+        from vargram.plots._profile import Profile
+        from vargram.wranglers._wrangler import Wrangler
+        self.async_capture(monkeypatch)
+        threads = {}
+        def recording(name, method):
+            def record(self, *args, **kwargs):
+                threads[name] = threading.current_thread()
+                return method(self, *args, **kwargs)
+            return record
+        monkeypatch.setattr(Wrangler, 'get_wrangled_data', recording('wrangle', Wrangler.get_wrangled_data))
+        monkeypatch.setattr(Profile, 'save', recording('save', Profile.save))
+        vg = vargram(**self.nextclade_kwargs)
+        vg.profile()
+        asyncio.run(vg.asave(str(tmp_path / 'profile.png')))
+        assert threads['save'] is threading.main_thread()
+        assert threads['wrangle'] is not threading.main_thread()
+        assert os.path.getsize(tmp_path / 'profile.png') > 0
+
+    def test_cancelled_stat(self, monkeypatch):
+        """Cancelling an awaited profile should cancel its Nextclade runs."""
+        cancelled = []
+        async def slow_capture(command, columns=None, engine=None):
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append(command[-1])
+                raise
+        monkeypatch.setattr(_nextclade_async, 'capture_output_async', slow_capture)
+        vg = vargram(**self.nextclade_kwargs, processes=2, cpus=2)
+        vg.profile()
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(vg.astat(), 1))
+        assert time.monotonic() - start < 10
+        assert len(cancelled) == 2
@@ -0,0 +1,185 @@
+"""Tests whether VARGRAM runs Nextclade CLI correctly, using the stand-in Nextclade executable (tests/standin/nextclade)."""
+
+from vargram import vargram
+from vargram.wranglers import _nextclade
+from vargram.wranglers._nextclade import nextclade
+from vargram.wranglers._sequence_cache import read_fasta
+from vargram.wranglers._nextclade_async import nextclade_async
+from vargram.wranglers._nextclade_utils import count_nextclade
+from vargram.wranglers._datasets import check_reference
+import asyncio
+import pandas as pd
+import pytest
+import os
+import shutil
+
+STANDIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin')
+
+
+@pytest.fixture(autouse=True)
+def standin(monkeypatch, tmp_path):
+    """Put the stand-in Nextclade executable first in $PATH and use a temporary cache."""
+    monkeypatch.setenv('PATH', STANDIN_DIR + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    for variable in ['NEXTCLADE_STANDIN_FAIL', 'NEXTCLADE_STANDIN_OFFLINE']:
+        monkeypatch.delenv(variable, raising=False)
+
+
+class TestStandinRuns:
+
+    nextclade_kwargs = {'seq': 'tests/test_data/sequences', 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                        'gene': 'tests/test_data/sc2.gff', 'qc': None}
+
+    def test_run(self):
+        """Every sequence of every batch should be analysed."""
+        output, annotation = nextclade(**self.nextclade_kwargs)
+        assert len(output) == 160
+        assert output['batch'].unique().tolist() == ['sc2_BA1_n80', 'sc2_BA2_n80']
+        assert 'index' not in output.columns
+        assert annotation['feature'].eq('gene').all()
+
+    def test_equivalent_runs(self):
+        """Piped, sharded and awaited runs should count the same mutations as file runs."""
+        expected = count_nextclade([nextclade(**self.nextclade_kwargs)[0]])
+        piped, _ = nextclade(**self.nextclade_kwargs, chunksize=25)
+        pd.testing.assert_frame_equal(piped, expected)
+        single_file = {**self.nextclade_kwargs, 'seq': 'tests/test_data/sequences/sc2_BA1_n80.fasta'}
+        sharded, _ = nextclade(**single_file, shards=3, cpus=3)
+        unsharded, _ = nextclade(**single_file, shards=1)
+        pd.testing.assert_frame_equal(sharded, unsharded, check_dtype=False)
+        awaited, _ = asyncio.run(nextclade_async(**self.nextclade_kwargs))
+        pd.testing.assert_frame_equal(count_nextclade([awaited]), expected)
+
+    def test_incremental_run(self, tmp_path):
+        """Incremental runs should give the same output as full runs."""
+        expected, _ = nextclade(**self.nextclade_kwargs)
+        for _ in range(2):
+            result, _ = nextclade(**self.nextclade_kwargs, incremental=True, cache_dir=str(tmp_path))
+            pd.testing.assert_frame_equal(count_nextclade([result]), count_nextclade([expected]))
+
+    def test_failed_batch(self, monkeypatch):
+        """A failing batch should be left out with a warning."""
+        monkeypatch.setenv('NEXTCLADE_STANDIN_FAIL', 'BA2')
+        with pytest.warns(UserWarning, match='NEXTCLADE_STANDIN_FAIL'):
+            output, _ = nextclade(**self.nextclade_kwargs)
+        assert output['batch'].unique().tolist() == ['sc2_BA1_n80']
+
+
+class TestCollapsedRuns:
+
+    @pytest.fixture
+    def duplicated(self, tmp_path):
+        """Write FASTA batches where sequences are repeated within and across batches."""
+        ba1 = list(read_fasta('tests/test_data/sequences/sc2_BA1_n80.fasta'))
+        ba2 = list(read_fasta('tests/test_data/sequences/sc2_BA2_n80.fasta'))
+        batches = {'a.fasta': ba1 + [(f'repeat_{name}', sequence.lower()) for name, sequence in ba1[:30]],
+                   'b.fasta': ba2 + [(f'copy_{name}', sequence) for name, sequence in ba1[:5]]}
+        for file, records in batches.items():
+            (tmp_path / file).write_text(''.join(f'>{name}\n{sequence}\n' for name, sequence in records))
+        return {'seq': str(tmp_path), 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                'gene': 'tests/test_data/sc2.gff', 'qc': None}
+
+    def test_collapsed_run(self, monkeypatch, duplicated):
+        """Identical sequences should be run once and expanded back to every sequence name."""
+        expected, _ = nextclade(**duplicated)
+        run_sizes = []
+        capture = _nextclade.capture_output
+        def recording_capture(command, **read_options):
+            run_sizes.append(len(list(read_fasta(command[-1]))))
+            return capture(command, **read_options)
+        monkeypatch.setattr(_nextclade, 'capture_output', recording_capture)
+        result, _ = nextclade(**duplicated, collapse=True)
+        assert sorted(run_sizes) == [80, 80]
+        pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+
+    def test_shared_batch_name(self, monkeypatch, tmp_path):
+        """Collapsed FASTA files sharing a batch name should not overwrite each other's output."""
+        monkeypatch.setenv('NEXTCLADE_STANDIN_SEQ_LATENCY', '0.002') # Running both batches at the same time
+        shutil.copy('tests/test_data/sequences/sc2_BA1_n80.fasta', tmp_path / 'a.fasta')
+        shutil.copy('tests/test_data/sequences/sc2_BA2_n80.fasta', tmp_path / 'a.fa')
+        nextclade_kwargs = {'seq': str(tmp_path), 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                            'gene': 'tests/test_data/sc2.gff', 'qc': None}
+        expected, _ = nextclade(**nextclade_kwargs)
+        result, _ = nextclade(**nextclade_kwargs, collapse=True, processes=2, cpus=2)
+        assert len(result) == 160
+        pd.testing.assert_frame_equal(count_nextclade([result]), count_nextclade([expected]))
+
+    def test_failed_representative(self, monkeypatch, duplicated):
+        """Batches with sequences collapsed into a failed batch should be left out."""
+        monkeypatch.setenv('NEXTCLADE_STANDIN_FAIL', 'a.fasta')
+        with pytest.raises(RuntimeError, match='identical to sequences of a failed batch'):
+            nextclade(**duplicated, collapse=True)
+
+
+class TestWatchedRuns:
+
+    def test_watched_save(self, monkeypatch, tmp_path):
+        """Each watched FASTA file should be run once, saving the figure and data of every current batch."""
+        batch_dir = tmp_path / 'sequences'
+        batch_dir.mkdir()
+        shutil.copy('tests/test_data/sequences/sc2_BA1_n80.fasta', batch_dir)
+        vargram_kwargs = {'seq': str(batch_dir), 'ref': 'tests/test_data/sc2_wuhan_2019.fasta',
+                          'gene': 'tests/test_data/sc2.gff'}
+        run_files = []
+        capture = _nextclade.capture_output
+        def recording_capture(command, **read_options):
+            run_files.append(os.path.basename(command[-1]))
+            return capture(command, **read_options)
+        monkeypatch.setattr(_nextclade, 'capture_output', recording_capture)
+        vg = vargram(**vargram_kwargs)
+        vg.profile()
+        outputs = [str(tmp_path / 'profile.png'), str(tmp_path / 'profile.csv')]
+        vg.watch(outputs, interval=0.01, max_updates=1)
+        shutil.copy('tests/test_data/sequences/sc2_BA2_n80.fasta', batch_dir)
+        vg.watch(outputs, interval=0.01, max_updates=1)
+        assert run_files == ['sc2_BA1_n80.fasta', 'sc2_BA2_n80.fasta']
+        assert os.path.getsize(outputs[0]) > 0
+
+        vg = vargram(**vargram_kwargs)
+        vg.profile()
+        pd.testing.assert_frame_equal(pd.read_csv(outputs[1]), vg.stat().reset_index(drop=True), check_dtype=False)
+
+
+class TestStandinDatasets:
+
+    def test_dataset_run(self, monkeypatch, tmp_path):
+        """A dataset name should be checked, downloaded once and used for the run."""
+        vg = vargram(seq='tests/test_data/sequences', ref='sars-cov-2', cache_dir=str(tmp_path))
+        vg.profile()
+        expected = vg.stat()
+        assert os.listdir(tmp_path / 'datasets' / 'sars-cov-2') == ['latest']
+
+        # The downloaded dataset is used offline
+        monkeypatch.setenv('NEXTCLADE_STANDIN_OFFLINE', '1')
+        vg = vargram(seq='tests/test_data/sequences', ref='sars-cov-2', cache_dir=str(tmp_path))
+        vg.profile()
+        pd.testing.assert_frame_equal(vg.stat(), expected)
+
+    def test_updated_dataset_cache(self, monkeypatch, tmp_path):
+        """A cached analysis should not be used once the downloaded dataset is updated."""
+        pytest.importorskip('pyarrow')
+        run_files = []
+        capture = _nextclade.capture_output
+        def recording_capture(command, **read_options):
+            run_files.append(os.path.basename(command[-1]))
+            return capture(command, **read_options)
+        monkeypatch.setattr(_nextclade, 'capture_output', recording_capture)
+        vargram_kwargs = {'seq': 'tests/test_data/sequences/sc2_BA1_n80.fasta', 'ref': 'sars-cov-2',
+                          'cache': True, 'cache_dir': str(tmp_path)}
+        for _ in range(2):
+            vg = vargram(**vargram_kwargs)
+            vg.profile()
+            vg.stat()
+        assert len(run_files) == 1
+
+        with open(tmp_path / 'datasets' / 'sars-cov-2' / 'latest' / 'genome_annotation.gff3', 'a') as annotation_file:
+            annotation_file.write('# Updated\n')
+        vg = vargram(**vargram_kwargs)
+        vg.profile()
+        vg.stat()
+        assert len(run_files) == 2
+
+    def test_unrecognized_dataset(self, tmp_path):
+        """An unknown dataset name should be reported."""
+        with pytest.raises(ValueError, match='not recognized'):
+            check_reference('sars-cov-3', cache_dir=str(tmp_path))
@@ -2,7 +2,10 @@
 
 from create_profile_data import MyProfileData
 from vargram import vargram
+from vargram.plots._profile import count_stacks, weight_basis_points
+from decimal import Decimal
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 import pandas as pd
 import tempfile
@@ -99,4 +102,46 @@ class TestProfileData:
         vg = profile_data["vg"]
         expected = profile_data["output"]
         result = vg.stat()
-        assert result.equals(expected) 
\ No newline at end of file
+        assert result.equals(expected) 
+
+class TestWeights:
+
+    @pytest.mark.parametrize('values', [np.array([[1, 0], [23, 0], [8, 0]], dtype=np.uint8), # Ties at the third decimal
+                                        np.array([[1, 2**62], [7, 2**62], [2**40, 1]], dtype=np.uint64),
+                                        np.array([[0.5, 3.0], [0.25, 1.0], [2.0, 0.0]]),
+                                        np.array([[-1, 4], [3, 4], [5, 0]])])
+    def test_basis_points(self, values):
+        """Weights should equal percentages of each stack total rounded to two decimals with Decimal."""
+        basis_points = weight_basis_points(values)
+        for i in range(values.shape[1]):
+            stack = [Decimal(str(value)) for value in values[:, i]]
+            stack_sum = sum(stack, Decimal('0'))
+            if stack_sum == 0:
+                expected = [0.0] * len(stack)
+            else:
+                expected = [float((value * Decimal('100') / stack_sum).quantize(Decimal('0.01'))) for value in stack]
+            assert (basis_points[:, i] / 100).astype(float).tolist() == expected
+
+
+class TestCountStacks:
+
+    @pytest.mark.parametrize('values', [None, 'int', 'uint', 'bool', 'float'])
+    def test_pivot_counts(self, values):
+        """Stack sums should equal those of pandas.pivot_table()."""
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({'gene': pd.Categorical(rng.choice(['S', 'N', 'E', None], 500), categories=['S', 'N', 'E', 'M']),
+                             'mutation': pd.Categorical(rng.choice([f'A{i}V' for i in range(40)], 500)),
+                             'position': rng.integers(1, 5, 500),
+                             'batch': pd.Categorical(rng.choice(['b1', 'b3', 'b2'], 500), categories=['b3', 'b2', 'b1', 'b4']),
+                             'int': rng.integers(-3, 10, 500),
+                             'bool': rng.random(500) > 0.5,
+                             'float': rng.random(500)})
+        data['uint'] = data['int'].abs().astype(np.uint16)
+        data['ones'] = np.ones(len(data), dtype=np.uint8)
+        index_columns = ['gene', 'mutation', 'position']
+        expected = pd.pivot_table(data, index=index_columns, columns='batch', values=values or 'ones', aggfunc='sum', 
+                                  fill_value=0, observed=True).reset_index().rename_axis(None, axis=1)
+        index_data, stack_names, sums = count_stacks(data, index_columns, 'batch', values=values)
+        assert stack_names == ['b3', 'b2', 'b1']
+        pd.testing.assert_frame_equal(index_data, expected[index_columns])
+        np.testing.assert_array_equal(sums, expected[stack_names].to_numpy())